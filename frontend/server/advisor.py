@@ -30,13 +30,32 @@ def maybe_advise(user, project, database, base_url='http://localhost:3000'):
         user: the full user info.
         project: the project to advise. This proto will be modified.
     """
+    if recommend_advice(user, project, database):
+        send_activation_email(user, project, database, base_url)
+
+
+def recommend_advice(user, project, database):
+    """Populate the advice fields of a project if it needs advice.
+
+    This does not send any email, see send_activation_email.
+
+    Args:
+        user: the full user info.
+        project: the project to advise. This proto will be modified.
+    Returns:
+        whether some advice was recommended.
+    """
     if project.is_incomplete:
-        return
-    if _maybe_recommend_advice(user, project, database) and project.advices:
-        try:
-            _send_activation_email(user, project, database, base_url)
-        except mailjet_rest.client.ApiError as error:
-            logging.warning('Could not send the activation email: %s', error)
+        return False
+    return _maybe_recommend_advice(user, project, database) and bool(project.advices)
+
+
+def send_activation_email(user, project, database, base_url='http://localhost:3000'):
+    """Send the email about the advice that were just recommended for a project."""
+    try:
+        _send_activation_email(user, project, database, base_url)
+    except mailjet_rest.client.ApiError as error:
+        logging.warning('Could not send the activation email: %s', error)
 
 
 def _maybe_recommend_advice(user, project, database):
@@ -64,18 +83,29 @@ def compute_advices_for_project(user, project, database):
     scores = {}
     advice_modules = _advice_modules(database)
     advice = project_pb2.Advices()
-    for module in advice_modules:
-        if not module.is_ready_for_prod and not user.features_enabled.alpha:
-            continue
+    scored_modules = []
+    if user.features_enabled.alpha:
+        available_modules = advice_modules
+    else:
+        available_modules = _advice_modules_index(database).ready_for_prod
+    for module in available_modules:
         scoring_model = scoring.get_scoring_model(module.trigger_scoring_model)
         if scoring_model is None:
             logging.warning(
                 'Not able to score advice "%s", the scoring model "%s" is unknown.',
                 module.advice_id, module.trigger_scoring_model)
             continue
-        if user.features_enabled.all_modules:
-            scores[module.advice_id] = 3
-        else:
+        scored_modules.append((module, scoring_model))
+
+    if user.features_enabled.all_modules:
+        scores = {module.advice_id: 3 for module, unused_model in scored_modules}
+    else:
+        # Fetch concurrently all the data needed by the scoring models, so
+        # that the scoring itself does not wait on any I/O.
+        scoring_project.prefetch(sorted(set(
+            accessor for unused_module, scoring_model in scored_modules
+            for accessor in getattr(scoring_model, 'accessors', ()))))
+        for module, scoring_model in scored_modules:
             try:
                 scores[module.advice_id] = scoring_model.score(scoring_project)
             except Exception:  # pylint: disable=broad-except
@@ -146,7 +176,7 @@ def _maybe_override_advice_data(piece_of_advice, module, scoring_project):
 
 def _send_activation_email(user, project, database, base_url):
     """Send an email to the user just after we have defined their diagnosis."""
-    advice_modules = {a.advice_id: a for a in _advice_modules(database)}
+    advice_modules = _advice_modules_index(database).by_advice_id
     advices = [a for a in project.advices if a.advice_id in advice_modules]
     if not advices:
         logging.error(  # pragma: no-cover
@@ -198,11 +228,8 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
     if not cache:
         cache = {}
 
-    try:
-        module = next(
-            m for m in _advice_modules(database)
-            if m.advice_id == piece_of_advice.advice_id)
-    except StopIteration:
+    module = get_advice_module(piece_of_advice.advice_id, database)
+    if not module:
         logging.warning('Advice module %s does not exist anymore', piece_of_advice.advice_id)
         return []
 
@@ -228,28 +255,43 @@ def list_all_tips(user, project, piece_of_advice, database, cache=None, filter_t
 
 # Cache (from MongoDB) of known advice module.
 _ADVICE_MODULES = proto.MongoCachedCollection(advisor_pb2.AdviceModule, 'advice_modules')
-_EASY_ADVICE_MODULES = set()
+
+# Indexes of the advice modules.
+_AdviceModulesIndex = collections.namedtuple('AdviceModulesIndex', [
+    # Advice modules keyed by their advice_id.
+    'by_advice_id',
+    # The list of advice modules that are ready for prod.
+    'ready_for_prod',
+    # The set of the IDs of the easy advice modules.
+    'easy_advice_ids',
+])
 
 
 def _advice_modules(database):
     return _ADVICE_MODULES.get_collection(database)
 
 
+def _index_advice_modules(advice_modules):
+    advice_modules = list(advice_modules)
+    return _AdviceModulesIndex(
+        by_advice_id={m.advice_id: m for m in advice_modules},
+        ready_for_prod=[m for m in advice_modules if m.is_ready_for_prod],
+        easy_advice_ids=frozenset(m.advice_id for m in advice_modules if m.is_easy),
+    )
+
+
+def _advice_modules_index(database):
+    """Get the indexes of the advice modules, built once per refresh of the cache."""
+    return _advice_modules(database).get_derived('index', _index_advice_modules)
+
+
 def get_advice_module(advice_id, database):
     """Get a module by its ID."""
-    try:
-        return next(a for a in _advice_modules(database) if a.advice_id == advice_id)
-    except StopIteration:
-        return None
+    return _advice_modules_index(database).by_advice_id.get(advice_id)
 
 
 def _easy_advice_modules(database):
-    if _EASY_ADVICE_MODULES:
-        return _EASY_ADVICE_MODULES
-    _EASY_ADVICE_MODULES.update(
-        a.advice_id for a in _advice_modules(database)
-        if a.is_easy)
-    return _EASY_ADVICE_MODULES
+    return _advice_modules_index(database).easy_advice_ids
 
 
 # Cache (from MongoDB) of known tip templates.
@@ -264,5 +306,4 @@ def _tip_templates(database):
 def clear_cache():
     """Clear all caches for this module."""
     _ADVICE_MODULES.reset_cache()
-    _EASY_ADVICE_MODULES.clear()
     _TIP_TEMPLATES.reset_cache()
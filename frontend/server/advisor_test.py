@@ -216,6 +216,45 @@ class MaybeAdviseTestCase(_BaseTestCase):
         mock_send_template.assert_called_once()
         mock_logger.assert_called_once()
 
+    @mock.patch(advisor.scoring.__name__ + '.SCORING_MODELS', new_callable=dict)
+    @mock.patch(advisor.scoring.__name__ + '.ScoringProject.prefetch')
+    def test_prefetch_data(self, mock_prefetch, mock_scoring_models, mock_send_template):
+        """Prefetch the data needed by all the modules before scoring them."""
+        mock_send_template().status_code = 200
+
+        mock_scoring_models['needs-trainings'] = mock.MagicMock(spec=['score', 'accessors'])
+        mock_scoring_models['needs-trainings'].accessors = ('get_trainings', 'job_group_info')
+        mock_scoring_models['needs-trainings'].score.return_value = 1
+        mock_scoring_models['needs-missions'] = mock.MagicMock(spec=['score', 'accessors'])
+        mock_scoring_models['needs-missions'].accessors = (
+            'volunteering_missions', 'job_group_info')
+        mock_scoring_models['needs-missions'].score.return_value = 2
+
+        def _check_not_scored(unused_accessors):
+            mock_scoring_models['needs-trainings'].score.assert_not_called()
+            mock_scoring_models['needs-missions'].score.assert_not_called()
+        mock_prefetch.side_effect = _check_not_scored
+
+        project = project_pb2.Project()
+        self.database.advice_modules.insert_many([
+            {
+                'adviceId': 'training',
+                'triggerScoringModel': 'needs-trainings',
+                'isReadyForProd': True,
+            },
+            {
+                'adviceId': 'volunteer',
+                'triggerScoringModel': 'needs-missions',
+                'isReadyForProd': True,
+            },
+        ])
+
+        advisor.maybe_advise(self.user, project, self.database)
+
+        mock_prefetch.assert_called_once_with(
+            ['get_trainings', 'job_group_info', 'volunteering_missions'])
+        self.assertEqual(['volunteer', 'training'], [a.advice_id for a in project.advices])
+
 
 class ExtraDataTestCase(_BaseTestCase):
     """Unit tests for maybe_advise to compute extra data for advice modules."""
@@ -579,5 +618,66 @@ class OverrideAdviceTestCase(_BaseTestCase):
         self.assertTrue(advice.expanded_card_items)
 
 
+class AdviceModulesIndexTestCase(_BaseTestCase):
+    """Unit tests for the indexes of advice modules."""
+
+    def setUp(self):
+        super(AdviceModulesIndexTestCase, self).setUp()
+        self.database.advice_modules.insert_many([
+            {
+                'adviceId': 'network',
+                'airtableId': 'recNetwork',
+                'isReadyForProd': True,
+                'isEasy': True,
+            },
+            {
+                'adviceId': 'alpha',
+                'airtableId': 'recAlpha',
+            },
+        ])
+
+    def test_get_advice_module(self):
+        """Get advice modules by their IDs."""
+        self.assertEqual(
+            'recNetwork', advisor.get_advice_module('network', self.database).airtable_id)
+        self.assertEqual(
+            'recAlpha', advisor.get_advice_module('alpha', self.database).airtable_id)
+        self.assertIsNone(advisor.get_advice_module('unknown', self.database))
+
+    def test_index_once(self):
+        """Build the indexes only once per refresh of the cache."""
+        # pylint: disable=protected-access
+        with mock.patch(
+                advisor.__name__ + '._index_advice_modules',
+                wraps=advisor._index_advice_modules) as mock_index:
+            advisor.get_advice_module('network', self.database)
+            index = advisor._advice_modules_index(self.database)
+            mock_index.assert_called_once()
+
+            advisor.clear_cache()
+            self.database.advice_modules.insert_one({'adviceId': 'new', 'isEasy': True})
+            self.assertTrue(advisor.get_advice_module('new', self.database))
+            self.assertEqual(2, mock_index.call_count)
+
+        self.assertEqual({'network'}, index.easy_advice_ids)
+        self.assertEqual(['network'], [m.advice_id for m in index.ready_for_prod])
+        self.assertEqual('recAlpha', index.by_advice_id['alpha'].airtable_id)
+        self.assertEqual({'network', 'new'}, advisor._easy_advice_modules(self.database))
+
+    def test_ready_for_prod(self):
+        """Only score the advice modules ready for prod."""
+        self.database.advice_modules.update_many({}, {'$set': {
+            'triggerScoringModel': 'constant(2)',
+        }})
+        advices = advisor.compute_advices_for_project(
+            self.user, project_pb2.Project(), self.database)
+        self.assertEqual(['network'], [a.advice_id for a in advices.advices])
+
+        self.user.features_enabled.alpha = True
+        advices = advisor.compute_advices_for_project(
+            self.user, project_pb2.Project(), self.database)
+        self.assertEqual(['network', 'alpha'], [a.advice_id for a in advices.advices])
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
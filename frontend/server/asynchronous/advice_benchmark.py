@@ -0,0 +1,186 @@
+"""Script to benchmark the advisor on a pool of use cases.
+
+It computes the advice for the main project of each use case of a pool, as
+created by create_pool.py, and reports the throughput, the distribution of
+the latencies, the slowest use cases and the time spent in each scoring
+model.
+
+The external APIs called by the advisor (CARIF, LBB) are stubbed so that the
+benchmark neither loads them nor depends on their latency. The market data is
+read from MongoDB, or from a folder of JSON fixtures, one
+file per collection (e.g. job_group_info.json), loaded in a local mongomock
+database so that the results are reproducible.
+
+If a max latency is given, the script fails when any use case is slower, so
+that it can be used as a regression gate before deploying.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask-test python bob_emploi/frontend/asynchronous/advice_benchmark.py \
+    2017-11-15 3 50 bob_emploi/frontend/testdata
+"""
+import contextlib
+import json
+import math
+import os
+import sys
+import timeit
+
+import mock
+import pymongo
+
+try:
+    import mongomock
+except ImportError:
+    # mongomock is only needed to run the benchmark on fixtures.
+    mongomock = None
+
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend import carif
+from bob_emploi.frontend import companies
+from bob_emploi.frontend import proto
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import use_case_pb2
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+# Number of slowest use cases and most expensive scoring models to report.
+_NUM_REPORTED = 10
+
+
+def load_fixtures(fixture_folder):
+    """Load a folder of JSON fixtures in a mongomock database.
+
+    Args:
+        fixture_folder: a folder with a JSON file for each collection, named
+            after the collection and containing a list of documents.
+    Returns:
+        a mongomock database.
+    """
+    if not mongomock:
+        raise ValueError('mongomock is required to load fixtures.')
+    database = mongomock.MongoClient().get_database('fixtures')
+    for filename in sorted(os.listdir(fixture_folder)):
+        collection, extension = os.path.splitext(filename)
+        if extension != '.json':
+            continue
+        with open(os.path.join(fixture_folder, filename)) as json_file:
+            documents = json.load(json_file)
+        if documents:
+            database[collection].insert_many(documents)
+    return database
+
+
+@contextlib.contextmanager
+def stub_external_apis():
+    """Stub the external APIs called by the advisor: they return no results."""
+    with mock.patch(carif.__name__ + '.get_trainings', return_value=[]), \
+            mock.patch(companies.__name__ + '.get_lbb_companies', return_value=[]):
+        yield
+
+
+def _load_use_cases(pool_name, database):
+    use_cases = []
+    for use_case_dict in database.use_case.find({'poolName': pool_name}).sort('indexInPool'):
+        use_case = use_case_pb2.UseCase()
+        use_case.use_case_id = use_case_dict.pop('_id')
+        if proto.parse_from_mongo(use_case_dict, use_case) and use_case.user_data.projects:
+            use_cases.append(use_case)
+    return use_cases
+
+
+def _percentile(sorted_values, percent):
+    index = max(0, math.ceil(len(sorted_values) * percent / 100) - 1)
+    return sorted_values[index]
+
+
+def benchmark_use_cases(use_cases, database, repeat=3):
+    """Time the advisor on each use case.
+
+    All use cases are advised once to warm up the caches, and then timed
+    several times.
+
+    Args:
+        use_cases: a list of UseCase protos with at least one project.
+        database: the database with the market data.
+        repeat: the number of times to advise all the use cases.
+    Returns:
+        a tuple with the time of the first pass on all the use cases, the best
+        time of the other passes, and the best time for each use case.
+    """
+    def _advise(use_case):
+        advisor.compute_advices_for_project(
+            use_case.user_data, use_case.user_data.projects[0], database)
+
+    with stub_external_apis():
+        start = timeit.default_timer()
+        for use_case in use_cases:
+            _advise(use_case)
+        first_pass_time = timeit.default_timer() - start
+
+        scoring.reset_stats()
+        latencies = [float('inf')] * len(use_cases)
+        pass_times = []
+        for unused_index in range(repeat):
+            pass_start = timeit.default_timer()
+            for index, use_case in enumerate(use_cases):
+                start = timeit.default_timer()
+                _advise(use_case)
+                latencies[index] = min(latencies[index], timeit.default_timer() - start)
+            pass_times.append(timeit.default_timer() - pass_start)
+    return first_pass_time, min(pass_times), latencies
+
+
+def main(pool_name, repeat=3, max_latency_ms=0, fixture_folder='', database=None):
+    """Benchmark the advisor on a pool of use cases.
+
+    Returns:
+        False if a use case is slower than max_latency_ms.
+    """
+    if database is None:
+        database = _DB
+    use_cases = _load_use_cases(pool_name, database)
+    print('Pool "%s": %d use cases with a project' % (pool_name, len(use_cases)))
+    if not use_cases:
+        return True
+    market_database = load_fixtures(fixture_folder) if fixture_folder else database
+
+    scoring.enable_stats()
+    try:
+        first_pass_time, pass_time, latencies = benchmark_use_cases(
+            use_cases, market_database, repeat=int(repeat))
+        stats = scoring.get_stats()
+    finally:
+        scoring.enable_stats(False)
+
+    sorted_latencies = sorted(latencies)
+    print('First pass: %.2fms' % (first_pass_time * 1000))
+    print('Throughput: %.1f use cases/s' % (len(use_cases) / pass_time))
+    print('Latency: min %.2fms, p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms' % tuple(
+        value * 1000 for value in (
+            sorted_latencies[0], _percentile(sorted_latencies, 50),
+            _percentile(sorted_latencies, 90), _percentile(sorted_latencies, 99),
+            sorted_latencies[-1])))
+    print('Slowest use cases:')
+    slowest = sorted(zip(latencies, use_cases), key=lambda item: -item[0])[:_NUM_REPORTED]
+    for latency, use_case in slowest:
+        print('  %-20s %8.2fms %s' % (use_case.use_case_id, latency * 1000, use_case.title))
+    print('Most expensive scoring models:')
+    for model in stats.scoring_models[:_NUM_REPORTED]:
+        print('  %-30s %6d calls %8.2fms' % (
+            model.scoring_model_name, sum(method.call_count for method in model.methods),
+            model.total_duration_seconds * 1000))
+
+    max_latency_ms = float(max_latency_ms)
+    if max_latency_ms and sorted_latencies[-1] * 1000 > max_latency_ms:
+        print('%d use cases are slower than %.2fms' % (
+            sum(1 for latency in latencies if latency * 1000 > max_latency_ms), max_latency_ms))
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main(*sys.argv[1:]) else 1)
@@ -0,0 +1,136 @@
+"""Tests for the advice_benchmark module."""
+import json
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import advisor
+from bob_emploi.frontend import carif
+from bob_emploi.frontend import companies
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import use_case_pb2
+from bob_emploi.frontend.asynchronous import advice_benchmark
+
+
+@mock.patch(advice_benchmark.__name__ + '.print', create=True)
+class AdviceBenchmarkTestCase(unittest.TestCase):
+    """Unit tests for the advice benchmark script."""
+
+    def setUp(self):
+        super(AdviceBenchmarkTestCase, self).setUp()
+        advisor.clear_cache()
+        self.database = mongomock.MongoClient().test
+        self.database.use_case.insert_many([
+            {
+                '_id': 'pool_00',
+                'poolName': 'pool',
+                'indexInPool': 0,
+                'title': 'Boulanger',
+                'userData': {'projects': [{'title': 'Boulanger'}]},
+            },
+            {
+                '_id': 'pool_01',
+                'poolName': 'pool',
+                'indexInPool': 1,
+                'title': 'No project',
+                'userData': {},
+            },
+            {
+                '_id': 'other-pool_00',
+                'poolName': 'other-pool',
+                'indexInPool': 0,
+                'userData': {'projects': [{'title': 'Pâtissier'}]},
+            },
+        ])
+        self.advice_modules = [{
+            'adviceId': 'network',
+            'triggerScoringModel': 'constant(2)',
+            'isReadyForProd': True,
+        }]
+
+    def tearDown(self):
+        advisor.clear_cache()
+        super(AdviceBenchmarkTestCase, self).tearDown()
+
+    def _lines(self, mock_print):
+        return [call[0][0] for call in mock_print.call_args_list]
+
+    def test_main(self, mock_print):
+        """Benchmark the use cases of a pool."""
+        self.database.advice_modules.insert_many(self.advice_modules)
+
+        self.assertTrue(advice_benchmark.main('pool', '2', database=self.database))
+
+        lines = self._lines(mock_print)
+        self.assertEqual('Pool "pool": 1 use cases with a project', lines[0])
+        self.assertTrue(lines[1].startswith('First pass: '), msg=lines)
+        self.assertTrue(lines[2].startswith('Throughput: '), msg=lines)
+        self.assertTrue(lines[3].startswith('Latency: min '), msg=lines)
+        self.assertEqual('Slowest use cases:', lines[4])
+        self.assertIn('pool_00', lines[5])
+        self.assertIn('Boulanger', lines[5])
+        self.assertEqual('Most expensive scoring models:', lines[6])
+        self.assertIn('constant(2)', lines[7])
+        self.assertIn(' 2 calls', lines[7])
+        self.assertFalse(scoring.get_stats().enabled)
+
+    def test_fixtures(self, mock_print):
+        """Use the market data from fixtures."""
+        fixture_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, fixture_folder)
+        with open(path.join(fixture_folder, 'advice_modules.json'), 'w') as json_file:
+            json.dump(self.advice_modules, json_file)
+        with open(path.join(fixture_folder, 'README.md'), 'w') as readme_file:
+            readme_file.write('Not a fixture')
+
+        advice_benchmark.main('pool', '1', fixture_folder=fixture_folder, database=self.database)
+
+        lines = self._lines(mock_print)
+        self.assertIn('constant(2)', lines[7])
+
+    def test_max_latency(self, mock_print):
+        """Fail when a use case is too slow."""
+        self.database.advice_modules.insert_many(self.advice_modules)
+
+        with mock.patch(advice_benchmark.__name__ + '.benchmark_use_cases') as mock_benchmark:
+            mock_benchmark.return_value = (.5, .2, [.2])
+            self.assertFalse(advice_benchmark.main('pool', '1', '100', database=self.database))
+
+        lines = self._lines(mock_print)
+        self.assertEqual('1 use cases are slower than 100.00ms', lines[-1])
+
+    @mock.patch(carif.__name__ + '._fetch_trainings')
+    @mock.patch(companies.__name__ + '._get_client')
+    @mock.patch(companies.__name__ + '._EMPLOI_STORE_DEV_CLIENT_ID', 'my-client-id')
+    @mock.patch(companies.__name__ + '._EMPLOI_STORE_DEV_SECRET', 'my-secret')
+    @mock.patch(advisor.__name__ + '.compute_advices_for_project')
+    def test_stub_external_apis(
+            self, mock_advise, mock_lbb_client, mock_fetch_trainings, unused_mock_print):
+        """Do not call the external APIs while benchmarking."""
+        results = []
+
+        def _advise(unused_user, project, unused_database):
+            results.append((
+                carif.get_trainings('A1234', '75'), list(companies.get_lbb_companies(project))))
+        mock_advise.side_effect = _advise
+
+        use_case = use_case_pb2.UseCase()
+        use_case.user_data.projects.add(title='Boulanger')
+        advice_benchmark.benchmark_use_cases([use_case], self.database, repeat=1)
+
+        self.assertEqual([([], []), ([], [])], results)
+        mock_fetch_trainings.assert_not_called()
+        mock_lbb_client.assert_not_called()
+
+    def test_empty_pool(self, mock_print):
+        """Nothing to benchmark."""
+        self.assertTrue(advice_benchmark.main('unknown', database=self.database))
+        self.assertEqual(['Pool "unknown": 0 use cases with a project'], self._lines(mock_print))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,109 @@
+"""Script to benchmark the engines finding commuting cities.
+
+It compares the per-proto loop, the grid index and the NumPy arrays on the
+largest documents of the hiring_cities collection.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask-test python bob_emploi/frontend/asynchronous/commute_benchmark.py 5
+"""
+import math
+import os
+import sys
+import timeit
+
+import pymongo
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import commute_pb2
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+# Number of target cities to look around in each job group.
+_NUM_TARGETS = 50
+
+
+class _HiringCitiesLoop(object):
+    """Find commuting cities by looping over all the hiring cities protos."""
+
+    def __init__(self, hiring_cities):
+        self.hiring_cities = hiring_cities
+
+    def list_commuting_cities(self, target_city):
+        """List the hiring cities closer than the max distance to a city."""
+        ref = next((
+            h.offers / h.city.population for h in self.hiring_cities
+            if h.city.city_id == target_city.city_id and h.city.population), 0)
+        for hiring_city in self.hiring_cities:
+            distance = math.sqrt(scoring.compute_square_distance(hiring_city.city, target_city))
+            if distance >= scoring._MAX_CITY_DISTANCE:  # pylint: disable=protected-access
+                continue
+            try:
+                relative_offers = (hiring_city.offers / hiring_city.city.population) / ref
+            except ZeroDivisionError:
+                relative_offers = 0
+            yield commute_pb2.CommutingCity(
+                name=hiring_city.city.name,
+                relative_offers_per_inhabitant=relative_offers,
+                distance_km=distance)
+
+
+def _list_engines():
+    engines = [
+        ('loop', _HiringCitiesLoop),
+        ('grid', scoring._HiringCitiesIndex),  # pylint: disable=protected-access
+    ]
+    if scoring.numpy:
+        engines.append(('numpy', scoring._HiringCitiesArrays))  # pylint: disable=protected-access
+    return engines
+
+
+def benchmark_job_group(hiring_cities, repeat=3):
+    """Time all the engines on one job group.
+
+    Args:
+        hiring_cities: a list of HiringCity protos.
+        repeat: the number of times to run each engine.
+    Returns:
+        a list of tuples with the engine name, the time to build it and the
+        best time to find commuting cities around the first hiring cities.
+    """
+    targets = [h.city for h in hiring_cities[:_NUM_TARGETS]]
+    results = []
+    for name, engine_class in _list_engines():
+        start = timeit.default_timer()
+        engine = engine_class(hiring_cities)
+        build_time = timeit.default_timer() - start
+        query_time = min(timeit.repeat(
+            lambda engine=engine: [
+                list(engine.list_commuting_cities(target)) for target in targets],
+            number=1, repeat=repeat))
+        results.append((name, build_time, query_time))
+    return results
+
+
+def main(num_job_groups=5, database=None):
+    """Benchmark the commute engines on the largest hiring_cities documents."""
+    if database is None:
+        database = _DB
+    largest = database.hiring_cities.aggregate([
+        {'$project': {'size': {'$size': {'$ifNull': ['$hiringCities', []]}}}},
+        {'$sort': {'size': -1}},
+        {'$limit': int(num_job_groups)},
+    ])
+    for job_group in largest:
+        all_cities = commute_pb2.HiringCities()
+        proto.parse_from_mongo(
+            database.hiring_cities.find_one({'_id': job_group['_id']}), all_cities)
+        print('%s: %d hiring cities' % (job_group['_id'], len(all_cities.hiring_cities)))
+        for name, build_time, query_time in benchmark_job_group(all_cities.hiring_cities):
+            print('  %-6s build %8.2fms, %d queries %8.2fms' % (
+                name, build_time * 1000, _NUM_TARGETS, query_time * 1000))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
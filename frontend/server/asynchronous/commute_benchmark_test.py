@@ -0,0 +1,68 @@
+"""Tests for the commute_benchmark module."""
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend.asynchronous import commute_benchmark
+from bob_emploi.frontend.api import commute_pb2
+from bob_emploi.frontend.api import geo_pb2
+
+
+def _hiring_city(city_id, latitude, longitude, offers=10, population=1000):
+    return commute_pb2.HiringCity(offers=offers, city=geo_pb2.FrenchCity(
+        city_id=city_id, name='City %s' % city_id, latitude=latitude, longitude=longitude,
+        population=population))
+
+
+class CommuteBenchmarkTestCase(unittest.TestCase):
+    """Unit tests for the commute benchmark script."""
+
+    def test_engines_agree(self):
+        """All engines find the same commuting cities."""
+        hiring_cities = [
+            _hiring_city('69123', 45.75, 4.85),
+            _hiring_city('69266', 45.77, 4.88, offers=30),
+            _hiring_city('38185', 45.19, 5.72),
+            _hiring_city('69149', 45.73, 4.80, population=0),
+        ]
+        # pylint: disable=protected-access
+        results = {
+            name: list(engine_class(hiring_cities).list_commuting_cities(hiring_cities[0].city))
+            for name, engine_class in commute_benchmark._list_engines()}
+
+        self.assertEqual(
+            ['City 69123', 'City 69266', 'City 69149'], [c.name for c in results['loop']])
+        for name, commuting_cities in results.items():
+            self.assertEqual(len(results['loop']), len(commuting_cities), msg=name)
+            for expected, city in zip(results['loop'], commuting_cities):
+                self.assertEqual(expected.name, city.name, msg=name)
+                self.assertAlmostEqual(expected.distance_km, city.distance_km, places=3, msg=name)
+                self.assertAlmostEqual(
+                    expected.relative_offers_per_inhabitant,
+                    city.relative_offers_per_inhabitant, places=3, msg=name)
+
+    @mock.patch(commute_benchmark.__name__ + '.print', create=True)
+    def test_main(self, mock_print):
+        """Benchmark the largest job groups."""
+        database = mongomock.MongoClient().test
+        database.hiring_cities.insert_many([
+            {'_id': 'A1234', 'hiringCities': [
+                {'offers': 3, 'city': {'cityId': '69123', 'latitude': 45.75, 'longitude': 4.85}},
+            ]},
+            {'_id': 'B1234', 'hiringCities': [
+                {'offers': 3, 'city': {'cityId': '69123', 'latitude': 45.75, 'longitude': 4.85}},
+                {'offers': 5, 'city': {'cityId': '69266', 'latitude': 45.77, 'longitude': 4.88}},
+            ]},
+        ])
+
+        commute_benchmark.main('1', database=database)
+
+        lines = [call[0][0] for call in mock_print.call_args_list]
+        self.assertEqual('B1234: 2 hiring cities', lines[0])
+        self.assertIn('loop', lines[1])
+        self.assertIn('grid', lines[2])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
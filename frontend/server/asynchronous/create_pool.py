@@ -1,5 +1,11 @@
-"""Script to create a pool of use cases from actual users."""
+"""Script to create a pool of use cases from actual users.
+
+Custom filters can only select users stored as binary protos on the fields of
+auth.USER_INDEXED_FIELDS.
+"""
+import copy
 import datetime
+import itertools
 import json
 import os
 import re
@@ -11,6 +17,8 @@ import pymongo
 import requests
 
 from bob_emploi.frontend import privacy
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
 
 _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
     .get_default_database()
@@ -27,16 +35,37 @@ _YESTERDAY = (datetime.date.today() + datetime.timedelta(days=-1)).strftime('%Y-
 _DEFAULT_USERS_FILTER = {
     'profile.email': {'$not': re.compile('@example.com|@bayes')},
     'registeredAt': {'$gt': _YESTERDAY, '$lt': '%sT24' % _YESTERDAY},
-    'projects.createdAt': {'$exists': True},
-    'projects.isIncomplete': {'$ne': True},
+    '$or': [
+        # Users stored as binary protos do not have their projects as JSON
+        # fields: they are filtered after being parsed.
+        {proto.BINARY_FIELD: {'$exists': True}},
+        {
+            'projects.createdAt': {'$exists': True},
+            'projects.isIncomplete': {'$ne': True},
+        },
+    ],
 }
 
 
+def _has_complete_projects(user_dict):
+    """Check the projects of a user, as in _DEFAULT_USERS_FILTER."""
+    if proto.BINARY_FIELD not in user_dict:
+        return True
+    user = user_pb2.User()
+    # parse_from_mongo modifies the dict.
+    if not proto.parse_from_mongo(copy.deepcopy(user_dict), user):
+        return False
+    return any(p.HasField('created_at') for p in user.projects) and \
+        not any(p.is_incomplete for p in user.projects)
+
+
 def main(pool_name=_YESTERDAY, users_json_filters=None, limit=20):
     """Create a pool of use cases and store them in MongoDB."""
     users_filters = json.loads(users_json_filters) if users_json_filters else _DEFAULT_USERS_FILTER
-    user_iterator = _DB.user.find(users_filters).limit(int(limit))
-    for user_index, user_dict in enumerate(user_iterator):
+    user_iterator = _DB.user.find(users_filters)
+    if not users_json_filters:
+        user_iterator = filter(_has_complete_projects, user_iterator)
+    for user_index, user_dict in enumerate(itertools.islice(user_iterator, int(limit) or None)):
         use_case_proto = privacy.user_to_use_case(user_dict, pool_name, user_index)
         use_case = json_format.MessageToDict(use_case_proto)
         use_case['_id'] = use_case.pop('useCaseId')
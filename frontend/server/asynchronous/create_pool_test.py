@@ -4,6 +4,9 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import auth
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.asynchronous import create_pool
 
 
@@ -58,6 +61,31 @@ class CreatePoolTestCase(unittest.TestCase):
             },
         )
 
+    def test_default_filter(self):
+        """Select users who finished their onboarding, even stored as binary protos."""
+        registered_at = create_pool._YESTERDAY + 'T12:00:00Z'  # pylint: disable=protected-access
+        self._db.user.insert_one({
+            'profile': {'email': 'json@example.fr', 'yearOfBirth': 1980},
+            'registeredAt': registered_at,
+            'projects': [{'createdAt': registered_at}],
+        })
+        for email, year_of_birth, is_incomplete in (
+                ('binary@example.fr', 1981, False), ('incomplete@example.fr', 1982, True)):
+            user = user_pb2.User()
+            user.profile.email = email
+            user.profile.year_of_birth = year_of_birth
+            proto.parse_from_mongo({'registeredAt': registered_at}, user)
+            project = user.projects.add(is_incomplete=is_incomplete)
+            project.created_at.CopyFrom(user.registered_at)
+            self._db.user.insert_one(
+                proto.to_binary_document(user, auth.USER_INDEXED_FIELDS))
+
+        create_pool.main(pool_name='test-pool')
+
+        self.assertEqual(
+            [1980, 1981],
+            sorted(u['userData']['profile']['yearOfBirth'] for u in self._db.use_case.find()))
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -147,13 +147,21 @@ def main():
             '$gt': '2017-04-01',
             '$lt': '2017-07-10',
         },
-        'projects.networkEstimate': 1,
+        '$or': [
+            # Users stored as binary protos do not have their projects as JSON
+            # fields: they are filtered after being parsed.
+            {proto.BINARY_FIELD: {'$exists': True}},
+            {'projects.networkEstimate': 1},
+        ],
     })
     for user_dict in selected_users:
         user_id = user_dict.pop('_id')
         user = user_pb2.User()
         proto.parse_from_mongo(user_dict, user)
 
+        if not any(project.network_estimate == 1 for project in user.projects):
+            continue
+
         if any(email.campaign_id == campaign_id for email in user.emails_sent):
             # We already sent the email to that person.
             continue
@@ -6,6 +6,8 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import auth
+from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.asynchronous import focus_email
 
@@ -104,6 +106,30 @@ class FocusEmailTestCase(unittest.TestCase):
             [e.keys() for e in april_user.get('emailsSent', [])])
         self.assertEqual('focus-network', april_user['emailsSent'][0]['campaignId'])
 
+    @mock.patch(focus_email.mail.__name__ + '.send_template')
+    @mock.patch(
+        focus_email.__name__ + '._DB',
+        new_callable=lambda: mongomock.MongoClient().test)
+    @mock.patch(focus_email.__name__ + '._DOMAINS', new={'A': 'dans la vie'})
+    def test_binary_users(self, mock_db, mock_mail):
+        """Select users stored as binary protos on their projects."""
+        mock_mail().status_code = 200
+        mock_mail.reset_mock()
+        for name, network_estimate in (('Network', 1), ('No network', 2)):
+            user = user_pb2.User()
+            user.registered_at.FromDatetime(datetime.datetime(2017, 5, 15))
+            user.profile.name = name
+            user.projects.add(network_estimate=network_estimate).target_job.job_group.rome_id = \
+                'A1234'
+            document = proto.to_binary_document(user, auth.USER_INDEXED_FIELDS)
+            document['_id'] = name
+            mock_db.user.insert_one(document)
+
+        self.assertEqual(1, focus_email.main())
+
+        self.assertEqual('Network', mock_mail.call_args[0][1].name)
+        self.assertTrue(mock_db.user.find_one({'_id': 'Network'}).get('emailsSent'))
+
 
 class StripDistrictTestCase(unittest.TestCase):
     """Unit tests for the strip_district method."""
@@ -0,0 +1,307 @@
+"""Script to load test the API of the server.
+
+It runs sessions of users signing up, saving a project, getting advice,
+browsing the project's resources and logging in again, concurrently on the
+Flask app with a local mongomock database. The market data can be loaded from
+a folder of JSON fixtures, one file per collection. As mongomock is not thread
+safe, its calls are serialized. The external APIs (CARIF, LBB) are stubbed.
+
+It reports the throughput and the latencies of each endpoint. Then it replays
+one session sequentially while tracing the memory allocations of each
+request: the peak of memory allocated during the request and the memory
+still allocated after it.
+
+The report can be saved in a JSON file and compared with the report of
+another commit, given as a baseline.
+
+Usage:
+
+docker-compose run --rm frontend-flask-test \
+    python bob_emploi/frontend/asynchronous/load_benchmark.py \
+    200 8 bob_emploi/frontend/testdata report.json baseline.json
+"""
+from concurrent import futures
+import binascii
+import collections
+import contextlib
+import functools
+import hashlib
+import json
+import math
+import sys
+import threading
+import timeit
+import tracemalloc
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import server
+from bob_emploi.frontend.asynchronous import advice_benchmark
+
+# Project resources browsed during each session.
+_PROJECT_RESOURCES = (
+    'associations', 'commute', 'events', 'interview-tips', 'jobboards', 'resume-tips', 'volunteer')
+
+
+def _sha1(*args):
+    hasher = hashlib.sha1()
+    for arg in args:
+        hasher.update(arg.encode('utf-8'))
+    return binascii.hexlify(hasher.digest()).decode('ascii')
+
+
+class _Recorder(object):
+    """Send requests to the app and record their latencies and allocations."""
+
+    def __init__(self, trace_allocations=False):
+        self._trace_allocations = trace_allocations
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.peak_bytes = collections.defaultdict(list)
+        self.retained_bytes = collections.defaultdict(list)
+
+    def request(self, name, method, url, data=None):
+        """Send a request and record its stats.
+
+        Args:
+            name: the name of the endpoint in the report.
+            method: the method of the test client to use, e.g. client.post.
+            url: the URL of the request.
+            data: the JSON data of the request if any.
+        Returns:
+            the JSON response, or None if the request failed.
+        """
+        kwargs = {}
+        if data is not None:
+            kwargs = {'data': json.dumps(data), 'content_type': 'application/json'}
+        if self._trace_allocations:
+            # Also resets the peak of traced memory.
+            tracemalloc.clear_traces()
+        start = timeit.default_timer()
+        response = method(url, **kwargs)
+        duration = timeit.default_timer() - start
+        if self._trace_allocations:
+            retained, peak = tracemalloc.get_traced_memory()
+        with self._lock:
+            self.latencies[name].append(duration)
+            if self._trace_allocations:
+                self.peak_bytes[name].append(peak)
+                self.retained_bytes[name].append(retained)
+            if response.status_code != 200:
+                self.errors[name] += 1
+                return None
+        return json.loads(response.get_data(as_text=True) or '{}')
+
+
+def run_session(client, session_id, recorder):
+    """Run the requests of a user session.
+
+    Args:
+        client: a test client of the Flask app.
+        session_id: a unique ID for the session, used in the user's email.
+        recorder: a _Recorder to send the requests.
+    """
+    email = 'load-test-%s@example.com' % session_id
+    auth_response = recorder.request(
+        'sign up', client.post, '/api/user/authenticate', {
+            'email': email,
+            'firstName': 'Load',
+            'lastName': 'Test',
+            'hashedPassword': _sha1(email, 'psswd'),
+        })
+    if not auth_response:
+        return
+    user = recorder.request('save user', client.post, '/api/user', {
+        'userId': auth_response['authenticatedUser']['userId'],
+        'profile': {
+            'email': email,
+            'city': {'name': 'Lyon', 'departementId': '69'},
+            'latestJob': {'jobGroup': {'romeId': 'D1102'}, 'codeOgr': '12006'},
+        },
+        'projects': [{
+            'targetJob': {'jobGroup': {'romeId': 'D1102'}, 'codeOgr': '12006'},
+            'mobility': {'city': {'cityId': '69123', 'departementId': '69'}},
+        }],
+    })
+    if not user or not user.get('projects'):
+        return
+    recorder.request('compute advices', client.post, '/api/project/compute-advices', user)
+    for resource in _PROJECT_RESOURCES:
+        recorder.request(
+            'get %s' % resource, client.get, '/api/project/%s/%s/%s' % (
+                user['userId'], user['projects'][0]['projectId'], resource))
+    salt_response = recorder.request('get salt', client.post, '/api/user/authenticate', {
+        'email': email,
+    })
+    if not salt_response:
+        return
+    recorder.request('log in', client.post, '/api/user/authenticate', {
+        'email': email,
+        'hashSalt': salt_response['hashSalt'],
+        'hashedPassword': _sha1(salt_response['hashSalt'], _sha1(email, 'psswd')),
+    })
+
+
+class _LockedMongo(object):
+    """A proxy to a mongomock object that serializes the calls with a lock.
+
+    The databases, collections and cursors it returns are proxied as well.
+    """
+
+    _PROXIED_TYPES = (mongomock.Database, mongomock.Collection, mongomock.collection.Cursor)
+
+    def __init__(self, wrapped, lock=None):
+        self._wrapped = wrapped
+        self._lock = lock or threading.RLock()
+
+    def _wrap(self, value):
+        if isinstance(value, self._PROXIED_TYPES):
+            return _LockedMongo(value, self._lock)
+        return value
+
+    def _call(self, func, *args, **kwargs):
+        with self._lock:
+            return self._wrap(func(*args, **kwargs))
+
+    def __getattr__(self, name):
+        value = self._call(getattr, self._wrapped, name)
+        if not callable(value) or isinstance(value, _LockedMongo):
+            return value
+        return functools.partial(self._call, value)
+
+    def __getitem__(self, key):
+        return self._call(self._wrapped.__getitem__, key)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._call(next, self._wrapped)
+
+
+def _percentile(sorted_values, percent):
+    index = max(0, math.ceil(len(sorted_values) * percent / 100) - 1)
+    return sorted_values[index]
+
+
+@contextlib.contextmanager
+def _setup_app(database):
+    """Set up the app to use a database, and restore it on exit."""
+    locked_database = _LockedMongo(database)
+    with mock.patch.dict(server.app.config, {'DATABASE': locked_database}), \
+            mock.patch(server.__name__ + '._DB', locked_database), \
+            mock.patch(server.advisor.__name__ + '._EMAIL_ACTIVATION_ENABLED', False), \
+            advice_benchmark.stub_external_apis():
+        server.clear_cache()
+        try:
+            yield
+        finally:
+            server.clear_cache()
+
+
+def load_test(database, num_sessions=20, concurrency=4):
+    """Load test the app.
+
+    Args:
+        database: the database to use for the app, modified by the test.
+        num_sessions: the number of user sessions to run.
+        concurrency: the number of sessions to run concurrently.
+    Returns:
+        a dict with the report for each endpoint, and the total for all of
+        them in the "total" key.
+    """
+    recorder = _Recorder()
+    allocations = _Recorder(trace_allocations=True)
+    with _setup_app(database):
+        start = timeit.default_timer()
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Consume the results to raise the exceptions of the sessions, if any.
+            list(executor.map(
+                lambda session_id: run_session(server.app.test_client(), session_id, recorder),
+                range(num_sessions)))
+        duration = timeit.default_timer() - start
+
+        tracemalloc.start()
+        try:
+            run_session(server.app.test_client(), 'allocations', allocations)
+        finally:
+            tracemalloc.stop()
+
+    report = {}
+    all_latencies = []
+    for name, latencies in recorder.latencies.items():
+        all_latencies.extend(latencies)
+        report[name] = _summarize(
+            latencies, recorder.errors[name], duration,
+            allocations.peak_bytes.get(name), allocations.retained_bytes.get(name))
+    report['total'] = _summarize(all_latencies, sum(recorder.errors.values()), duration)
+    return report
+
+
+def _summarize(latencies, num_errors, duration, peak_bytes=None, retained_bytes=None):
+    sorted_latencies = sorted(latencies)
+    summary = {
+        'requests': len(latencies),
+        'errors': num_errors,
+        'throughput': len(latencies) / duration,
+        'p50Ms': _percentile(sorted_latencies, 50) * 1000,
+        'p90Ms': _percentile(sorted_latencies, 90) * 1000,
+        'p99Ms': _percentile(sorted_latencies, 99) * 1000,
+        'maxMs': sorted_latencies[-1] * 1000,
+    }
+    if peak_bytes:
+        summary['peakBytes'] = sum(peak_bytes) / len(peak_bytes)
+        summary['retainedBytes'] = sum(retained_bytes) / len(retained_bytes)
+    return summary
+
+
+def _format_change(value, baseline_value):
+    if baseline_value is None:
+        return ''
+    if not baseline_value:
+        return ' (new)' if value else ''
+    return ' (%+.0f%%)' % ((value - baseline_value) / baseline_value * 100)
+
+
+def print_report(report, baseline=None):
+    """Print a report, with the changes from a baseline report if any."""
+    baseline = baseline or {}
+    names = sorted(report, key=lambda name: (name == 'total', name))
+    for name in names:
+        summary = report[name]
+        baseline_summary = baseline.get(name, {})
+        print('%-20s %5d requests %3d errors %8.1f req/s%s' % (
+            name, summary['requests'], summary['errors'], summary['throughput'],
+            _format_change(summary['throughput'], baseline_summary.get('throughput'))))
+        print('  latency p50 %.2fms%s, p90 %.2fms%s, p99 %.2fms%s, max %.2fms%s' % tuple(
+            value for key in ('p50Ms', 'p90Ms', 'p99Ms', 'maxMs')
+            for value in (summary[key], _format_change(summary[key], baseline_summary.get(key)))))
+        if 'peakBytes' in summary:
+            print('  allocations peak %.1fkB%s, retained %.1fkB%s' % (
+                summary['peakBytes'] / 1024,
+                _format_change(summary['peakBytes'], baseline_summary.get('peakBytes')),
+                summary['retainedBytes'] / 1024,
+                _format_change(summary['retainedBytes'], baseline_summary.get('retainedBytes'))))
+
+
+def main(num_sessions=20, concurrency=4, fixture_folder='', output_file='', baseline_file=''):
+    """Load test the app and print the report."""
+    if fixture_folder:
+        database = advice_benchmark.load_fixtures(fixture_folder)
+    else:
+        database = mongomock.MongoClient().get_database('load_test')
+    report = load_test(database, int(num_sessions), int(concurrency))
+    baseline = None
+    if baseline_file:
+        with open(baseline_file) as json_file:
+            baseline = json.load(json_file)
+    print_report(report, baseline)
+    if output_file:
+        with open(output_file, 'w') as json_file:
+            json.dump(report, json_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
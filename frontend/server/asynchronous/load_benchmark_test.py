@@ -0,0 +1,99 @@
+"""Tests for the load_benchmark module."""
+import json
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import server
+from bob_emploi.frontend.asynchronous import load_benchmark
+
+
+class LoadBenchmarkTestCase(unittest.TestCase):
+    """Unit tests for the load benchmark script."""
+
+    def setUp(self):
+        super(LoadBenchmarkTestCase, self).setUp()
+        self.database = mongomock.MongoClient().test
+        self.database.advice_modules.insert_one({
+            'adviceId': 'network',
+            'triggerScoringModel': 'constant(2)',
+            'isReadyForProd': True,
+        })
+
+    def test_load_test(self):
+        """Run concurrent sessions."""
+        report = load_benchmark.load_test(self.database, num_sessions=3, concurrency=2)
+
+        self.assertEqual(
+            ['compute advices', 'get associations', 'get commute', 'get events',
+             'get interview-tips', 'get jobboards', 'get resume-tips', 'get salt',
+             'get volunteer', 'log in', 'save user', 'sign up', 'total'],
+            sorted(report))
+        self.assertEqual(
+            {'errors': 0, 'requests': 36},
+            {k: v for k, v in report['total'].items() if k in ('errors', 'requests')})
+        self.assertEqual(3, report['sign up']['requests'])
+        self.assertLessEqual(report['save user']['p50Ms'], report['save user']['maxMs'])
+        self.assertGreater(report['compute advices']['peakBytes'], 0)
+        self.assertIn('retainedBytes', report['compute advices'])
+        self.assertNotIn('peakBytes', report['total'])
+        self.assertEqual(4, self.database.user.count())
+
+    def test_restore_app(self):
+        """Restore the database of the app after the test."""
+        # pylint: disable=protected-access
+        database = server._DB
+        config = dict(server.app.config)
+
+        load_benchmark.load_test(self.database, num_sessions=1, concurrency=1)
+
+        self.assertIs(database, server._DB)
+        self.assertEqual(config, server.app.config)
+
+    def test_locked_mongo(self):
+        """Proxy the databases, collections and cursors of mongomock."""
+        # pylint: disable=protected-access
+        locked = load_benchmark._LockedMongo(self.database)
+        locked['user'].insert_many([{'_id': 2, 'name': 'Pascal'}, {'_id': 1, 'name': 'Cyrille'}])
+
+        cursor = locked.get_collection('user').find({}, {'name': 1}).sort('_id')
+        self.assertIsInstance(cursor, load_benchmark._LockedMongo)
+        self.assertEqual(['Cyrille', 'Pascal'], [user['name'] for user in cursor])
+        self.assertEqual('test', locked.name)
+        self.assertEqual(2, self.database.user.count())
+
+    @mock.patch(load_benchmark.__name__ + '.print', create=True)
+    def test_main_with_baseline(self, mock_print):
+        """Save a report and compare with it."""
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        baseline_file = path.join(folder, 'baseline.json')
+        with open(baseline_file, 'w') as json_file:
+            json.dump({'total': {
+                'requests': 12, 'errors': 0, 'throughput': 1,
+                'p50Ms': 0, 'p90Ms': 1e6, 'p99Ms': 1e6, 'maxMs': 1e6,
+            }}, json_file)
+        report_file = path.join(folder, 'report.json')
+
+        load_benchmark.main('1', '1', '', report_file, baseline_file)
+
+        with open(report_file) as json_file:
+            report = json.load(json_file)
+        self.assertEqual(12, report['total']['requests'])
+
+        lines = [call[0][0] for call in mock_print.call_args_list]
+        self.assertTrue(lines[0].startswith('compute advices '), msg=lines)
+        self.assertIn('allocations peak ', lines[2])
+        total_index = next(i for i, line in enumerate(lines) if line.startswith('total '))
+        self.assertIn('req/s (+', lines[total_index])
+        self.assertIn('p90 ', lines[total_index + 1])
+        self.assertIn('(-', lines[total_index + 1])
+        self.assertIn('(new)', lines[total_index + 1])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
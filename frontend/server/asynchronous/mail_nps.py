@@ -23,6 +23,7 @@ import requests
 from google.protobuf import json_format
 
 from bob_emploi.frontend import mail
+from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import user_pb2
 
 # A Slack WebHook URL to send final reports to. Defined in the Incoming
@@ -128,14 +129,23 @@ def main(user_db, base_url, now, days_before_sending):
     """Send an email to users that signed up more than n days ago list of users."""
     query = {
         'featuresEnabled.netPromoterScoreEmail': 'NPS_EMAIL_PENDING',
-        'projects': {'$exists': True},
-        'projects.isIncomplete': {'$ne': True},
+        '$or': [
+            # Users stored as binary protos do not have their projects as JSON
+            # fields: they are filtered after being parsed.
+            {proto.BINARY_FIELD: {'$exists': True}},
+            {
+                'projects': {'$exists': True},
+                'projects.isIncomplete': {'$ne': True},
+            },
+        ],
     }
     count = 0
     user_iterator = user_db.find(
         query,
         {
             '_id': 1,
+            proto.BINARY_FIELD: 1,
+            proto.PARTIAL_FIELDS_FIELD: 1,
             'registeredAt': 1,
             'featuresEnabled.netPromoterScoreEmail': 1,
             'profile.email': 1,
@@ -148,11 +158,16 @@ def main(user_db, base_url, now, days_before_sending):
     for user_in_db in _break_on_signal([signal.SIGTERM], user_iterator):
         user = user_pb2.User()
         user_id = user_in_db.pop('_id')
-        json_format.ParseDict(user_in_db, user)
+        is_binary = proto.BINARY_FIELD in user_in_db
+        proto.parse_from_mongo(user_in_db, user)
         if user.features_enabled.net_promoter_score_email != user_pb2.NPS_EMAIL_PENDING:
             # Skip silently: NPS was sent already.
             continue
 
+        if is_binary and (not user.projects or any(p.is_incomplete for p in user.projects)):
+            # Skip silently: user has not finished onboarding.
+            continue
+
         if user.registered_at.ToDatetime() > registered_before:
             # Skip silently: will send another day.
             continue
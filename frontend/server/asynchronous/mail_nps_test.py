@@ -7,6 +7,9 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import auth
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
 from bob_emploi.frontend.asynchronous import mail_nps
 
 _USER_PENDING_NPS_DICT = {
@@ -106,6 +109,22 @@ class MailingTestCase(unittest.TestCase):
         mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
         self.assertFalse(mock_mail.send_template.called)
 
+    def test_binary_users(self, mock_mail):
+        """Select users stored as binary protos."""
+        mock_mail.send_template.return_value.status_code = 200
+        mock_mail.send_template_to_admins.return_value.status_code = 200
+        user = user_pb2.User()
+        proto.parse_from_mongo(dict(_USER_PENDING_NPS_DICT), user)
+        self._db.user.insert_one(proto.to_binary_document(user, auth.USER_INDEXED_FIELDS))
+        user.projects[0].is_incomplete = True
+        user.profile.email = 'incomplete@bayes.org'
+        self._db.user.insert_one(proto.to_binary_document(user, auth.USER_INDEXED_FIELDS))
+
+        mail_nps.main(self._db.user, 'http://localhost:3000', self._now, '1')
+
+        mock_mail.send_template.assert_called_once()
+        self.assertEqual('Pascal', mock_mail.send_template.call_args[0][1].name)
+
     def test_no_dupes(self, mock_mail):
         """Test that we do not send duplicate emails if we run the script twice."""
         mock_mail.send_template.return_value.status_code = 200
@@ -0,0 +1,89 @@
+"""Script to migrate the user documents from JSON to binary protos.
+
+It rewrites the users still stored as JSON documents in the format used by the
+server when STORE_USERS_AS_PROTOS is set. Users that are modified in any way
+while the script runs are skipped, so it can run in the background.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... -e NODRY_RUN=1 \
+    frontend-flask python bob_emploi/frontend/asynchronous/migrate_user_storage.py
+"""
+import copy
+import logging
+import os
+import sys
+
+import pymongo
+
+from bob_emploi.frontend import auth
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+# For a dry run we do not modify the database.
+DRY_RUN = not bool(os.getenv('NODRY_RUN'))
+
+
+def migrate_user(user_dict):
+    """Convert a user document from JSON to a binary proto document.
+
+    Returns: the new document, or None if the user could not be parsed.
+    """
+    user = user_pb2.User()
+    tags = {k: v for k, v in user_dict.items() if k.startswith('_')}
+    if not proto.parse_from_mongo(user_dict, user):
+        return None
+    document = proto.to_binary_document(user, auth.USER_INDEXED_FIELDS)
+    document.update(tags)
+    return document
+
+
+def _unmodified_user_filter(user_dict):
+    """Create a filter that only matches a user document if it was not modified.
+
+    Some updates do not bump the revision of the user (e.g. likes or NPS), so
+    the whole document is compared: all its fields must be unchanged, and the
+    user fields that it did not have must still be missing.
+    """
+    user_filter = dict(user_dict)
+    for field in user_pb2.User.DESCRIPTOR.fields:
+        if field.json_name not in user_dict:
+            user_filter[field.json_name] = {'$exists': False}
+    user_filter[proto.BINARY_FIELD] = {'$exists': False}
+    return user_filter
+
+
+def main(limit=0, database=None):
+    """Migrate the users that are still stored as JSON documents."""
+    if database is None:
+        database = _DB
+    count = 0
+    errors = 0
+    user_iterator = database.user.find({proto.BINARY_FIELD: {'$exists': False}})\
+        .limit(int(limit))
+    for user_dict in user_iterator:
+        user_id = user_dict['_id']
+        # migrate_user modifies the dict.
+        user_filter = _unmodified_user_filter(copy.deepcopy(user_dict))
+        document = migrate_user(user_dict)
+        if not document:
+            logging.warning('Could not parse user "%s"', user_id)
+            errors += 1
+            continue
+        if DRY_RUN:
+            count += 1
+            continue
+        # Do not overwrite the user if they were modified in the meantime.
+        result = database.user.replace_one(user_filter, document)
+        count += result.modified_count
+    logging.warning(
+        '%d users %s (%d errors).', count, 'to migrate' if DRY_RUN else 'migrated', errors)
+    return count
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,110 @@
+"""Tests for the migrate_user_storage module."""
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
+from bob_emploi.frontend.asynchronous import migrate_user_storage
+
+
+@mock.patch(migrate_user_storage.__name__ + '.DRY_RUN', new=False)
+class MigrateUserStorageTestCase(unittest.TestCase):
+    """Unit tests for the user storage migration script."""
+
+    def setUp(self):
+        super(MigrateUserStorageTestCase, self).setUp()
+        self._db = mongomock.MongoClient().test
+
+    def test_main(self):
+        """Migrate JSON users to binary protos."""
+        self._db.user.insert_many([
+            {
+                '_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000001'),
+                '_server': 'dev',
+                'profile': {'email': 'pascal@example.com', 'name': 'Pascal'},
+                'registeredAt': '2017-11-16T10:00:00Z',
+                'revision': 3,
+            },
+            {
+                '_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000002'),
+                'profile': {'email': 'cyrille@example.com', 'name': 'Cyrille'},
+            },
+        ])
+
+        self.assertEqual(2, migrate_user_storage.main(database=self._db))
+
+        user_in_db = self._db.user.find_one(
+            {'_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000001')})
+        self.assertEqual('dev', user_in_db['_server'])
+        self.assertEqual({'email': 'pascal@example.com'}, user_in_db['profile'])
+        self.assertEqual('2017-11-16T10:00:00Z', user_in_db['registeredAt'])
+        user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(user_in_db, user))
+        self.assertEqual('Pascal', user.profile.name)
+        self.assertEqual(3, user.revision)
+
+        self.assertEqual(
+            1, self._db.user.find({'profile.email': 'cyrille@example.com'}).count())
+
+        # Running it again does not change anything.
+        self.assertEqual(0, migrate_user_storage.main(database=self._db))
+
+    def test_concurrent_updates(self):
+        """Do not overwrite users that are updated in place while migrating."""
+        self._db.user.insert_many([
+            {
+                '_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000001'),
+                'profile': {'email': 'pascal@example.com'},
+                'likes': {'landing': 1},
+                'revision': 3,
+            },
+            {
+                '_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000002'),
+                'profile': {'email': 'cyrille@example.com'},
+                'revision': 3,
+            },
+            {
+                '_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000003'),
+                'profile': {'email': 'emilie@example.com'},
+                'revision': 3,
+            },
+        ])
+        migrate_user = migrate_user_storage.migrate_user
+
+        def _update_then_migrate(user_dict):
+            # Updates that do not bump the revision: changing a field or
+            # adding a new one.
+            self._db.user.update_one(
+                {'_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000001')},
+                {'$set': {'likes.landing': -1}})
+            self._db.user.update_one(
+                {'_id': mongomock.ObjectId('5a0c4f3e3cfc0a2a5e000002')},
+                {'$set': {'netPromoterScoreSurveyResponse': {'score': 10}}})
+            return migrate_user(user_dict)
+
+        with mock.patch(
+                migrate_user_storage.__name__ + '.migrate_user', new=_update_then_migrate):
+            self.assertEqual(1, migrate_user_storage.main(database=self._db))
+
+        pascal = self._db.user.find_one({'profile.email': 'pascal@example.com'})
+        self.assertEqual({'landing': -1}, pascal['likes'])
+        self.assertNotIn('_proto', pascal)
+        cyrille = self._db.user.find_one({'profile.email': 'cyrille@example.com'})
+        self.assertEqual({'score': 10}, cyrille['netPromoterScoreSurveyResponse'])
+        self.assertNotIn('_proto', cyrille)
+        self.assertIn('_proto', self._db.user.find_one({'profile.email': 'emilie@example.com'}))
+
+    def test_dry_run(self):
+        """Do not modify the database in dry run mode."""
+        self._db.user.insert_one({'profile': {'email': 'pascal@example.com'}})
+
+        with mock.patch(migrate_user_storage.__name__ + '.DRY_RUN', new=True):
+            self.assertEqual(1, migrate_user_storage.main(database=self._db))
+
+        self.assertNotIn('_proto', self._db.user.find_one())
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
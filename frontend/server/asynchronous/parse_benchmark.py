@@ -0,0 +1,69 @@
+"""Script to benchmark the parsing of user documents from MongoDB.
+
+It compares the fast path of proto.parse_from_mongo with the generic
+json_format path on a sample of the user collection.
+
+Usage:
+
+docker-compose run --rm \
+    -e MONGO_URL ... \
+    frontend-flask-test python bob_emploi/frontend/asynchronous/parse_benchmark.py 1000
+"""
+import copy
+import os
+import sys
+import timeit
+
+import pymongo
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import user_pb2
+
+_DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
+    .get_default_database()
+
+
+def _parse_all(parse, user_dicts):
+    for user_dict in user_dicts:
+        user = user_pb2.User()
+        parse(user_dict, user)
+
+
+def benchmark_users(user_dicts, repeat=3):
+    """Time the parsing paths on a list of user documents.
+
+    Args:
+        user_dicts: a list of dicts from the user collection.
+        repeat: the number of times to parse all the users.
+    Returns:
+        a list of tuples with the name of the parsing path and its best time.
+    """
+    paths = [
+        ('json_format', proto._parse_with_json_format),  # pylint: disable=protected-access
+        ('fast', proto.parse_from_mongo),
+    ]
+    results = []
+    for name, parse in paths:
+        times = []
+        for unused_index in range(repeat):
+            # Both paths may modify the dicts, so each run parses fresh copies.
+            copies = copy.deepcopy(user_dicts)
+            start = timeit.default_timer()
+            _parse_all(parse, copies)
+            times.append(timeit.default_timer() - start)
+        results.append((name, min(times)))
+    return results
+
+
+def main(num_users=1000, database=None):
+    """Benchmark the parsing of a sample of users."""
+    if database is None:
+        database = _DB
+    user_dicts = list(database.user.find({}, {'_id': 0}).limit(int(num_users)))
+    print('%d users' % len(user_dicts))
+    for name, parse_time in benchmark_users(user_dicts):
+        print('  %-12s %8.2fms' % (name, parse_time * 1000))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,36 @@
+"""Tests for the parse_benchmark module."""
+import datetime
+import unittest
+
+import mock
+import mongomock
+
+from bob_emploi.frontend.asynchronous import parse_benchmark
+
+
+class ParseBenchmarkTestCase(unittest.TestCase):
+    """Unit tests for the parse benchmark script."""
+
+    @mock.patch(parse_benchmark.__name__ + '.print', create=True)
+    def test_main(self, mock_print):
+        """Benchmark both parsing paths."""
+        database = mongomock.MongoClient().test
+        database.user.insert_many([
+            {
+                'registeredAt': datetime.datetime(2017, 11, 16),
+                'profile': {'name': 'Pascal', 'gender': 'MASCULINE'},
+                'projects': [{'projectId': '0'}],
+            },
+            {'profile': {'name': 'Cyrille'}},
+        ])
+
+        parse_benchmark.main('2', database=database)
+
+        lines = [call[0][0] for call in mock_print.call_args_list]
+        self.assertEqual('2 users', lines[0])
+        self.assertIn('json_format', lines[1])
+        self.assertIn('fast', lines[2])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -43,6 +43,13 @@ SECRET_SALT = os.getenv(
 # Validity of generated salt tokens.
 _SALT_VALIDITY_SECONDS = datetime.timedelta(hours=2).total_seconds()
 
+# Fields of the user documents that are indexed and used in queries, e.g. to
+# authenticate users, to select them in the asynchronous scripts or to guard
+# concurrent updates. They are kept as JSON fields when users are stored as
+# binary protos.
+USER_INDEXED_FIELDS = (
+    'facebook_id', 'features_enabled', 'google_id', 'profile.email', 'registered_at', 'revision')
+
 
 def decode_google_id_token(token_id):
     """Decode a token generated by Google sign-in client-side,
@@ -258,18 +265,18 @@ class Authenticator(object):
         auth_token = _timestamped_hash(
             int(time.time()), email + str(user_dict['_id']) + hashed_old_password)
 
-        user_profile = user_pb2.UserProfile()
-        proto.parse_from_mongo(user_dict.get('profile'), user_profile)
+        user_proto = user_pb2.User()
+        proto.parse_from_mongo(user_dict, user_proto)
 
         reset_link = parse.urljoin(flask.request.url, '/?' + parse.urlencode({
             'email': email,
             'resetToken': auth_token}))
         template_vars = {
             'resetLink': reset_link,
-            'firstName': user_profile.name,
+            'firstName': user_proto.profile.name,
         }
         result = mail.send_template(
-            '71254', user_profile, template_vars, monitoring_category='reset_password')
+            '71254', user_proto.profile, template_vars, monitoring_category='reset_password')
         if result.status_code != 200:
             logging.error('Failed to send an email with MailJet:\n %s', result.text)
             flask.abort(result.status_code)
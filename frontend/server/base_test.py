@@ -7,6 +7,8 @@ import unittest
 import mock
 import mongomock
 
+from bob_emploi.frontend import monitoring
+from bob_emploi.frontend import resources
 from bob_emploi.frontend import server
 
 
@@ -85,12 +87,16 @@ class ServerTestCase(unittest.TestCase):
                 },
             },
         ])
-        self._logging = mock.patch(server.__name__ + '.logging', spec=True)
-        self._logging.start()
+        self._logging = [
+            mock.patch(module.__name__ + '.logging', spec=True)
+            for module in (monitoring, resources, server)]
+        for patcher in self._logging:
+            patcher.start()
 
     def tearDown(self):
         super(ServerTestCase, self).tearDown()
-        self._logging.stop()
+        for patcher in self._logging:
+            patcher.stop()
 
     def authenticate_new_user(
             self, email='foo@bar.fr', first_name='Henry', last_name='Dupont', password='psswd'):
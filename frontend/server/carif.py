@@ -1,84 +1,308 @@
 """Module to get information on companies."""
+from concurrent import futures
+import datetime
 import logging
+import os
+import threading
+from xml.etree import ElementTree
+
 import requests
-import xmltodict
 
+from google.protobuf import json_format
+
+from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import training_pb2
 
 _CARIF_URL = 'http://www.intercariforef.org/serviceweb2/offre-info/?versionLHEO=2.2&typeListe=max'
 
+# Maximum number of seconds to wait for the CARIF API.
+_CARIF_TIMEOUT = float(os.getenv('CARIF_TIMEOUT_SECONDS', '3'))
+
+# Maximum number of trainings to keep for a job group and a département.
+_MAX_TRAININGS = int(os.getenv('CARIF_MAX_TRAININGS', '50'))
+
+# Size in bytes of the chunks of the CARIF API responses to parse at once.
+_CHUNK_SIZE = 16 * 1024
+
+# Duration after which trainings fetched from the CARIF API are refreshed.
+# Until the refresh is done, the stale ones are still served. Note that the
+# trainings persisted in MongoDB are dropped after a longer duration, see the
+# TTL index on carif_trainings._fetchedAt in db/create_index.js.
+_FRESH_DURATION = datetime.timedelta(days=1)
+
+# Threads used to refresh stale trainings in the background.
+_REFRESH_EXECUTOR = futures.ThreadPoolExecutor(max_workers=2)
+
 
 def _make_key(title, city):
     """Create a unique key for a training."""
     return title + city
 
 
-def get_trainings(rome_id, departement_id):
+class _TrainingsCache(object):
+    """A cache of the trainings by job group and département.
+
+    The trainings are kept in memory and persisted in a MongoDB collection so
+    that they survive a restart of the server. Once stale, they are still
+    served while being refreshed in the background.
+    """
+
+    def __init__(self, collection_name):
+        self._collection_name = collection_name
+        self._lock = threading.Lock()
+        self._database = None
+        # Trainings and the time at which they were fetched, keyed by
+        # "rome_id:departement_id".
+        self._trainings = {}
+        self._refreshing = set()
+
+    def get_trainings(self, database, rome_id, departement_id):
+        """Get the trainings, either from the cache or from the CARIF API."""
+        key = '%s:%s' % (rome_id, departement_id)
+        with self._lock:
+            if database is not self._database:
+                self._database = database
+                self._trainings = {}
+                self._refreshing = set()
+            cached = self._trainings.get(key)
+
+        if cached is None:
+            cached = self._load(database, key)
+
+        if cached is None:
+            trainings = _fetch_trainings(rome_id, departement_id)
+            if trainings is None:
+                return []
+            self._store(database, key, trainings)
+            return trainings
+
+        trainings, fetched_at = cached
+        if datetime.datetime.utcnow() - fetched_at >= _FRESH_DURATION:
+            self._refresh_in_background(database, key, rome_id, departement_id)
+        return trainings
+
+    def _load(self, database, key):
+        trainings_dict = database.get_collection(self._collection_name).find_one({'_id': key})
+        if not trainings_dict:
+            return None
+        fetched_at = trainings_dict.get('_fetchedAt')
+        trainings = training_pb2.Trainings()
+        if not fetched_at or not proto.parse_from_mongo(trainings_dict, trainings):
+            return None
+        cached = (list(trainings.trainings), fetched_at)
+        with self._lock:
+            self._trainings.setdefault(key, cached)
+        return cached
+
+    def _store(self, database, key, trainings):
+        fetched_at = datetime.datetime.utcnow()
+        trainings_dict = json_format.MessageToDict(training_pb2.Trainings(trainings=trainings))
+        trainings_dict['_fetchedAt'] = fetched_at
+        database.get_collection(self._collection_name).replace_one(
+            {'_id': key}, trainings_dict, upsert=True)
+        with self._lock:
+            if database is self._database:
+                self._trainings[key] = (trainings, fetched_at)
+
+    def _refresh_in_background(self, database, key, rome_id, departement_id):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        _REFRESH_EXECUTOR.submit(self._refresh, database, key, rome_id, departement_id)
+
+    def _refresh(self, database, key, rome_id, departement_id):
+        try:
+            trainings = _fetch_trainings(rome_id, departement_id)
+            if trainings is not None:
+                self._store(database, key, trainings)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Could not refresh the trainings for %s', key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def reset_cache(self):
+        """Drop the trainings kept in memory."""
+        with self._lock:
+            self._database = None
+            self._trainings = {}
+            self._refreshing = set()
+
+
+_TRAININGS = _TrainingsCache('carif_trainings')
+
+
+def get_trainings(rome_id, departement_id, database=None):
     """Helper function to get trainings from the CARIF API.
 
     Carif sends us multiple trainings that have the same city and title, this function only return
     one training per city/title.
+
+    Args:
+        rome_id: the ID of the job group to find trainings for.
+        departement_id: the ID of the département in which to find trainings.
+        database: a MongoDB database to cache the trainings into. If None,
+            the CARIF API is called every time.
+    Returns:
+        a list of Training protos.
     """
-    no_trainings = []
+    if database is not None:
+        return _TRAININGS.get_trainings(database, rome_id, departement_id)
+    trainings = _fetch_trainings(rome_id, departement_id)
+    if trainings is None:
+        return []
+    return trainings
+
+
+def clear_cache():
+    """Clear the in-memory cache of trainings."""
+    _TRAININGS.reset_cache()
 
+
+def _fetch_trainings(rome_id, departement_id):
+    """Fetch trainings from the CARIF API.
+
+    Returns:
+        a list of Training protos, or None if the API could not be reached.
+    """
     try:
         xml = requests.get(
-            _CARIF_URL, params={'idsMetiers': rome_id, 'code-departement': departement_id})
-    except requests.exceptions.ConnectionError as error:
+            _CARIF_URL, params={'idsMetiers': rome_id, 'code-departement': departement_id},
+            timeout=_CARIF_TIMEOUT, stream=True)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
         logging.warning('XML request for intercarif failed:\n%s', error)
-        return no_trainings
+        return None
 
-    trainings = []
-
-    if xml.status_code != 200:
-        logging.warning('XML request for intercarif failed with error code %d', xml.status_code)
-        return no_trainings
+    try:
+        if xml.status_code != 200:
+            logging.warning(
+                'XML request for intercarif failed with error code %d', xml.status_code)
+            return None
 
-    if not xml.text:
+        chunks = _check_not_empty(xml.iter_content(chunk_size=_CHUNK_SIZE))
+        return list(iterate_trainings(chunks))
+    except _EmptyResponseError:
         logging.warning('XML request for intercarif failed, there is no text in the response.')
-        return no_trainings
+        return None
+    except (requests.exceptions.RequestException, ElementTree.ParseError) as error:
+        logging.warning('XML response from intercarif could not be read:\n%s', error)
+        return None
+    finally:
+        xml.close()
 
-    # Intercarif does not provide an encoding in the response header which misleads the xmltodict
-    # module.
-    xml.encoding = 'utf-8'
 
-    info = xmltodict.parse(xml.text)
+class _EmptyResponseError(ValueError):
+    pass
 
-    offers = []
-    try:
-        offers = info['lheo-index']['resumes-offres']['resume-offre']
-    except KeyError:
-        return no_trainings
 
-    # Since our goal is not to give a super tool to find all the precise training and their
-    # differences, we just show one, and dedup them on a key composed of city and name.
-    trainings_keys = set()
+def _check_not_empty(chunks):
+    is_empty = True
+    for chunk in chunks:
+        if chunk:
+            is_empty = False
+            yield chunk
+    if is_empty:
+        raise _EmptyResponseError()
 
-    for offer in offers:
-        try:
-            formacodes = offer['domaine-formation']['code-FORMACODE']
-            if not isinstance(formacodes, list):
-                formacodes = [formacodes]
 
-            name = offer['intitule-formation'].replace('\n', ' ')
-            city_name = offer['ville']
-            url = offer['@href']
+def _local_name(tag):
+    """Strip the namespace of an XML tag, e.g. "{http://www.lheo.org/2.2}ville" -> "ville"."""
+    return tag.rsplit('}', 1)[-1]
+
 
-            key = _make_key(name, city_name)
-            if key in trainings_keys:
+def _iterate_offers(chunks):
+    """Parse incrementally a LHEO XML document and yield the offers.
+
+    Each "resume-offre" element is yielded as soon as it has been fully
+    parsed and then dropped, so that the whole document is never held in
+    memory.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    offers_parent = None
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, element in parser.read_events():
+            tag = _local_name(element.tag)
+            if event == 'start':
+                if tag == 'resumes-offres':
+                    offers_parent = element
                 continue
+            if tag != 'resume-offre':
+                continue
+            yield element
+            if offers_parent is not None:
+                offers_parent.remove(element)
+            else:
+                element.clear()
+    parser.close()
+
+
+def _find_child_texts(element, tag):
+    texts = [
+        child.text.strip() for child in element
+        if _local_name(child.tag) == tag and child.text and child.text.strip()]
+    if not texts:
+        raise KeyError(tag)
+    return texts
+
+
+def _offer_to_training(offer):
+    """Convert a "resume-offre" element to a Training proto.
 
-            training = training_pb2.Training(
-                name=name,
-                city_name=city_name,
-                url=url,
-                formacodes=formacodes)
+    Raises:
+        KeyError if an important field is missing.
+    """
+    domain = next((c for c in offer if _local_name(c.tag) == 'domaine-formation'), None)
+    if domain is None:
+        raise KeyError('domaine-formation')
+    url = offer.get('href')
+    if url is None:
+        raise KeyError('@href')
+    return training_pb2.Training(
+        name=_find_child_texts(offer, 'intitule-formation')[0].replace('\n', ' '),
+        city_name=_find_child_texts(offer, 'ville')[0],
+        url=url,
+        formacodes=_find_child_texts(domain, 'code-FORMACODE'))
+
+
+def iterate_trainings(chunks, max_trainings=None):
+    """Parse incrementally a LHEO XML document from the CARIF API.
+
+    Carif sends us multiple trainings that have the same city and title, this function only yields
+    one training per city/title.
+
+    Args:
+        chunks: an iterable of bytes of the XML document.
+        max_trainings: the maximum number of trainings to yield, by default
+            _MAX_TRAININGS. The rest of the document is not parsed.
+    Yields:
+        Training protos as soon as they are parsed.
+    """
+    if max_trainings is None:
+        max_trainings = _MAX_TRAININGS
 
-            trainings_keys.add(key)
-            trainings.append(training)
-        except KeyError:
+    # Since our goal is not to give a super tool to find all the precise training and their
+    # differences, we just show one, and dedup them on a key composed of city and name.
+    trainings_keys = set()
+
+    if not max_trainings:
+        return
+    for offer in _iterate_offers(chunks):
+        try:
+            training = _offer_to_training(offer)
+        except KeyError as error:
             # If an important field is missing, we skip this training.
-            logging.info('Skipping the offer from CARIF, an important field is missing: %s', offer)
+            logging.info(
+                'Skipping the offer "%s" from CARIF, an important field is missing: %s',
+                offer.get('numero'), error)
             continue
 
-    return trainings
+        key = _make_key(training.name, training.city_name)
+        if key in trainings_keys:
+            continue
+        trainings_keys.add(key)
+
+        yield training
+        if len(trainings_keys) >= max_trainings:
+            return
@@ -2,7 +2,11 @@
 from os import path
 import unittest
 
+import datetime
+
 import mock
+import mongomock
+import requests
 
 from bob_emploi.frontend import carif
 
@@ -12,13 +16,13 @@ class CarifTestCase(unittest.TestCase):
 
     @classmethod
     def setUpClass(cls):
-        with open(path.join(path.dirname(__file__), 'testdata/carif.xml')) as carif_file:
+        with open(path.join(path.dirname(__file__), 'testdata/carif.xml'), 'rb') as carif_file:
             cls._carif_xml_response = carif_file.read()
 
     @mock.patch('requests.get')
     def test_get_trainings(self, mock_get):
         """Basic usage of get_trainings."""
-        mock_get().text = self._carif_xml_response
+        mock_get().iter_content.return_value = [self._carif_xml_response]
         mock_get().status_code = 200
         mock_get.reset_mock()
 
@@ -28,7 +32,7 @@ class CarifTestCase(unittest.TestCase):
         args, kwargs = mock_get.call_args
         self.assertEqual(1, len(args))
         self.assertRegex(args[0], r'^http://www.intercariforef.org/')
-        self.assertEqual({'params'}, set(kwargs))
+        self.assertEqual({'params', 'stream', 'timeout'}, set(kwargs))
         self.assertEqual(
             {'idsMetiers': 'G1201', 'code-departement': '75'},
             kwargs['params'])
@@ -60,7 +64,7 @@ class CarifTestCase(unittest.TestCase):
     @mock.patch('requests.get')
     def test_error_code(self, mock_get):
         """Error 500 on InterCarif."""
-        mock_get().text = self._carif_xml_response
+        mock_get().iter_content.return_value = [self._carif_xml_response]
         mock_get().status_code = 500
         mock_get.reset_mock()
 
@@ -71,7 +75,7 @@ class CarifTestCase(unittest.TestCase):
     @mock.patch('requests.get')
     def test_empty_response(self, mock_get):
         """Missing text when calling InterCarif."""
-        mock_get().text = ''
+        mock_get().iter_content.return_value = [b'']
         mock_get().status_code = 200
         mock_get.reset_mock()
 
@@ -79,6 +83,173 @@ class CarifTestCase(unittest.TestCase):
 
         self.assertEqual([], trainings)
 
+    @mock.patch('requests.get')
+    def test_invalid_xml(self, mock_get):
+        """InterCarif sends an invalid XML response."""
+        mock_get().iter_content.return_value = [b'<lheo-index><resumes-offres>']
+        mock_get().status_code = 200
+        mock_get.reset_mock()
+
+        trainings = carif.get_trainings('G1201', '75')
+
+        self.assertEqual([], trainings)
+        mock_get().close.assert_called_once_with()
+
+    def test_iterate_trainings_small_chunks(self):
+        """Parse a response that arrives in small chunks."""
+        chunks = [
+            self._carif_xml_response[index:index + 100]
+            for index in range(0, len(self._carif_xml_response), 100)]
+
+        trainings = list(carif.iterate_trainings(iter(chunks)))
+
+        self.assertEqual(9, len(trainings))
+        self.assertEqual('Paris 17e Arrondissement', trainings[7].city_name)
+
+    def test_iterate_trainings_max(self):
+        """Stop parsing once enough trainings were found."""
+        def _chunks():
+            yield self._carif_xml_response
+            self.fail('The parser should not read more data.')
+
+        trainings = list(carif.iterate_trainings(_chunks(), max_trainings=2))
+
+        self.assertEqual(
+            [
+                "Titre professionnel d'accompagnateur(trice) de tourisme",
+                'Licence arts, lettres, langues mention langues, littérature et '
+                'civilisations étrangères et régionales',
+            ],
+            [t.name for t in trainings])
+
+    @mock.patch(carif.__name__ + '._MAX_TRAININGS', 0)
+    def test_iterate_trainings_no_max(self):
+        """Do not parse anything if no trainings are needed."""
+        self.assertEqual([], list(carif.iterate_trainings(iter([b'not XML']))))
+
+    def test_iterate_trainings_without_namespace(self):
+        """Parse trainings from a document without LHEO namespace."""
+        chunks = [
+            b'<lheo-index><resumes-offres><resume-offre numero="1" href="http://example.com">',
+            b'<domaine-formation><code-FORMACODE>42602</code-FORMACODE></domaine-formation>',
+            b'<intitule-formation>\nLicence pro\nguide\n</intitule-formation>',
+            b'<ville>Lyon</ville></resume-offre></resumes-offres></lheo-index>',
+        ]
+
+        trainings = list(carif.iterate_trainings(chunks))
+
+        self.assertEqual(['Licence pro guide'], [t.name for t in trainings])
+        self.assertEqual(['42602'], trainings[0].formacodes)
+
+    @mock.patch('requests.get')
+    def test_timeout(self, mock_get):
+        """InterCarif takes too long to answer."""
+        mock_get.side_effect = requests.exceptions.ReadTimeout('Too slow')
+
+        trainings = carif.get_trainings('G1201', '75')
+
+        self.assertEqual([], trainings)
+
+
+@mock.patch('requests.get')
+class CarifCacheTestCase(unittest.TestCase):
+    """Unit tests for the cache of trainings."""
+
+    @classmethod
+    def setUpClass(cls):
+        with open(path.join(path.dirname(__file__), 'testdata/carif.xml'), 'rb') as carif_file:
+            cls._carif_xml_response = carif_file.read()
+
+    def setUp(self):
+        super(CarifCacheTestCase, self).setUp()
+        self.database = mongomock.MongoClient().test
+        carif.clear_cache()
+
+    def _mock_response(self, mock_get, status_code=200):
+        mock_get().iter_content.return_value = [self._carif_xml_response]
+        mock_get().status_code = status_code
+        mock_get.reset_mock()
+
+    def test_cache(self, mock_get):
+        """Call the CARIF API only once per job group and département."""
+        self._mock_response(mock_get)
+
+        trainings = carif.get_trainings('G1201', '75', self.database)
+        self.assertEqual(9, len(trainings))
+        self.assertEqual(trainings, carif.get_trainings('G1201', '75', self.database))
+        mock_get.assert_called_once()
+
+        carif.get_trainings('G1201', '69', self.database)
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_persisted(self, mock_get):
+        """Trainings are persisted in MongoDB."""
+        self._mock_response(mock_get)
+        trainings = carif.get_trainings('G1201', '75', self.database)
+
+        carif.clear_cache()
+
+        self.assertEqual(trainings, carif.get_trainings('G1201', '75', self.database))
+        mock_get.assert_called_once()
+        self.assertEqual(['G1201:75'], [t['_id'] for t in self.database.carif_trainings.find()])
+
+    @mock.patch(carif.__name__ + '._REFRESH_EXECUTOR')
+    def test_stale(self, mock_executor, mock_get):
+        """Serve stale trainings while refreshing them in the background."""
+        self._mock_response(mock_get)
+        self.database.carif_trainings.insert_one({
+            '_id': 'G1201:75',
+            '_fetchedAt': datetime.datetime.utcnow() - datetime.timedelta(days=3),
+            'trainings': [{'name': 'Old training'}],
+        })
+
+        trainings = carif.get_trainings('G1201', '75', self.database)
+
+        self.assertEqual(['Old training'], [t.name for t in trainings])
+        mock_get.assert_not_called()
+        mock_executor.submit.assert_called_once()
+
+        # Run the background refresh.
+        func, *args = mock_executor.submit.call_args[0]
+        func(*args)
+
+        mock_get.assert_called_once()
+        self.assertEqual(9, len(carif.get_trainings('G1201', '75', self.database)))
+        self.assertEqual(
+            9, len(self.database.carif_trainings.find_one({'_id': 'G1201:75'})['trainings']))
+
+    @mock.patch(carif.__name__ + '._REFRESH_EXECUTOR')
+    def test_refresh_once(self, mock_executor, mock_get):
+        """Only refresh stale trainings once at a time."""
+        self._mock_response(mock_get, status_code=500)
+        self.database.carif_trainings.insert_one({
+            '_id': 'G1201:75',
+            '_fetchedAt': datetime.datetime.utcnow() - datetime.timedelta(days=3),
+            'trainings': [{'name': 'Old training'}],
+        })
+
+        carif.get_trainings('G1201', '75', self.database)
+        carif.get_trainings('G1201', '75', self.database)
+        mock_executor.submit.assert_called_once()
+
+        # The refresh fails, the stale trainings are kept.
+        func, *args = mock_executor.submit.call_args[0]
+        func(*args)
+        trainings = carif.get_trainings('G1201', '75', self.database)
+
+        self.assertEqual(['Old training'], [t.name for t in trainings])
+        self.assertEqual(2, mock_executor.submit.call_count)
+
+    def test_error_not_cached(self, mock_get):
+        """Errors from the CARIF API are not cached."""
+        self._mock_response(mock_get, status_code=500)
+
+        self.assertEqual([], carif.get_trainings('G1201', '75', self.database))
+        self.assertEqual([], carif.get_trainings('G1201', '75', self.database))
+
+        self.assertEqual(2, mock_get.call_count)
+        self.assertFalse(self.database.carif_trainings.find_one())
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -1,6 +1,9 @@
 """Module to get inforomation on companies."""
+import collections
+import datetime
 import logging
 import os
+import threading
 
 import emploi_store
 
@@ -9,27 +12,85 @@ from bob_emploi.frontend.api import company_pb2
 _EMPLOI_STORE_DEV_CLIENT_ID = os.getenv('EMPLOI_STORE_CLIENT_ID')
 _EMPLOI_STORE_DEV_SECRET = os.getenv('EMPLOI_STORE_CLIENT_SECRET')
 
+# Duration during which companies fetched from LBB are reused.
+_CACHE_DURATION = datetime.timedelta(minutes=5)
+
+# Maximum number of (city, job group) pairs for which companies are cached.
+_CACHE_MAX_SIZE = 1000
+
+# A client shared by all the calls so that its access tokens are reused.
+_CLIENT = None
+_LOCK = threading.Lock()
+
+# Lists of companies and their expiry time, keyed by (city_id, rome_id).
+_LBB_COMPANIES = collections.OrderedDict()
+
+
+def _get_client():
+    global _CLIENT  # pylint: disable=global-statement
+    with _LOCK:
+        if _CLIENT is None:
+            _CLIENT = emploi_store.Client(
+                client_id=_EMPLOI_STORE_DEV_CLIENT_ID,
+                client_secret=_EMPLOI_STORE_DEV_SECRET)
+        return _CLIENT
+
+
+def _get_cached_companies(key, now):
+    with _LOCK:
+        cached = _LBB_COMPANIES.get(key)
+        if cached is None:
+            return None
+        companies, valid_until = cached
+        if valid_until < now:
+            del _LBB_COMPANIES[key]
+            return None
+        return companies
+
+
+def _cache_companies(key, companies, now):
+    with _LOCK:
+        _LBB_COMPANIES[key] = (companies, now + _CACHE_DURATION)
+        _LBB_COMPANIES.move_to_end(key)
+        while len(_LBB_COMPANIES) > _CACHE_MAX_SIZE:
+            _LBB_COMPANIES.popitem(last=False)
+
+
+def clear_cache():
+    """Clear the cached companies and the shared LBB client."""
+    global _CLIENT  # pylint: disable=global-statement
+    with _LOCK:
+        _CLIENT = None
+        _LBB_COMPANIES.clear()
+
 
 def get_lbb_companies(project):
-    """Retrieve a list of companies from LaBonneBoite API."""
+    """Retrieve a list of companies from LaBonneBoite API.
+
+    The companies are cached for a few minutes by city and job group, so that
+    several calls for the same project only cost one call to the API.
+    """
     if not _EMPLOI_STORE_DEV_CLIENT_ID or not _EMPLOI_STORE_DEV_SECRET:
         logging.warning('Missing Emploi Store Dev identifiers.')
         return
 
-    client = emploi_store.Client(
-        client_id=_EMPLOI_STORE_DEV_CLIENT_ID,
-        client_secret=_EMPLOI_STORE_DEV_SECRET)
-    try:
-        companies = client.get_lbb_companies(
-            city_id=project.mobility.city.city_id,
-            rome_codes=[project.target_job.job_group.rome_id])
-        for company in companies:
-            yield company
-    except (IOError, ValueError) as error:
-        logging.error(
-            'Error while calling LBB API: %s\nCity: %s\nJob group: %s',
-            error, project.mobility.city.city_id, project.target_job.job_group)
-        return
+    city_id = project.mobility.city.city_id
+    rome_id = project.target_job.job_group.rome_id
+    now = datetime.datetime.now()
+    companies = _get_cached_companies((city_id, rome_id), now)
+    if companies is None:
+        try:
+            companies = list(_get_client().get_lbb_companies(
+                city_id=city_id, rome_codes=[rome_id]))
+        except (IOError, ValueError) as error:
+            logging.error(
+                'Error while calling LBB API: %s\nCity: %s\nJob group: %s',
+                error, city_id, project.target_job.job_group)
+            return
+        _cache_companies((city_id, rome_id), companies, now)
+
+    for company in companies:
+        yield company
 
 
 def to_proto(company_json):
@@ -0,0 +1,108 @@
+"""Tests for the bob_emploi.frontend.companies module."""
+import datetime
+import unittest
+
+import mock
+
+from bob_emploi.frontend import companies
+from bob_emploi.frontend.api import project_pb2
+
+
+@mock.patch(companies.__name__ + '._EMPLOI_STORE_DEV_CLIENT_ID', 'my-client-id')
+@mock.patch(companies.__name__ + '._EMPLOI_STORE_DEV_SECRET', 'my-secret')
+@mock.patch(companies.emploi_store.__name__ + '.Client')
+class LbbCompaniesTestCase(unittest.TestCase):
+    """Unit tests for the get_lbb_companies function."""
+
+    def setUp(self):
+        super(LbbCompaniesTestCase, self).setUp()
+        companies.clear_cache()
+        self.project = project_pb2.Project()
+        self.project.mobility.city.city_id = '69123'
+        self.project.target_job.job_group.rome_id = 'A1234'
+
+    def test_basic(self, mock_client):
+        """Basic usage."""
+        mock_client.return_value.get_lbb_companies.return_value = iter([{'name': 'Carrefour'}])
+
+        self.assertEqual(
+            [{'name': 'Carrefour'}], list(companies.get_lbb_companies(self.project)))
+
+        mock_client.assert_called_once_with(client_id='my-client-id', client_secret='my-secret')
+        mock_client.return_value.get_lbb_companies.assert_called_once_with(
+            city_id='69123', rome_codes=['A1234'])
+
+    def test_cache(self, mock_client):
+        """Several calls for the same project only call the API once."""
+        mock_client.return_value.get_lbb_companies.return_value = iter([
+            {'name': 'Carrefour'}, {'name': 'Auchan'}])
+
+        first_companies = companies.get_lbb_companies(self.project)
+        self.assertEqual({'name': 'Carrefour'}, next(first_companies))
+        self.assertEqual(
+            [{'name': 'Carrefour'}, {'name': 'Auchan'}],
+            list(companies.get_lbb_companies(self.project)))
+
+        mock_client.assert_called_once()
+        mock_client.return_value.get_lbb_companies.assert_called_once()
+
+        mock_client.return_value.get_lbb_companies.return_value = iter([{'name': 'Lidl'}])
+        self.project.mobility.city.city_id = '31555'
+        self.assertEqual([{'name': 'Lidl'}], list(companies.get_lbb_companies(self.project)))
+        mock_client.assert_called_once()
+
+    @mock.patch(companies.__name__ + '.datetime')
+    def test_cache_expires(self, mock_datetime, mock_client):
+        """Cached companies expire after a few minutes."""
+        mock_datetime.datetime.now.return_value = datetime.datetime(2017, 9, 1, 12, 0)
+        mock_datetime.timedelta = datetime.timedelta
+        mock_client.return_value.get_lbb_companies.return_value = iter([{'name': 'Carrefour'}])
+        list(companies.get_lbb_companies(self.project))
+
+        mock_datetime.datetime.now.return_value = datetime.datetime(2017, 9, 1, 13, 0)
+        mock_client.return_value.get_lbb_companies.return_value = iter([{'name': 'Auchan'}])
+
+        self.assertEqual([{'name': 'Auchan'}], list(companies.get_lbb_companies(self.project)))
+
+    @mock.patch(companies.__name__ + '._CACHE_MAX_SIZE', 2)
+    def test_cache_max_size(self, mock_client):
+        """Only keep the most recently cached companies."""
+        for city_id in ('69123', '31555', '75056'):
+            self.project.mobility.city.city_id = city_id
+            mock_client.return_value.get_lbb_companies.return_value = iter([{'name': city_id}])
+            list(companies.get_lbb_companies(self.project))
+        mock_client.return_value.get_lbb_companies.reset_mock()
+
+        self.project.mobility.city.city_id = '75056'
+        list(companies.get_lbb_companies(self.project))
+        mock_client.return_value.get_lbb_companies.assert_not_called()
+
+        self.project.mobility.city.city_id = '69123'
+        mock_client.return_value.get_lbb_companies.return_value = iter([])
+        list(companies.get_lbb_companies(self.project))
+        mock_client.return_value.get_lbb_companies.assert_called_once()
+
+    @mock.patch(companies.logging.__name__ + '.error')
+    def test_error(self, mock_logging, mock_client):
+        """Errors from the API are logged and not cached."""
+        mock_client.return_value.get_lbb_companies.side_effect = IOError('LBB is down')
+
+        self.assertEqual([], list(companies.get_lbb_companies(self.project)))
+        mock_logging.assert_called_once()
+
+        mock_client.return_value.get_lbb_companies.side_effect = None
+        mock_client.return_value.get_lbb_companies.return_value = iter([{'name': 'Carrefour'}])
+        self.assertEqual(
+            [{'name': 'Carrefour'}], list(companies.get_lbb_companies(self.project)))
+
+    @mock.patch(companies.logging.__name__ + '.warning')
+    def test_missing_credentials(self, mock_logging, mock_client):
+        """Do not call the API without credentials."""
+        with mock.patch(companies.__name__ + '._EMPLOI_STORE_DEV_SECRET', ''):
+            self.assertEqual([], list(companies.get_lbb_companies(self.project)))
+        mock_logging.assert_called_once()
+        mock_client.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -2,3 +2,8 @@
 db.user.createIndex('facebookId')
 db.user.createIndex('googleId')
 db.user.createIndex('profile.email')
+// Trainings from the CARIF API are refreshed after a day, and dropped after a week.
+db.carif_trainings.createIndex({'_fetchedAt': 1}, {expireAfterSeconds: 604800})
+// Used to select users in the asynchronous scripts, it is kept as a JSON field
+// when users are stored as binary protos.
+db.user.createIndex('registeredAt')
@@ -383,6 +383,30 @@ class FilterUsingScoreTestCase(unittest.TestCase):
         filtered = scoring.filter_using_score([42], get_scoring_func, None)
         self.assertEqual([], list(filtered))
 
+    def test_score_once_per_model(self):
+        """Score each distinct filter only once."""
+        scoring.SCORING_MODELS['test-mock'] = mock.MagicMock(spec=['score'])
+        scoring.SCORING_MODELS['test-mock'].score.return_value = 3
+        try:
+            filtered = scoring.filter_using_score(
+                range(4), lambda a: ['test-mock', 'test-two'] if a % 2 else ['test-mock'], None)
+            self.assertEqual([0, 1, 2, 3], list(filtered))
+        finally:
+            scoring_model = scoring.SCORING_MODELS.pop('test-mock')
+        scoring_model.score.assert_called_once_with(None)
+
+    def test_skip_useless_models(self):
+        """Do not score a filter once all the items it filters are excluded."""
+        scoring.SCORING_MODELS['test-expensive'] = mock.MagicMock(spec=['score', 'accessors'])
+        scoring.SCORING_MODELS['test-expensive'].accessors = ('get_trainings',)
+        try:
+            filtered = scoring.filter_using_score(
+                range(3), lambda a: ['test-expensive', 'test-zero'] if a else [], None)
+            self.assertEqual([0], list(filtered))
+        finally:
+            scoring_model = scoring.SCORING_MODELS.pop('test-expensive')
+        scoring_model.score.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -0,0 +1,280 @@
+"""Module to record metrics in memory and export them for Prometheus.
+
+The metrics are recorded in the memory of each process. When the server runs
+in several processes, e.g. uWSGI workers, set METRICS_MULTIPROCESS_DIR to a
+folder shared by all of them: each process then regularly saves its values in
+that folder, and the export sums the values of all the processes, whichever
+worker serves the scrape. The values of the processes that stopped are folded
+in a merged file, so that the counters never go backward.
+"""
+import bisect
+import collections
+import fcntl
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+# Folder shared by all the processes of the server to aggregate their metrics.
+# If unset, each process only exports its own values.
+_MULTIPROCESS_DIR = os.getenv('METRICS_MULTIPROCESS_DIR')
+
+# Minimum time between two saves of the values of a process, so that
+# recording metrics does not write a file for each request. The exported
+# values of the other processes may lag behind by this duration.
+_SAVE_PERIOD_SECONDS = 1
+
+_SAVE_LOCK = threading.Lock()
+_LAST_SAVE = {'time': 0}
+
+# Key of the current process, made of its PID and its start time so that a
+# new process reusing the PID of a stopped one does not overwrite its values.
+_PROCESS_KEY = {'pid': None, 'key': None}
+
+_PROCESS_FILE_REGEX = re.compile(r'^metrics\.(\d+)-(\d+)\.json$')
+# File with the values of the processes that stopped.
+_MERGED_FILE = 'metrics.merged.json'
+_LOCK_FILE = 'metrics.lock'
+
+# Default upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Histogram(object):
+    """A set of histograms of observed values, one for each set of labels."""
+
+    def __init__(self, name, documentation, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # Values keyed by the tuple of label values: for each, a list of
+        # counts for each bucket (the last one being for +Inf), and the sum of
+        # all observed values.
+        self._values = collections.OrderedDict()
+
+    def observe(self, value, *label_values):
+        """Record an observed value.
+
+        Args:
+            value: the value to record, e.g. a duration in seconds.
+            label_values: the value of each label, in the order of label_names.
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError(
+                'Expected %d labels for %s, got %d' % (
+                    len(self.label_names), self.name, len(label_values)))
+        bucket = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            try:
+                counts, total = self._values[label_values]
+            except KeyError:
+                counts, total = [0] * (len(self._buckets) + 1), 0
+            counts[bucket] += 1
+            self._values[label_values] = (counts, total + value)
+
+    def get_count(self, *label_values):
+        """Number of values observed for a set of labels."""
+        with self._lock:
+            counts = self._values.get(label_values, ((), 0))[0]
+            return sum(counts)
+
+    def reset(self):
+        """Forget all the observed values."""
+        with self._lock:
+            self._values.clear()
+
+    def get_values(self):
+        """Get a copy of the observed values, to save or to merge them."""
+        with self._lock:
+            return [
+                (list(labels), list(counts), total)
+                for labels, (counts, total) in self._values.items()]
+
+    def merge_values(self, values):
+        """Add values observed by another histogram with the same buckets."""
+        with self._lock:
+            for labels, counts, total in values:
+                if len(counts) != len(self._buckets) + 1 or len(labels) != len(self.label_names):
+                    # Saved by a version of the server with other buckets.
+                    continue
+                labels = tuple(labels)
+                previous_counts, previous_total = self._values.get(
+                    labels, ([0] * len(counts), 0))
+                self._values[labels] = (
+                    [a + b for a, b in zip(previous_counts, counts)], previous_total + total)
+
+    def export(self):
+        """Export the histograms in the Prometheus text format.
+
+        Yields:
+            the lines of the export.
+        """
+        yield '# HELP %s %s' % (self.name, self.documentation)
+        yield '# TYPE %s histogram' % self.name
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total)
+                      in self._values.items()]
+        bounds = [_format_value(bound) for bound in self._buckets] + ['+Inf']
+        for label_values, counts, total in values:
+            labels = ['%s="%s"' % (name, _escape_label_value(value))
+                      for name, value in zip(self.label_names, label_values)]
+            cumulative_count = 0
+            for bound, count in zip(bounds, counts):
+                cumulative_count += count
+                yield '%s_bucket%s %d' % (
+                    self.name, _format_labels(labels + ['le="%s"' % bound]), cumulative_count)
+            yield '%s_sum%s %s' % (self.name, _format_labels(labels), _format_value(total))
+            yield '%s_count%s %d' % (self.name, _format_labels(labels), cumulative_count)
+
+
+def _format_value(value):
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(labels)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _get_process_key():
+    pid = os.getpid()
+    if _PROCESS_KEY['pid'] != pid:
+        # Computed again after a fork, e.g. for each uWSGI worker.
+        _PROCESS_KEY['key'] = '%d-%d' % (pid, time.time() * 1000000)
+        _PROCESS_KEY['pid'] = pid
+    return _PROCESS_KEY['key']
+
+
+def _write_json(filename, data):
+    path = os.path.join(_MULTIPROCESS_DIR, filename)
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(data, json_file)
+    # Other processes never read a partially written file.
+    os.replace(path + '.tmp', path)
+
+
+def _read_json(filename):
+    try:
+        with open(os.path.join(_MULTIPROCESS_DIR, filename)) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as error:
+        logging.warning('Could not read the metrics in "%s": %s', filename, error)
+        return None
+
+
+def save_process_values(histograms, force=False):
+    """Save the values of this process for the export of other processes.
+
+    This does nothing if METRICS_MULTIPROCESS_DIR is not set, or if the values
+    were saved less than a second ago.
+    """
+    if not _MULTIPROCESS_DIR:
+        return
+    with _SAVE_LOCK:
+        now = time.time()
+        if not force and now - _LAST_SAVE['time'] < _SAVE_PERIOD_SECONDS:
+            return
+        _LAST_SAVE['time'] = now
+        filename = 'metrics.%s.json' % _get_process_key()
+        try:
+            os.makedirs(_MULTIPROCESS_DIR, exist_ok=True)
+            _write_json(filename, {h.name: h.get_values() for h in histograms})
+        except OSError as error:
+            logging.warning('Could not save the metrics in "%s": %s', filename, error)
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _list_dead_process_files(filenames):
+    process_starts = {}
+    for filename in filenames:
+        match = _PROCESS_FILE_REGEX.match(filename)
+        if match:
+            process_starts[filename] = (int(match.group(1)), int(match.group(2)))
+    last_starts = {}
+    for pid, start in process_starts.values():
+        last_starts[pid] = max(start, last_starts.get(pid, start))
+    # A process is dead if its PID is not running, or has been reused by a
+    # more recent process.
+    return {
+        filename for filename, (pid, start) in process_starts.items()
+        if start < last_starts[pid] or not _is_process_alive(pid)}
+
+
+def _merge_files(histograms, filenames):
+    for filename in filenames:
+        values = _read_json(filename) or {}
+        for histogram in histograms:
+            histogram.merge_values(values.get(histogram.name, []))
+
+
+def _aggregate_processes(histograms):
+    save_process_values(histograms, force=True)
+    aggregated = [
+        Histogram(
+            histogram.name, histogram.documentation, histogram.label_names,
+            histogram._buckets)  # pylint: disable=protected-access
+        for histogram in histograms]
+    with open(os.path.join(_MULTIPROCESS_DIR, _LOCK_FILE), 'w') as lock_file:
+        # Only one process at a time folds the values of the dead processes.
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        merged = _read_json(_MERGED_FILE) or {}
+        for histogram in aggregated:
+            histogram.merge_values(merged.get('values', {}).get(histogram.name, []))
+        # Files of dead processes that are already in the merged values, in
+        # case they could not be removed.
+        folded = set(merged.get('folded', []))
+
+        filenames = set(os.listdir(_MULTIPROCESS_DIR))
+        dead_files = _list_dead_process_files(filenames)
+        if dead_files:
+            _merge_files(aggregated, sorted(dead_files - folded))
+            _write_json(_MERGED_FILE, {
+                'folded': sorted((folded | dead_files) & filenames),
+                'values': {histogram.name: histogram.get_values() for histogram in aggregated},
+            })
+            for filename in dead_files:
+                try:
+                    os.remove(os.path.join(_MULTIPROCESS_DIR, filename))
+                except OSError as error:
+                    logging.warning('Could not remove the metrics in "%s": %s', filename, error)
+
+        _merge_files(aggregated, sorted(
+            filename for filename in filenames - dead_files - folded
+            if _PROCESS_FILE_REGEX.match(filename)))
+    return aggregated
+
+
+def export(histograms):
+    """Export several histograms in the Prometheus text format.
+
+    If METRICS_MULTIPROCESS_DIR is set, the values of all the processes are
+    summed up.
+    """
+    if _MULTIPROCESS_DIR:
+        histograms = _aggregate_processes(histograms)
+    return ''.join(
+        line + '\n' for histogram in histograms for line in histogram.export())
@@ -0,0 +1,191 @@
+"""Unit tests for the metrics module."""
+import json
+import os
+from os import path
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from bob_emploi.frontend import metrics
+
+
+class HistogramTestCase(unittest.TestCase):
+    """Unit tests for the Histogram class."""
+
+    def test_export(self):
+        """Export cumulative buckets for each set of labels."""
+        histogram = metrics.Histogram(
+            'request_seconds', 'Duration of requests.', ['endpoint'], buckets=(.1, 1))
+        histogram.observe(.05, 'user')
+        histogram.observe(.1, 'user')
+        histogram.observe(3, 'user')
+        histogram.observe(.5, 'jobs')
+
+        self.assertEqual([
+            '# HELP request_seconds Duration of requests.',
+            '# TYPE request_seconds histogram',
+            'request_seconds_bucket{endpoint="user",le="0.1"} 2',
+            'request_seconds_bucket{endpoint="user",le="1.0"} 2',
+            'request_seconds_bucket{endpoint="user",le="+Inf"} 3',
+            'request_seconds_sum{endpoint="user"} 3.15',
+            'request_seconds_count{endpoint="user"} 3',
+            'request_seconds_bucket{endpoint="jobs",le="0.1"} 0',
+            'request_seconds_bucket{endpoint="jobs",le="1.0"} 1',
+            'request_seconds_bucket{endpoint="jobs",le="+Inf"} 1',
+            'request_seconds_sum{endpoint="jobs"} 0.5',
+            'request_seconds_count{endpoint="jobs"} 1',
+        ], list(histogram.export()))
+        self.assertEqual(3, histogram.get_count('user'))
+
+    def test_escape_labels(self):
+        """Escape label values."""
+        histogram = metrics.Histogram('stage_seconds', 'Stages.', ['stage'], buckets=())
+        histogram.observe(1, 'Say "hello"\\')
+
+        self.assertIn(
+            r'stage_seconds_count{stage="Say \"hello\"\\"} 1', list(histogram.export()))
+
+    def test_wrong_labels(self):
+        """Labels must match the label names."""
+        histogram = metrics.Histogram('stage_seconds', 'Stages.', ['endpoint', 'stage'])
+        with self.assertRaises(ValueError):
+            histogram.observe(1, 'user')
+
+    def test_reset(self):
+        """Forget the observed values."""
+        histogram = metrics.Histogram('stage_seconds', 'Stages.', ['stage'])
+        histogram.observe(1, 'Advisor')
+        histogram.reset()
+        self.assertEqual(0, histogram.get_count('Advisor'))
+        self.assertEqual(2, len(list(histogram.export())))
+
+    def test_export_several(self):
+        """Export several histograms in the same text."""
+        first = metrics.Histogram('first_seconds', 'First.', [])
+        second = metrics.Histogram('second_seconds', 'Second.', [])
+        first.observe(1)
+        text = metrics.export([first, second])
+        self.assertTrue(text.endswith('# TYPE second_seconds histogram\n'))
+        self.assertIn('first_seconds_count 1\n', text)
+
+
+class MultiprocessTestCase(unittest.TestCase):
+    """Unit tests for the aggregation of the metrics of several processes."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        super(MultiprocessTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        patcher = mock.patch(metrics.__name__ + '._MULTIPROCESS_DIR', self.folder)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(metrics.__name__ + '._LAST_SAVE', {'time': 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.dict(metrics.__name__ + '._PROCESS_KEY', {'pid': None, 'key': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.histogram = metrics.Histogram(
+            'request_seconds', 'Duration of requests.', ['endpoint'], buckets=(.1, 1))
+
+    def _write_process_values(self, filename, values):
+        with open(path.join(self.folder, filename), 'w') as values_file:
+            json.dump({'request_seconds': values}, values_file)
+
+    @mock.patch(metrics.__name__ + '._is_process_alive', new=lambda pid: True)
+    def test_export_all_processes(self):
+        """Sum up the values saved by the other processes."""
+        self.histogram.observe(.0625, 'user')
+        with open(path.join(self.folder, 'metrics.1-1000.json'), 'w') as values_file:
+            json.dump({
+                'request_seconds': [[['user'], [1, 0, 1], 2.0625], [['jobs'], [0, 1, 0], .5]],
+                'other_seconds': [[[], [1], 1]],
+            }, values_file)
+        # Saved by a version of the server with other buckets.
+        self._write_process_values('metrics.2-1000.json', [[['user'], [1, 0], .05]])
+
+        text = metrics.export([self.histogram])
+
+        self.assertIn('request_seconds_bucket{endpoint="user",le="0.1"} 2\n', text)
+        self.assertIn('request_seconds_bucket{endpoint="user",le="+Inf"} 3\n', text)
+        self.assertIn('request_seconds_sum{endpoint="user"} 2.125\n', text)
+        self.assertIn('request_seconds_count{endpoint="jobs"} 1\n', text)
+        self.assertNotIn('other_seconds', text)
+        # The values of the process itself are not modified.
+        self.assertEqual(1, self.histogram.get_count('user'))
+
+    @mock.patch(metrics.__name__ + '._is_process_alive')
+    def test_fold_dead_processes(self, mock_is_process_alive):
+        """Fold the values of the stopped processes so that counters never go backward."""
+        mock_is_process_alive.side_effect = lambda pid: pid != 2
+        self._write_process_values('metrics.1-1000.json', [[['user'], [1, 0, 0], .0625]])
+        self._write_process_values('metrics.2-1000.json', [[['user'], [1, 0, 0], .0625]])
+        self._write_process_values('metrics.3-1000.json', [[['user'], [1, 0, 0], .0625]])
+        # The PID 3 is reused by a new process.
+        self._write_process_values('metrics.3-2000.json', [[['user'], [1, 0, 0], .0625]])
+
+        text = metrics.export([self.histogram])
+        self.assertIn('request_seconds_count{endpoint="user"} 4\n', text)
+        self.assertEqual(
+            {
+                'metrics.1-1000.json', 'metrics.3-2000.json', 'metrics.lock',
+                'metrics.merged.json', 'metrics.%s.json' % metrics._get_process_key(),
+            },
+            set(os.listdir(self.folder)))
+
+        # The new process with the PID 3 records more values.
+        self._write_process_values('metrics.3-2000.json', [[['user'], [2, 0, 0], .125]])
+        text = metrics.export([self.histogram])
+        self.assertIn('request_seconds_count{endpoint="user"} 5\n', text)
+
+    @mock.patch(metrics.__name__ + '._is_process_alive', new=lambda pid: pid != 2)
+    def test_dead_process_file_not_removed(self):
+        """Do not count twice a dead process whose file could not be removed."""
+        self._write_process_values('metrics.2-1000.json', [[['user'], [1, 0, 0], .0625]])
+
+        with mock.patch(metrics.os.__name__ + '.remove') as mock_remove:
+            mock_remove.side_effect = PermissionError('Read-only')
+            self.assertIn(
+                'request_seconds_count{endpoint="user"} 1\n', metrics.export([self.histogram]))
+            self.assertIn(
+                'request_seconds_count{endpoint="user"} 1\n', metrics.export([self.histogram]))
+
+    @mock.patch(metrics.os.__name__ + '.getpid')
+    def test_process_key(self, mock_getpid):
+        """A new process gets a new key even if it reuses a PID."""
+        mock_getpid.return_value = 42
+        key = metrics._get_process_key()
+        self.assertTrue(key.startswith('42-'), msg=key)
+        self.assertEqual(key, metrics._get_process_key())
+
+        mock_getpid.return_value = 43
+        self.assertTrue(metrics._get_process_key().startswith('43-'))
+
+    @mock.patch(metrics.__name__ + '.time.time')
+    def test_save_throttled(self, mock_time):
+        """Save the values of the process at most once per period."""
+        mock_time.return_value = 1000
+        self.histogram.observe(.05, 'user')
+        metrics.save_process_values([self.histogram])
+        self.histogram.observe(.05, 'user')
+        metrics.save_process_values([self.histogram])
+
+        process_file = path.join(
+            self.folder, 'metrics.%s.json' % metrics._get_process_key())
+        with open(process_file) as values_file:
+            self.assertEqual(
+                {'request_seconds': [[['user'], [1, 0, 0], .05]]}, json.load(values_file))
+
+        mock_time.return_value = 1010
+        metrics.save_process_values([self.histogram])
+        with open(process_file) as values_file:
+            self.assertEqual(
+                {'request_seconds': [[['user'], [2, 0, 0], .1]]}, json.load(values_file))
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,90 @@
+"""Endpoints to monitor the latency of the server and the cost of its scoring."""
+import logging
+
+import flask
+
+from bob_emploi.frontend import metrics
+from bob_emploi.frontend import proto
+from bob_emploi.frontend import scoring
+from bob_emploi.frontend.api import stats_pb2
+
+# Log timing of requests that take too long to be treated.
+_LONG_REQUEST_DURATION_SECONDS = 1.5
+
+_REQUEST_DURATION = metrics.Histogram(
+    'bob_request_duration_seconds', 'Duration of the requests.', ['endpoint'])
+# The stages are delimited by the ticks of a request: each stage goes from a
+# tick to the next one, and is named after the former.
+_REQUEST_STAGE_DURATION = metrics.Histogram(
+    'bob_request_stage_duration_seconds', 'Duration of the stages of the requests.',
+    ['endpoint', 'stage'])
+_REQUEST_HISTOGRAMS = [_REQUEST_DURATION, _REQUEST_STAGE_DURATION]
+
+
+def record_request(endpoint, start, ticks, end):
+    """Record the duration of a request and of its stages, and log it if too long.
+
+    Args:
+        endpoint: the name of the endpoint of the request.
+        start: the time at which the request started.
+        ticks: the ticks of the request, sorted by time. Each one has a name
+            and a time.
+        end: the time at which the request ended.
+    """
+    _REQUEST_DURATION.observe(end - start, endpoint)
+    for tick, next_tick_time in zip(ticks, [t.time for t in ticks[1:]] + [end]):
+        if tick.name.endswith(' end'):
+            # This tick only marks the end of the previous stage.
+            continue
+        stage = tick.name[:-len(' start')] if tick.name.endswith(' start') else tick.name
+        _REQUEST_STAGE_DURATION.observe(next_tick_time - tick.time, endpoint, stage)
+    metrics.save_process_values(_REQUEST_HISTOGRAMS)
+
+    total_duration = end - start
+    if total_duration <= _LONG_REQUEST_DURATION_SECONDS:
+        return
+    logging.warning('Long request: %d seconds', total_duration)
+    last_tick_time = start
+    for tick in ticks:
+        logging.warning(
+            '%.4f: Tick %s (%.4f since last tick)',
+            tick.time - start, tick.name, tick.time - last_tick_time)
+        last_tick_time = tick.time
+
+
+def create_blueprint(requires_admin_auth):
+    """Create the blueprint of the monitoring endpoints.
+
+    Args:
+        requires_admin_auth: a decorator to restrict an endpoint to admins.
+    Returns:
+        a flask Blueprint to register with the "/api" prefix.
+    """
+    app = flask.Blueprint('monitoring', __name__)  # pylint: disable=invalid-name
+
+    @app.route('/metrics', methods=['GET'])
+    @requires_admin_auth
+    def get_metrics():
+        """Export the latency of the requests and of their stages for Prometheus."""
+        return flask.Response(
+            metrics.export(_REQUEST_HISTOGRAMS), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/scoring/stats', methods=['GET'])
+    @requires_admin_auth
+    @proto.flask_api(out_type=stats_pb2.ScoringStats)
+    def get_scoring_stats():
+        """Get the time spent in each scoring model by this server process.
+
+        The stats are only recorded if the server was started with the
+        SCORING_STATS_ENABLED environment variable.
+        """
+        return scoring.get_stats()
+
+    @app.route('/scoring/stats', methods=['DELETE'])
+    @requires_admin_auth
+    def reset_scoring_stats():
+        """Reset the stats of the scoring models of this server process."""
+        scoring.reset_stats()
+        return ''
+
+    return app
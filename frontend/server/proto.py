@@ -1,10 +1,22 @@
 """Module to help the frontend manipulate protobuffers."""
+import abc
 import collections
+import collections.abc
+from concurrent import futures
 import datetime
 import functools
+import glob
+import json
 import logging
+import math
+import mmap
 import os
+import struct
+import threading
 
+import bson
+from bson import codec_options
+from bson import raw_bson
 try:
     import flask
 except ImportError:
@@ -13,28 +25,188 @@ except ImportError:
     # but the rest will.
     pass
 
+from google.protobuf import descriptor
 from google.protobuf import json_format
 from google.protobuf import message
+import pymongo
 
 _CACHE_DURATION = datetime.timedelta(hours=1)
+# Minimum delay between two checks of the "meta" collection to find out
+# whether the importers have updated a collection.
+_META_CHECK_PERIOD = datetime.timedelta(seconds=10)
+# Delay before trying again to refresh a cached collection after a failure.
+_REFRESH_RETRY_DELAY = datetime.timedelta(minutes=1)
 _IS_TEST_ENV = bool(os.getenv('TEST_ENV'))
 
+# Field of MongoDB documents storing the proto in its binary form, see
+# to_binary_document.
+BINARY_FIELD = '_proto'
+# Field of MongoDB documents listing the top level fields that only hold a few
+# indexed nested fields of the binary proto, see to_binary_document. Queries
+# with a projection need it as well as BINARY_FIELD to parse the proto back.
+PARTIAL_FIELDS_FIELD = '_partialFields'
+
+# A directory in which to share snapshots of the cached collections between
+# processes, e.g. the uWSGI workers. If unset, each process holds its own
+# parsed copy of the collections.
+_SNAPSHOT_DIR = os.getenv('PROTO_SNAPSHOT_DIR')
+# First bytes of a snapshot file.
+_SNAPSHOT_MAGIC = b'BOBPROTO'
+
+# Threads used to refresh the cached collections off the request path.
+_REFRESH_EXECUTOR = futures.ThreadPoolExecutor(max_workers=2)
+
 
 def parse_from_mongo(mongo_dict, proto):
     """Parse a Protobuf from a dict coming from MongoDB.
 
+    If the dict was created by to_binary_document, the proto is parsed from
+    its binary form and the other fields of the dict then replace the binary
+    ones, so that updates of those fields are taken into account as they would
+    be for a JSON document. Fields that only index a few nested fields are
+    merged instead.
+
     Args:
         mongo_dict: a dict coming from MongoDB, or None. This dict will be
             modified by the function: it removes all the keys prefixed by "_"
-            and convert datetime objects to iso strings.
+            and may convert datetime objects to iso strings.
         proto: a protobuffer to merge data into.
     Returns: a boolean indicating whether the input had actual data.
     """
     if mongo_dict is None:
         return False
+    binary = mongo_dict.get(BINARY_FIELD)
+    if not isinstance(binary, bytes):
+        # Only documents created by to_binary_document hold a binary proto
+        # (bson.Binary is a subclass of bytes).
+        binary = None
+    partial_fields = mongo_dict.get(PARTIAL_FIELDS_FIELD) or ()
     to_delete = [k for k in mongo_dict if k.startswith('_')]
     for key in to_delete:
         del mongo_dict[key]
+    if binary is not None:
+        try:
+            proto.MergeFromString(bytes(binary))
+        except message.DecodeError as error:
+            logging.warning(
+                'Error %s while parsing a binary proto of type %s', error,
+                proto.__class__.__name__)
+            if _IS_TEST_ENV:
+                raise error
+            return False
+        if not mongo_dict:
+            return True
+        for key in mongo_dict:
+            field = proto.DESCRIPTOR.fields_by_camelcase_name.get(key) or \
+                proto.DESCRIPTOR.fields_by_name.get(key)
+            if field and field.name not in partial_fields:
+                proto.ClearField(field.name)
+    try:
+        _fast_parse_message(mongo_dict, proto, not _IS_TEST_ENV)
+        return True
+    except _SlowParseRequired:
+        # The fast path only handles the common cases, let json_format deal
+        # with the others and raise the same errors as before.
+        pass
+    return _parse_with_json_format(mongo_dict, proto)
+
+
+def to_binary_document(proto, indexed_fields=()):
+    """Create a MongoDB document storing a proto in its binary form.
+
+    This is much faster to write and to parse back than a JSON document, but
+    the fields cannot be used in queries: the ones that are needed can be
+    kept as JSON fields as well.
+
+    Args:
+        proto: the protobuffer to store.
+        indexed_fields: the fields to keep as JSON fields, as dotted paths of
+            proto field names, e.g. "profile.email".
+    Returns: a dict to store in MongoDB, that can be parsed with parse_from_mongo.
+    """
+    indexed_proto = proto.__class__()
+    for field_path in indexed_fields:
+        _copy_field(proto, indexed_proto, field_path.split('.'))
+    document = json_format.MessageToDict(indexed_proto)
+    document[BINARY_FIELD] = bson.Binary(proto.SerializeToString())
+    partial_fields = sorted({
+        field_path.split('.')[0] for field_path in indexed_fields if '.' in field_path})
+    if partial_fields:
+        document[PARTIAL_FIELDS_FIELD] = partial_fields
+    return document
+
+
+def _copy_field(source, target, field_path):
+    name = field_path[0]
+    field = source.DESCRIPTOR.fields_by_name[name]
+    if field.label == descriptor.FieldDescriptor.LABEL_REPEATED:
+        getattr(target, name).MergeFrom(getattr(source, name))
+    elif field.cpp_type != descriptor.FieldDescriptor.CPPTYPE_MESSAGE:
+        setattr(target, name, getattr(source, name))
+    elif not source.HasField(name):
+        return
+    elif len(field_path) > 1:
+        _copy_field(getattr(source, name), getattr(target, name), field_path[1:])
+    else:
+        getattr(target, name).CopyFrom(getattr(source, name))
+
+
+def get_mongo_update(previous_document, document):
+    """Compute a MongoDB update that changes a document into another one.
+
+    Sub-documents and lists of the same length are compared item by item so
+    that only the fields that changed are sent.
+
+    Args:
+        previous_document: the document as it is stored in MongoDB.
+        document: the new document. Its _id field is ignored.
+    Returns: a dict with the $set and $unset operators to apply, empty if both
+        documents are equal.
+    """
+    to_set = {}
+    to_unset = {}
+    previous_document = {k: v for k, v in previous_document.items() if k != '_id'}
+    document = {k: v for k, v in document.items() if k != '_id'}
+    _diff_dicts(previous_document, document, '', to_set, to_unset)
+    update = {}
+    if to_set:
+        update['$set'] = to_set
+    if to_unset:
+        update['$unset'] = to_unset
+    return update
+
+
+def _diff_dicts(previous_dict, new_dict, prefix, to_set, to_unset):
+    for key, value in new_dict.items():
+        if key in previous_dict:
+            _diff_values(previous_dict[key], value, prefix + key, to_set, to_unset)
+        else:
+            to_set[prefix + key] = value
+    for key in previous_dict:
+        if key not in new_dict:
+            to_unset[prefix + key] = ''
+
+
+def _diff_values(previous_value, value, path, to_set, to_unset):
+    if previous_value == value:
+        return
+    if isinstance(previous_value, dict) and isinstance(value, dict) and \
+            _has_path_safe_keys(previous_value) and _has_path_safe_keys(value):
+        _diff_dicts(previous_value, value, path + '.', to_set, to_unset)
+        return
+    if isinstance(previous_value, list) and isinstance(value, list) and \
+            len(previous_value) == len(value):
+        for index, (previous_item, item) in enumerate(zip(previous_value, value)):
+            _diff_values(previous_item, item, '%s.%d' % (path, index), to_set, to_unset)
+        return
+    to_set[path] = value
+
+
+def _has_path_safe_keys(value):
+    return all(key and '.' not in key and not key.startswith('$') for key in value)
+
+
+def _parse_with_json_format(mongo_dict, proto):
     _convert_datetimes_to_string(mongo_dict)
     try:
         json_format.ParseDict(mongo_dict, proto, ignore_unknown_fields=not _IS_TEST_ENV)
@@ -48,6 +220,216 @@ def parse_from_mongo(mongo_dict, proto):
     return True
 
 
+class _SlowParseRequired(Exception):
+    """The fast parser cannot handle a value, json_format should be used."""
+
+
+# The converters below check exact types as bool is a subclass of int, and
+# json_format does not accept booleans for numbers.
+
+
+def _convert_integer(value):
+    if type(value) is not int:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    return value
+
+
+def _convert_double(value):
+    if type(value) is int:  # pylint: disable=unidiomatic-typecheck
+        return value
+    if type(value) is not float:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    if not math.isfinite(value):
+        raise _SlowParseRequired()
+    return value
+
+
+def _convert_float(value):
+    value = _convert_double(value)
+    if abs(value) > _MAX_FLOAT:
+        raise _SlowParseRequired()
+    return value
+
+
+def _convert_bool(value):
+    if type(value) is not bool:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    return value
+
+
+def _convert_string(value):
+    if type(value) is not str:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    return value
+
+
+def _make_enum_converter(enum_type):
+    def _convert_enum(value):
+        if type(value) is str:  # pylint: disable=unidiomatic-typecheck
+            enum_value = enum_type.values_by_name.get(value)
+        elif type(value) is int:  # pylint: disable=unidiomatic-typecheck
+            enum_value = enum_type.values_by_number.get(value)
+        else:
+            enum_value = None
+        if enum_value is None:
+            raise _SlowParseRequired()
+        return enum_value.number
+    return _convert_enum
+
+
+def _unsupported_scalar(unused_value):
+    raise _SlowParseRequired()
+
+
+def _unsupported_setter(unused_value, unused_proto_message, unused_ignore_unknown_fields):
+    raise _SlowParseRequired()
+
+
+_MAX_FLOAT = 3.4028234663852886e+38
+
+_SCALAR_CONVERTERS = {
+    descriptor.FieldDescriptor.CPPTYPE_INT32: _convert_integer,
+    descriptor.FieldDescriptor.CPPTYPE_INT64: _convert_integer,
+    descriptor.FieldDescriptor.CPPTYPE_UINT32: _convert_integer,
+    descriptor.FieldDescriptor.CPPTYPE_UINT64: _convert_integer,
+    descriptor.FieldDescriptor.CPPTYPE_DOUBLE: _convert_double,
+    descriptor.FieldDescriptor.CPPTYPE_FLOAT: _convert_float,
+    descriptor.FieldDescriptor.CPPTYPE_BOOL: _convert_bool,
+}
+
+
+def _get_scalar_converter(field):
+    if field.cpp_type == descriptor.FieldDescriptor.CPPTYPE_ENUM:
+        return _make_enum_converter(field.enum_type)
+    if field.type == descriptor.FieldDescriptor.TYPE_STRING:
+        return _convert_string
+    return _SCALAR_CONVERTERS.get(field.cpp_type, _unsupported_scalar)
+
+
+def _make_map_setter(field):
+    key_field = field.message_type.fields_by_name['key']
+    value_field = field.message_type.fields_by_name['value']
+    if key_field.type != descriptor.FieldDescriptor.TYPE_STRING:
+        return _unsupported_setter
+    is_message = value_field.cpp_type == descriptor.FieldDescriptor.CPPTYPE_MESSAGE
+    convert = None if is_message else _get_scalar_converter(value_field)
+
+    def _set_map(value, proto_message, ignore_unknown_fields):
+        if type(value) is not dict:  # pylint: disable=unidiomatic-typecheck
+            raise _SlowParseRequired()
+        proto_message.ClearField(field.name)
+        map_field = getattr(proto_message, field.name)
+        for key, item in value.items():
+            if is_message:
+                _fast_parse_message(item, map_field[key], ignore_unknown_fields)
+            else:
+                map_field[key] = convert(item)
+    return _set_map
+
+
+def _make_field_setter(field):
+    if field.cpp_type == descriptor.FieldDescriptor.CPPTYPE_MESSAGE:
+        if field.message_type.GetOptions().map_entry:
+            return _make_map_setter(field)
+        if field.label == descriptor.FieldDescriptor.LABEL_REPEATED:
+            def _set_repeated_messages(value, proto_message, ignore_unknown_fields):
+                if type(value) is not list:  # pylint: disable=unidiomatic-typecheck
+                    raise _SlowParseRequired()
+                proto_message.ClearField(field.name)
+                repeated_field = getattr(proto_message, field.name)
+                for item in value:
+                    _fast_parse_message(item, repeated_field.add(), ignore_unknown_fields)
+            return _set_repeated_messages
+
+        def _set_message(value, proto_message, ignore_unknown_fields):
+            sub_message = getattr(proto_message, field.name)
+            sub_message.SetInParent()
+            _fast_parse_message(value, sub_message, ignore_unknown_fields)
+        return _set_message
+
+    convert = _get_scalar_converter(field)
+    if field.label == descriptor.FieldDescriptor.LABEL_REPEATED:
+        def _set_repeated_scalars(value, proto_message, unused_ignore_unknown_fields):
+            if type(value) is not list:  # pylint: disable=unidiomatic-typecheck
+                raise _SlowParseRequired()
+            proto_message.ClearField(field.name)
+            getattr(proto_message, field.name).extend([convert(item) for item in value])
+        return _set_repeated_scalars
+
+    def _set_scalar(value, proto_message, unused_ignore_unknown_fields):
+        setattr(proto_message, field.name, convert(value))
+    return _set_scalar
+
+
+# Compiled parsers for each message descriptor: a dict of setters keyed by
+# the JSON and the proto names of the fields.
+_FAST_PARSERS = {}
+
+
+def _get_fast_parser(message_descriptor):
+    try:
+        return _FAST_PARSERS[message_descriptor]
+    except KeyError:
+        pass
+    parser = {}
+    for field in message_descriptor.fields:
+        setter = (field, _make_field_setter(field))
+        parser[field.name] = setter
+        parser[field.json_name] = setter
+    _FAST_PARSERS[message_descriptor] = parser
+    return parser
+
+
+def _parse_timestamp(value, timestamp):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise _SlowParseRequired()
+        timestamp.FromDatetime(value)
+        return
+    if type(value) is not str:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    try:
+        timestamp.FromJsonString(value)
+    except ValueError:
+        raise _SlowParseRequired()
+
+
+def _fast_parse_message(value, proto_message, ignore_unknown_fields):
+    """Parse a dict from MongoDB in a proto like json_format.ParseDict does.
+
+    It only handles the common cases, and raises a _SlowParseRequired for
+    all the others (well known types apart from Timestamp, null values,
+    invalid values, etc).
+    """
+    message_descriptor = proto_message.DESCRIPTOR
+    if message_descriptor.full_name == 'google.protobuf.Timestamp':
+        _parse_timestamp(value, proto_message)
+        return
+    if message_descriptor.file.name.startswith('google/protobuf/'):
+        raise _SlowParseRequired()
+    if type(value) is not dict:  # pylint: disable=unidiomatic-typecheck
+        raise _SlowParseRequired()
+    parser = _get_fast_parser(message_descriptor)
+    seen = set()
+    for name, field_value in value.items():
+        try:
+            field, setter = parser[name]
+        except KeyError:
+            if ignore_unknown_fields and not name.startswith('['):
+                continue
+            raise _SlowParseRequired()
+        oneof = field.containing_oneof
+        if field_value is None or field in seen or oneof in seen:
+            raise _SlowParseRequired()
+        seen.add(field)
+        if oneof is not None:
+            seen.add(oneof)
+        try:
+            setter(field_value, proto_message, ignore_unknown_fields)
+        except (TypeError, ValueError):
+            raise _SlowParseRequired()
+
+
 def _convert_datetimes_to_string(values):
     if isinstance(values, dict):
         for key, value in values.items():
@@ -108,7 +490,8 @@ def _cache_mongo_collection(mongo_iterator, cache, proto_type, update_func=None)
     Args:
         mongo_iterator: a function that iterates over mongo documents.
         cache: a list or a dict to populate with cached protos. If it is a dict
-            then the key populated will be the "_id" values.
+            then the key populated will be the "_id" values. If it is a
+            LazyProtos, the documents are only parsed on first access.
         proto_type: the python proto class for the expected proto type.
         update_func: an optional function to call on each proto once imported.
     Returns:
@@ -116,6 +499,10 @@ def _cache_mongo_collection(mongo_iterator, cache, proto_type, update_func=None)
     """
     if cache:
         return cache
+    if isinstance(cache, LazyProtos):
+        for document in mongo_iterator():
+            cache.add_document(str(document['_id']), document)
+        return cache
     as_dict = isinstance(cache, dict)
     for document in mongo_iterator():
         proto = proto_type()
@@ -133,17 +520,22 @@ def _cache_mongo_collection(mongo_iterator, cache, proto_type, update_func=None)
 class MongoCachedCollection(object):
     """Handler for a collection of protobuffers in MongoDB."""
 
-    def __init__(self, proto_type, collection_name, update_func=None):
+    def __init__(self, proto_type, collection_name, update_func=None, lazy=False):
         """Creates a new collection.
 
         Args:
             proto_type: the python proto class for the expected proto type.
             collection_name: a MongoDB collection_name that holds he original protobuffers.
             update_func: an optional function to call on each proto once imported.
+            lazy: whether to parse each proto only when it is first accessed,
+                instead of parsing all of them when populating the cache.
+                Use it for large collections of which a request only needs a
+                few protos.
         """
         self._collection_name = collection_name
         self._proto_type = proto_type
         self._update_func = update_func
+        self._lazy = lazy
 
         self._cache = None
         self._database = None
@@ -153,7 +545,13 @@ class MongoCachedCollection(object):
         if self._cache and database == self._database:
             return self._cache
         self._database = database
-        self._cache = _MongoCachedCollection(self._populate)
+        self._cache = _MongoCachedCollection(
+            functools.partial(self._populate, database),
+            get_updated_at=functools.partial(
+                get_collection_updated_at, database, self._collection_name),
+            load_snapshot=functools.partial(self._load_snapshot, database),
+            create_cache=functools.partial(LazyProtos, self._proto_type, self._update_func)
+            if self._lazy else collections.OrderedDict)
         return self._cache
 
     def reset_cache(self):
@@ -161,36 +559,407 @@ class MongoCachedCollection(object):
         self._cache = None
         self._database = None
 
-    def _populate(self, cache):
-        _cache_mongo_collection(
-            self._database.get_collection(self._collection_name).find, cache,
-            self._proto_type, self._update_func)
+    def _populate(self, database, cache):
+        if isinstance(cache, LazyProtos):
+            # Only the top level of the documents is decoded, to get their
+            # IDs: the rest is kept as raw BSON until it is accessed.
+            collection = database.get_collection(
+                self._collection_name,
+                codec_options=codec_options.CodecOptions(
+                    document_class=raw_bson.RawBSONDocument))
+        else:
+            collection = database.get_collection(self._collection_name)
+        _cache_mongo_collection(collection.find, cache, self._proto_type, self._update_func)
+
+    def _load_snapshot(self, database, updated_at):
+        """Load the collection from a snapshot file shared between processes.
+
+        The first process to need a given import of the collection populates
+        it from MongoDB and writes the snapshot, the others only map it.
+
+        Returns:
+            a mapping of protos, or None if snapshots are disabled or failed.
+        """
+        if not _SNAPSHOT_DIR:
+            return None
+        prefix = os.path.join(_SNAPSHOT_DIR, '%s.%s.' % (database.name, self._collection_name))
+        path = '%s%s.snapshot' % (prefix, updated_at.strftime('%Y%m%d%H%M%S%f'))
+        try:
+            if not os.path.exists(path):
+                cache = collections.OrderedDict()
+                self._populate(database, cache)
+                write_snapshot(path, cache.items())
+                # Processes that still map older snapshots keep their pages
+                # until they unmap them.
+                for old_path in glob.glob(glob.escape(prefix) + '*.snapshot'):
+                    if old_path == path:
+                        continue
+                    try:
+                        os.remove(old_path)
+                    except FileNotFoundError:
+                        # Already removed by another process.
+                        pass
+            return MappedProtos(path, self._proto_type)
+        except (OSError, ValueError) as error:
+            logging.warning('Could not use the snapshot "%s": %s', path, error)
+            return None
+
+
+def write_snapshot(path, protos):
+    """Write protos to a snapshot file that processes can map in memory.
+
+    The file starts with a magic string, the size of the index and the index
+    itself: a JSON list of [key, offset, size] of each serialized proto. The
+    serialized protos follow. The file is written atomically.
+
+    Args:
+        path: the path of the file to write.
+        protos: an iterable of (key, proto) tuples.
+    """
+    index = []
+    data = []
+    offset = 0
+    for key, proto in protos:
+        serialized = proto.SerializeToString()
+        index.append([key, offset, len(serialized)])
+        data.append(serialized)
+        offset += len(serialized)
+    header = json.dumps(index).encode('utf-8')
+
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(_SNAPSHOT_MAGIC)
+        snapshot_file.write(struct.pack('<Q', len(header)))
+        snapshot_file.write(header)
+        for serialized in data:
+            snapshot_file.write(serialized)
+    os.replace(tmp_path, path)
+
+
+class _LazyMapping(collections.abc.Mapping):
+    """A read-only mapping of protos that are parsed on their first access.
+
+    The parsed protos are memoized and shared: do not modify them.
+    """
+
+    def __init__(self, proto_type):
+        self._proto_type = proto_type
+        self._protos = {}
+
+    @abc.abstractmethod
+    def _parse(self, key):
+        """Parse the proto for a key, or raise a KeyError."""
+
+    def __getitem__(self, key):
+        try:
+            return self._protos[key]
+        except KeyError:
+            pass
+        proto = self._parse(key)
+        self._protos[key] = proto
+        return proto
+
+
+class LazyProtos(_LazyMapping):
+    """A mapping of MongoDB documents kept as BSON and parsed on first access."""
+
+    def __init__(self, proto_type, update_func=None):
+        super(LazyProtos, self).__init__(proto_type)
+        self._update_func = update_func
+        self._documents = collections.OrderedDict()
+
+    def add_document(self, key, document):
+        """Add a MongoDB document to parse when the key is first accessed.
+
+        Documents read as RawBSONDocument keep their raw bytes, other ones are
+        encoded in BSON.
+        """
+        if isinstance(document, raw_bson.RawBSONDocument):
+            self._documents[key] = document.raw
+        else:
+            self._documents[key] = bson.BSON.encode(document)
+
+    def _parse(self, key):
+        proto = self._proto_type()
+        parse_from_mongo(bson.BSON(self._documents[key]).decode(), proto)
+        if self._update_func:
+            self._update_func(proto, key)
+        return proto
+
+    def __iter__(self):
+        return iter(self._documents)
+
+    def __len__(self):
+        return len(self._documents)
+
+
+class MappedProtos(_LazyMapping):
+    """A read-only mapping of the protos of a snapshot file, see write_snapshot.
+
+    The file is memory-mapped so that its pages are shared by all the processes
+    using it. Each proto is only deserialized on its first access.
+    """
+
+    def __init__(self, path, proto_type):
+        super(MappedProtos, self).__init__(proto_type)
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic_size = len(_SNAPSHOT_MAGIC)
+        if self._mmap[:magic_size] != _SNAPSHOT_MAGIC:
+            raise ValueError('Not a snapshot file')
+        header_size, = struct.unpack('<Q', self._mmap[magic_size:magic_size + 8])
+        header_start = magic_size + 8
+        self._data_start = header_start + header_size
+        self._index = collections.OrderedDict(
+            (key, (offset, size)) for key, offset, size in json.loads(
+                self._mmap[header_start:self._data_start].decode('utf-8')))
+
+    def _parse(self, key):
+        offset, size = self._index[key]
+        start = self._data_start + offset
+        proto = self._proto_type()
+        proto.ParseFromString(self._mmap[start:start + size])
+        return proto
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
 
 
 class _MongoCachedCollection(object):
+    """A snapshot of a collection of protos, refreshed in the background.
+
+    The first access populates the snapshot synchronously. Once it is
+    stale, the snapshot keeps being served while a new one is populated off
+    the request path and then swapped in atomically.
+
+    If the importers record when they updated the source collection, the
+    snapshot is stale only once this date moves: it is polled at most every
+    _META_CHECK_PERIOD. Otherwise the snapshot expires after cache_duration.
+
+    If MongoDB cannot be reached, the current snapshot is served and a refresh
+    is only tried again after _REFRESH_RETRY_DELAY.
+    """
 
-    def __init__(self, populate, cache_duration=_CACHE_DURATION):
+    def __init__(
+            self, populate, cache_duration=_CACHE_DURATION, get_updated_at=None,
+            load_snapshot=None, create_cache=collections.OrderedDict):
         self._populate = populate
-        self._cache = None
+        self._load_snapshot = load_snapshot
+        self._create_cache = create_cache
+        # A tuple with the cached protos and the data derived from them, see
+        # get_derived. Both are swapped together.
+        self._snapshot = None
         self._cached_valid_until = None
         self._cache_duration = cache_duration
+        self._lock = threading.Lock()
+        self._is_refreshing = False
+        self._get_updated_at = get_updated_at
+        # When the source collection was updated for the current snapshot.
+        self._updated_at = None
+        self._meta_checked_at = None
+        self._has_source_changed = False
+        # When to try again to refresh the snapshot after a failure.
+        self._retry_refresh_at = None
 
     @property
     def is_cached(self):
         """Returns whether this object holds some cached data."""
-        return bool(self._cache)
+        return bool(self._snapshot and self._snapshot[0])
 
-    def _ensure_cache(self):
-        now = datetime.datetime.utcnow()
-        if self._cached_valid_until and self._cached_valid_until >= now:
-            return self._cache
+    def _load(self):
+        # Get the update date first, so that an import running while we
+        # populate the cache triggers another refresh.
+        updated_at = self._get_updated_at() if self._get_updated_at else None
+        cache = None
+        if updated_at and self._load_snapshot:
+            cache = self._load_snapshot(updated_at)
+        if cache is None:
+            cache = self._create_cache()
+            self._populate(cache)
+        return cache, {}, updated_at
+
+    def _swap(self, loaded, now):
+        cache, derived, updated_at = loaded
         self._cached_valid_until = now + self._cache_duration
-        self._cache = collections.OrderedDict()
-        self._populate(self._cache)
-        return self._cache
+        self._updated_at = updated_at
+        self._meta_checked_at = now
+        self._has_source_changed = False
+        self._retry_refresh_at = None
+        self._snapshot = (cache, derived)
+
+    def _is_stale(self, now):
+        if self._retry_refresh_at and now < self._retry_refresh_at:
+            return False
+        if self._get_updated_at and self._meta_checked_at + _META_CHECK_PERIOD <= now:
+            self._meta_checked_at = now
+            try:
+                if self._get_updated_at() != self._updated_at:
+                    self._has_source_changed = True
+            except pymongo.errors.PyMongoError as error:
+                logging.warning('Could not check whether a collection was updated: %s', error)
+        if self._has_source_changed:
+            return True
+        if self._updated_at is not None:
+            # The source has not changed since the last import.
+            return False
+        return self._cached_valid_until < now
+
+    def _ensure_snapshot(self):
+        snapshot = self._snapshot
+        now = datetime.datetime.utcnow()
+        if snapshot and not self._is_stale(now):
+            return snapshot
+        with self._lock:
+            if not self._snapshot:
+                # Nothing to serve yet: populate synchronously. Other threads
+                # wait for the lock instead of populating it as well.
+                self._swap(self._load(), now)
+            elif self._is_stale(now) and not self._is_refreshing:
+                self._is_refreshing = True
+                _REFRESH_EXECUTOR.submit(self._refresh)
+            return self._snapshot
+
+    def _refresh(self):
+        try:
+            loaded = self._load()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Could not refresh a cached collection')
+            loaded = None
+        with self._lock:
+            now = datetime.datetime.utcnow()
+            if loaded:
+                self._swap(loaded, now)
+            else:
+                self._retry_refresh_at = now + _REFRESH_RETRY_DELAY
+            self._is_refreshing = False
+
+    def _ensure_cache(self):
+        return self._ensure_snapshot()[0]
+
+    def get_derived(self, name, compute):
+        """Get data derived from the cached protos.
+
+        The data is computed only once per refresh of the cache.
+
+        Args:
+            name: a name for the derived data, unique for this collection.
+            compute: a function to compute the derived data from an iterable
+                of all the cached protos.
+        """
+        cache, derived = self._ensure_snapshot()
+        try:
+            return derived[name]
+        except KeyError:
+            derived[name] = compute(cache.values())
+            return derived[name]
 
     def __getattr__(self, prop):
         return getattr(self._ensure_cache(), prop)
 
     def __iter__(self):
         return iter(self.values())
+
+
+def get_collection_updated_at(database, collection_name):
+    """Get the last time a collection was updated by an importer.
+
+    Importers record it in the "meta" collection, see
+    bob_emploi.lib.mongo.Importer.import_in_collection.
+
+    Returns:
+        a datetime or None if the collection was never imported.
+    """
+    meta = database.meta.find_one({'_id': collection_name}, {'updated_at': 1})
+    if not meta:
+        return None
+    return meta.get('updated_at')
+
+
+class MongoCachedDocuments(object):
+    """A bounded cache of protobuffers fetched one by one from MongoDB.
+
+    Contrary to MongoCachedCollection, it does not load a whole collection at
+    once but only the documents that are requested. They are kept across
+    requests until they are evicted (the least recently used first), expire
+    or the importer updates the collection.
+
+    The cached protos are shared: do not modify them.
+    """
+
+    def __init__(
+            self, proto_type, collection_name, max_size=1000,
+            cache_duration=_CACHE_DURATION, load_func=None):
+        """Creates a new cache.
+
+        Args:
+            proto_type: the python proto class for the expected proto type.
+            collection_name: a MongoDB collection_name that holds the original protobuffers.
+            max_size: the maximum number of documents to keep in memory.
+            cache_duration: a timedelta after which a cached document is fetched again.
+            load_func: an optional function to compute the value to cache for
+                a key. It gets the MongoDB collection and the key as
+                parameters. By default the value is the document with this
+                key as "_id" parsed as a proto_type, or an empty proto if
+                there is no such document.
+        """
+        self._collection_name = collection_name
+        self._proto_type = proto_type
+        self._max_size = max_size
+        self._cache_duration = cache_duration
+        self._load_func = load_func or self._load_proto
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._database = None
+        self._updated_at = None
+        self._meta_checked_at = None
+
+    def get_document(self, database, key):
+        """Get the value for a key, fetching it from the database if needed."""
+        now = datetime.datetime.utcnow()
+        self._check_freshness(database, now)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached and cached[1] >= now:
+                self._cache.move_to_end(key)
+                return cached[0]
+
+        value = self._load_func(database.get_collection(self._collection_name), key)
+
+        with self._lock:
+            self._cache[key] = (value, now + self._cache_duration)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_size:
+                self._cache.popitem(last=False)
+        return value
+
+    def reset_cache(self):
+        """Reset any cache that this object could hold."""
+        with self._lock:
+            self._cache.clear()
+            self._database = None
+            self._updated_at = None
+            self._meta_checked_at = None
+
+    def _check_freshness(self, database, now):
+        """Drop the cache if it was populated from another DB or an older import."""
+        if database is not self._database:
+            self.reset_cache()
+            self._database = database
+        elif self._meta_checked_at and self._meta_checked_at + _META_CHECK_PERIOD > now:
+            return
+        self._meta_checked_at = now
+        updated_at = get_collection_updated_at(database, self._collection_name)
+        if updated_at == self._updated_at:
+            return
+        with self._lock:
+            self._cache.clear()
+        self._updated_at = updated_at
+
+    def _load_proto(self, collection, key):
+        value = self._proto_type()
+        parse_from_mongo(collection.find_one({'_id': key}), value)
+        return value
@@ -1,15 +1,27 @@
 """Unit tests for the bob_emploi.frontend.proto module."""
+import copy
 import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 from urllib import parse
 
 import flask
+from google.protobuf import json_format
 import mock
 import mongomock
+import pymongo
 
 from bob_emploi.frontend import proto
 from bob_emploi.frontend.api import action_pb2
+from bob_emploi.frontend.api import commute_pb2
 from bob_emploi.frontend.api import job_pb2
+from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import user_pb2
 
 app = flask.Flask(__name__)  # pylint: disable=invalid-name
 
@@ -155,6 +167,369 @@ class CacheMongoTestCase(unittest.TestCase):
         self.assertEqual(set(['A123', 'A124']), set(cache.keys()))
         self.assertEqual('Job Group 2', cache.get('A124').name)
 
+    def test_derived(self):
+        """Compute derived data only once per refresh of the cache."""
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+        ])
+        compute = mock.MagicMock(side_effect=lambda groups: [g.name for g in groups])
+
+        cache = self._collection.get_collection(self._db)
+        self.assertEqual(['Job Group 1', 'Job Group 2'], cache.get_derived('names', compute))
+        self.assertEqual(['Job Group 1', 'Job Group 2'], cache.get_derived('names', compute))
+        compute.assert_called_once()
+
+        self._db.basic.delete_one({'_id': 'A123'})
+        self._collection.reset_cache()
+        cache = self._collection.get_collection(self._db)
+        self.assertEqual(['Job Group 2'], cache.get_derived('names', compute))
+        self.assertEqual(2, compute.call_count)
+
+
+class LazyCacheMongoTestCase(unittest.TestCase):
+    """Unit tests for the MongoCachedCollection class in lazy mode."""
+
+    def setUp(self):
+        super(LazyCacheMongoTestCase, self).setUp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+        ])
+
+    @mock.patch(proto.__name__ + '.parse_from_mongo', wraps=proto.parse_from_mongo)
+    def test_parse_on_access(self, mock_parse):
+        """Only parse the protos that are accessed."""
+        update_func = mock.MagicMock()
+        collection = proto.MongoCachedCollection(
+            job_pb2.JobGroup, 'basic', update_func=update_func, lazy=True)
+        cache = collection.get_collection(self._db)
+
+        self.assertEqual(['A123', 'A124'], list(cache.keys()))
+        mock_parse.assert_not_called()
+
+        self.assertEqual('Job Group 2', cache.get('A124').name)
+        self.assertIs(cache.get('A124'), cache.get('A124'))
+        mock_parse.assert_called_once()
+        update_func.assert_called_once_with(cache.get('A124'), 'A124')
+        self.assertIsNone(cache.get('A125'))
+
+        self.assertEqual(['A123', 'A124'], [g.rome_id for g in cache])
+        self.assertEqual(2, mock_parse.call_count)
+
+    def test_keep_raw_bson(self):
+        """Keep the raw bytes of documents read as RawBSONDocument."""
+        document = proto.raw_bson.RawBSONDocument(
+            proto.bson.BSON.encode({'_id': 'A123', 'name': 'Job Group 1'}))
+        protos = proto.LazyProtos(job_pb2.JobGroup)
+
+        with mock.patch(proto.bson.__name__ + '.BSON.encode') as mock_encode:
+            protos.add_document('A123', document)
+            self.assertEqual('Job Group 1', protos['A123'].name)
+
+        mock_encode.assert_not_called()
+
+
+@mock.patch(proto.__name__ + '._REFRESH_EXECUTOR')
+@mock.patch(proto.__name__ + '._META_CHECK_PERIOD', datetime.timedelta(0))
+class CacheMongoImporterTestCase(unittest.TestCase):
+    """Unit tests for the MongoCachedCollection class with imported collections."""
+
+    def setUp(self):
+        super(CacheMongoImporterTestCase, self).setUp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_one({'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'})
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime(2017, 9, 1)})
+        self._collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+
+    def test_reload_after_import(self, mock_executor):
+        """Reload the collection when the importer updates it."""
+        self.assertEqual(['A123'], list(self._collection.get_collection(self._db).keys()))
+
+        self._db.basic.insert_one({'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'})
+        self.assertEqual(['A123'], list(self._collection.get_collection(self._db).keys()))
+        mock_executor.submit.assert_not_called()
+
+        self._db.meta.update_one(
+            {'_id': 'basic'}, {'$set': {'updated_at': datetime.datetime(2017, 9, 2)}})
+        self.assertEqual(['A123'], list(self._collection.get_collection(self._db).keys()))
+        mock_executor.submit.assert_called_once()
+
+        mock_executor.submit.call_args[0][0]()
+        self.assertEqual(
+            ['A123', 'A124'], list(self._collection.get_collection(self._db).keys()))
+        mock_executor.submit.assert_called_once()
+
+    def test_no_expiry(self, mock_executor):
+        """Do not reload an imported collection that did not change."""
+        self._collection.get_collection(self._db)
+        # pylint: disable=protected-access
+        self._collection._cache._cached_valid_until = datetime.datetime(2017, 9, 1)
+
+        self._collection.get_collection(self._db).keys()
+        mock_executor.submit.assert_not_called()
+
+        self._db.meta.delete_one({'_id': 'basic'})
+        self._collection.get_collection(self._db).keys()
+        mock_executor.submit.assert_called_once()
+
+    @mock.patch(proto.logging.__name__ + '.warning')
+    def test_meta_unavailable(self, mock_warning, mock_executor):
+        """Keep serving the collection if its import date cannot be checked."""
+        self._collection.get_collection(self._db).keys()
+
+        with mock.patch.object(
+                self._db.meta, 'find_one',
+                side_effect=pymongo.errors.ServerSelectionTimeoutError('Mongo is down')):
+            self.assertEqual(['A123'], list(self._collection.get_collection(self._db).keys()))
+        mock_warning.assert_called_once()
+        mock_executor.submit.assert_not_called()
+
+
+class SnapshotTestCase(unittest.TestCase):
+    """Unit tests for the snapshots of collections shared between processes."""
+
+    def setUp(self):
+        super(SnapshotTestCase, self).setUp()
+        self._tmpdir = tempfile.mkdtemp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+        ])
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime(2017, 9, 1)})
+
+    def tearDown(self):
+        shutil.rmtree(self._tmpdir)
+        super(SnapshotTestCase, self).tearDown()
+
+    def test_write_and_map(self):
+        """Map protos written in a snapshot."""
+        path = os.path.join(self._tmpdir, 'groups.snapshot')
+        proto.write_snapshot(path, [
+            ('A123', job_pb2.JobGroup(rome_id='A123', name='Job Group 1')),
+            ('A124', job_pb2.JobGroup(rome_id='A124')),
+        ])
+
+        protos = proto.MappedProtos(path, job_pb2.JobGroup)
+
+        self.assertEqual(['A123', 'A124'], list(protos))
+        self.assertEqual(2, len(protos))
+        self.assertEqual('Job Group 1', protos['A123'].name)
+        self.assertIs(protos['A123'], protos.get('A123'))
+        self.assertEqual(['A123', 'A124'], [g.rome_id for g in protos.values()])
+        self.assertIsNone(protos.get('unknown'))
+
+    def test_not_a_snapshot(self):
+        """Refuse to map a file that is not a snapshot."""
+        path = os.path.join(self._tmpdir, 'groups.snapshot')
+        with open(path, 'wb') as snapshot_file:
+            snapshot_file.write(b'Not a snapshot file at all')
+
+        with self.assertRaises(ValueError):
+            proto.MappedProtos(path, job_pb2.JobGroup)
+
+    def test_cached_collection(self):
+        """Share a cached collection through a snapshot."""
+        with mock.patch(proto.__name__ + '._SNAPSHOT_DIR', self._tmpdir):
+            collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+            cache = collection.get_collection(self._db)
+            self.assertEqual(['A123', 'A124'], list(cache.keys()))
+            self.assertEqual('Job Group 2', cache.get('A124').name)
+            self.assertEqual(['test.basic.20170901000000000000.snapshot'], os.listdir(self._tmpdir))
+
+            # Another process only maps the snapshot.
+            self._db.basic.delete_one({'_id': 'A123'})
+            other_collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+            self.assertEqual(
+                ['A123', 'A124'], list(other_collection.get_collection(self._db).keys()))
+
+            # A new import replaces the snapshot.
+            self._db.meta.update_one(
+                {'_id': 'basic'}, {'$set': {'updated_at': datetime.datetime(2017, 9, 2)}})
+            other_collection.reset_cache()
+            self.assertEqual(['A124'], list(other_collection.get_collection(self._db).keys()))
+            self.assertEqual(['test.basic.20170902000000000000.snapshot'], os.listdir(self._tmpdir))
+
+    @mock.patch(proto.logging.__name__ + '.warning')
+    def test_old_snapshot_removed_concurrently(self, mock_warning):
+        """Use the new snapshot even if another process removed the old one first."""
+        old_path = os.path.join(self._tmpdir, 'test.basic.20170801000000000000.snapshot')
+        proto.write_snapshot(old_path, [])
+
+        with mock.patch(proto.__name__ + '._SNAPSHOT_DIR', self._tmpdir), \
+                mock.patch(proto.os.__name__ + '.remove') as mock_remove:
+            mock_remove.side_effect = FileNotFoundError(old_path)
+            collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+            cache = collection.get_collection(self._db)
+            self.assertEqual(['A123', 'A124'], list(cache.keys()))
+
+        mock_remove.assert_called_once_with(old_path)
+        self.assertFalse(mock_warning.called)
+
+    @mock.patch(proto.logging.__name__ + '.warning')
+    def test_snapshot_error(self, mock_warning):
+        """Fall back to a cache per process when the snapshot fails."""
+        with mock.patch(proto.__name__ + '._SNAPSHOT_DIR', os.path.join(self._tmpdir, 'missing')):
+            collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+            self.assertEqual(['A123', 'A124'], list(collection.get_collection(self._db).keys()))
+        mock_warning.assert_called_once()
+
+    def test_no_import(self):
+        """Do not snapshot a collection that was not imported."""
+        self._db.meta.delete_one({'_id': 'basic'})
+        with mock.patch(proto.__name__ + '._SNAPSHOT_DIR', self._tmpdir):
+            collection = proto.MongoCachedCollection(job_pb2.JobGroup, 'basic')
+            self.assertEqual(['A123', 'A124'], list(collection.get_collection(self._db).keys()))
+        self.assertFalse(os.listdir(self._tmpdir))
+
+
+class CachedCollectionRefreshTestCase(unittest.TestCase):
+    """Unit tests for the refresh of cached collections."""
+
+    def setUp(self):
+        super(CachedCollectionRefreshTestCase, self).setUp()
+        self._version = 0
+
+    def _populate(self, cache):
+        self._version += 1
+        cache['version'] = self._version
+
+    @mock.patch(proto.__name__ + '._REFRESH_EXECUTOR')
+    def test_refresh_in_background(self, mock_executor):
+        """Serve the expired snapshot while a new one is populated."""
+        # pylint: disable=protected-access
+        collection = proto._MongoCachedCollection(
+            self._populate, cache_duration=datetime.timedelta(0))
+        self.assertEqual([1], list(collection))
+        mock_executor.submit.assert_not_called()
+
+        time.sleep(.001)
+        self.assertEqual([1], list(collection))
+        self.assertEqual([1], list(collection))
+        mock_executor.submit.assert_called_once()
+
+        # Run the refresh.
+        mock_executor.submit.call_args[0][0]()
+        self.assertEqual(2, collection.get('version'))
+
+    @mock.patch(proto.__name__ + '._REFRESH_EXECUTOR')
+    @mock.patch(proto.__name__ + '._REFRESH_RETRY_DELAY', datetime.timedelta(milliseconds=50))
+    @mock.patch(proto.logging.__name__ + '.exception')
+    def test_refresh_error(self, mock_log_exception, mock_executor):
+        """Keep the old snapshot if the refresh fails, and retry later."""
+        populate = mock.MagicMock(side_effect=self._populate)
+        # pylint: disable=protected-access
+        collection = proto._MongoCachedCollection(populate, cache_duration=datetime.timedelta(0))
+        self.assertEqual([1], list(collection))
+        time.sleep(.001)
+        self.assertEqual([1], list(collection))
+
+        populate.side_effect = IOError('Mongo is down')
+        mock_executor.submit.call_args[0][0]()
+        mock_log_exception.assert_called_once()
+
+        self.assertEqual([1], list(collection))
+        mock_executor.submit.assert_called_once()
+
+        time.sleep(.06)
+        self.assertEqual([1], list(collection))
+        self.assertEqual(2, mock_executor.submit.call_count)
+
+    def test_derived_swapped_with_snapshot(self):
+        """Derived data is computed again for a new snapshot."""
+        # pylint: disable=protected-access
+        collection = proto._MongoCachedCollection(self._populate)
+        self.assertEqual([1], collection.get_derived('list', list))
+        collection._refresh()
+        self.assertEqual([2], collection.get_derived('list', list))
+
+    def test_concurrent_first_load(self):
+        """Threads do not race to populate the same collection."""
+        def _slow_populate(cache):
+            time.sleep(.01)
+            self._populate(cache)
+
+        # pylint: disable=protected-access
+        collection = proto._MongoCachedCollection(_slow_populate)
+        threads = [threading.Thread(target=collection.keys) for unused_index in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(1, self._version)
+
+
+class CachedDocumentsTestCase(unittest.TestCase):
+    """Unit tests for the MongoCachedDocuments class."""
+
+    def setUp(self):
+        """Set up mock environment."""
+        super(CachedDocumentsTestCase, self).setUp()
+        self._db = mongomock.MongoClient().get_database('test')
+        self._db.basic.insert_many([
+            {'_id': 'A123', 'romeId': 'A123', 'name': 'Job Group 1'},
+            {'_id': 'A124', 'romeId': 'A124', 'name': 'Job Group 2'},
+        ])
+        self._cache = proto.MongoCachedDocuments(job_pb2.JobGroup, 'basic', max_size=2)
+
+    def test_basic(self):
+        """Test basic usage."""
+        self.assertEqual('Job Group 1', self._cache.get_document(self._db, 'A123').name)
+
+        # Update the collection behind the scene.
+        self._db.basic.update_one({'_id': 'A123'}, {'$set': {'name': 'New name'}})
+        self.assertEqual('Job Group 1', self._cache.get_document(self._db, 'A123').name)
+
+        self._cache.reset_cache()
+        self.assertEqual('New name', self._cache.get_document(self._db, 'A123').name)
+
+    def test_missing_document(self):
+        """Get an empty proto for a missing document."""
+        self.assertEqual(job_pb2.JobGroup(), self._cache.get_document(self._db, 'Z999'))
+
+    def test_least_recently_used(self):
+        """Evict the least recently used document."""
+        self._cache.get_document(self._db, 'A123')
+        self._cache.get_document(self._db, 'A124')
+        self._cache.get_document(self._db, 'A123')
+        self._db.basic.update_many({}, {'$set': {'name': 'New name'}})
+
+        self._cache.get_document(self._db, 'Z999')
+
+        self.assertEqual('Job Group 1', self._cache.get_document(self._db, 'A123').name)
+        self.assertEqual('New name', self._cache.get_document(self._db, 'A124').name)
+
+    def test_other_database(self):
+        """Do not mix documents from different databases."""
+        self._cache.get_document(self._db, 'A123')
+        other_db = mongomock.MongoClient().get_database('test')
+        other_db.basic.insert_one({'_id': 'A123', 'name': 'Other'})
+
+        self.assertEqual('Other', self._cache.get_document(other_db, 'A123').name)
+
+    @mock.patch(proto.__name__ + '._META_CHECK_PERIOD', datetime.timedelta(0))
+    def test_importer_update(self):
+        """Drop the cache when an importer updates the collection."""
+        self._cache.get_document(self._db, 'A123')
+        self._db.basic.update_one({'_id': 'A123'}, {'$set': {'name': 'New name'}})
+        self.assertEqual('Job Group 1', self._cache.get_document(self._db, 'A123').name)
+
+        self._db.meta.insert_one({'_id': 'basic', 'updated_at': datetime.datetime.now()})
+
+        self.assertEqual('New name', self._cache.get_document(self._db, 'A123').name)
+
+    def test_load_func(self):
+        """Cache values computed from the collection."""
+        cache = proto.MongoCachedDocuments(
+            None, 'basic', load_func=lambda collection, key: collection.find({'romeId': {
+                '$regex': '^%s' % key}}).count())
+
+        self.assertEqual(2, cache.get_document(self._db, 'A12'))
+        self.assertEqual(0, cache.get_document(self._db, 'B'))
+
 
 @mock.patch(proto.__name__ + '._IS_TEST_ENV', new=False)
 class ParseFromMongoTestCase(unittest.TestCase):
@@ -189,5 +564,211 @@ class ParseFromMongoTestCase(unittest.TestCase):
         self.assertEqual("{'romeId': 123}", str(mock_warning.call_args[0][3]))
 
 
+@mock.patch(proto.__name__ + '._IS_TEST_ENV', new=False)
+class FastParseFromMongoTestCase(unittest.TestCase):
+    """Unit tests for the fast path of parse_from_mongo."""
+
+    def _assert_same_as_json_format(self, mongo_dict, proto_type):
+        mongo_dict = {k: v for k, v in mongo_dict.items() if not k.startswith('_')}
+        fast_proto = proto_type()
+        slow_proto = proto_type()
+        fast_result = proto.parse_from_mongo(copy.deepcopy(mongo_dict), fast_proto)
+        slow_result = proto._parse_with_json_format(  # pylint: disable=protected-access
+            copy.deepcopy(mongo_dict), slow_proto)
+        self.assertEqual(slow_result, fast_result)
+        self.assertEqual(slow_proto, fast_proto)
+        return fast_proto
+
+    def _load_testdata(self, filename):
+        with open(os.path.join(os.path.dirname(__file__), 'testdata', filename)) as json_file:
+            return json.load(json_file)
+
+    def test_testdata(self):
+        """Same output as json_format on the test data."""
+        for job_group in self._load_testdata('job_group_info.json'):
+            self._assert_same_as_json_format(job_group, job_pb2.JobGroup)
+        for hiring_cities in self._load_testdata('hiring_cities.json'):
+            self._assert_same_as_json_format(hiring_cities, commute_pb2.HiringCities)
+        for local_stats in self._load_testdata('local_diagnosis.json'):
+            self._assert_same_as_json_format(local_stats, job_pb2.LocalJobStats)
+        for persona in self._load_testdata('personas.json').values():
+            self._assert_same_as_json_format(persona['user'], user_pb2.UserProfile)
+            self._assert_same_as_json_format(persona['project'], project_pb2.Project)
+
+    def test_user(self):
+        """Parse a user with timestamps, maps and nested messages."""
+        now = datetime.datetime(2017, 11, 16, 14, 3, 21, 123456)
+        user = self._assert_same_as_json_format({
+            'registeredAt': now,
+            'likes': {'advice': 1},
+            'profile': {'gender': 'FEMININE', 'yearOfBirth': 1982, 'frustrations': ['MOTIVATION']},
+            'projects': [{'projectId': '0', 'createdAt': '2017-11-16T14:03:21Z'}],
+            'emailsSent': [{'sentAt': now, 'mailjetTemplate': '123'}],
+            'unknownField': {'foo': 'bar'},
+        }, user_pb2.User)
+        self.assertEqual(now, user.registered_at.ToDatetime())
+        self.assertEqual(1, user.likes['advice'])
+        self.assertEqual(user_pb2.FEMININE, user.profile.gender)
+        self.assertEqual([user_pb2.MOTIVATION], list(user.profile.frustrations))
+        self.assertEqual('0', user.projects[0].project_id)
+
+    def test_fallback(self):
+        """Values that the fast path cannot handle fall back on json_format."""
+        self._assert_same_as_json_format(
+            {'profile': {'yearOfBirth': None, 'name': 'Pascal'}}, user_pb2.User)
+        self._assert_same_as_json_format(
+            {'registeredAt': datetime.datetime(2017, 11, 16, tzinfo=datetime.timezone.utc)},
+            user_pb2.User)
+        self._assert_same_as_json_format({'profile': {'yearOfBirth': 1982.0}}, user_pb2.User)
+        self._assert_same_as_json_format({'profile': {'gender': 1}}, user_pb2.User)
+
+    @mock.patch(proto.__name__ + '._parse_with_json_format')
+    def test_no_fallback(self, mock_parse_with_json_format):
+        """The fast path handles the common values without json_format."""
+        user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo({
+            'registeredAt': datetime.datetime(2017, 11, 16),
+            'profile': {'gender': 'MASCULINE', 'name': 'Pascal'},
+        }, user))
+        self.assertEqual('Pascal', user.profile.name)
+        mock_parse_with_json_format.assert_not_called()
+
+    @mock.patch(proto.__name__ + '.logging.warning')
+    def test_invalid_enum(self, mock_warning):
+        """Invalid values still raise the json_format errors."""
+        self.assertFalse(proto.parse_from_mongo(
+            {'profile': {'gender': 'UNKNOWN_GENDER_VALUE'}}, user_pb2.User()))
+        mock_warning.assert_called_once()
+
+    def test_unknown_field_in_test_env(self):
+        """Unknown fields still raise an error in the test environment."""
+        with mock.patch(proto.__name__ + '._IS_TEST_ENV', new=True):
+            with self.assertRaises(json_format.ParseError):
+                proto.parse_from_mongo({'profile': {'unknownField': 3}}, user_pb2.User())
+
+
+class BinaryDocumentTestCase(unittest.TestCase):
+    """Unit tests for the to_binary_document function."""
+
+    def test_round_trip(self):
+        """Parse back a proto stored in binary."""
+        user = user_pb2.User(google_id='1234', revision=3)
+        user.profile.name = 'Pascal'
+        user.profile.email = 'pascal@example.com'
+        user.registered_at.FromDatetime(datetime.datetime(2017, 11, 16))
+        user.projects.add(project_id='0', title='Project')
+
+        document = proto.to_binary_document(
+            user, ('facebook_id', 'google_id', 'profile.email', 'registered_at'))
+
+        self.assertEqual(
+            {'_partialFields', '_proto', 'googleId', 'profile', 'registeredAt'}, set(document))
+        self.assertEqual({'email': 'pascal@example.com'}, document['profile'])
+        self.assertEqual('2017-11-16T00:00:00Z', document['registeredAt'])
+
+        parsed_user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(document, parsed_user))
+        self.assertEqual(user, parsed_user)
+
+    def test_partial_update(self):
+        """JSON fields of a binary document override the binary values."""
+        user = user_pb2.User(google_id='1234')
+        user.features_enabled.advisor = user_pb2.ACTIVE
+        user.likes['landing'] = 1
+        document = proto.to_binary_document(user, ('features_enabled',))
+        document['featuresEnabled']['netPromoterScoreEmail'] = 'NPS_EMAIL_SENT'
+        document['likes'] = {'landing': 1, 'dashboard': -1}
+
+        parsed_user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(document, parsed_user))
+        self.assertEqual('1234', parsed_user.google_id)
+        self.assertEqual(user_pb2.ACTIVE, parsed_user.features_enabled.advisor)
+        self.assertEqual(
+            user_pb2.NPS_EMAIL_SENT, parsed_user.features_enabled.net_promoter_score_email)
+        self.assertEqual({'landing': 1, 'dashboard': -1}, dict(parsed_user.likes))
+
+    def test_replace_fields(self):
+        """JSON fields of a binary document replace the binary values."""
+        user = user_pb2.User()
+        user.profile.name = 'Pascal'
+        user.profile.email = 'pascal@example.com'
+        user.features_enabled.advisor = user_pb2.ACTIVE
+        user.features_enabled.switched_from_mashup_to_advisor = True
+        user.emails_sent.add(mailjet_template='1')
+        document = proto.to_binary_document(user, ('features_enabled', 'profile.email'))
+        document['featuresEnabled'] = {'advisor': 'ACTIVE'}
+        document['emailsSent'] = [{'mailjetTemplate': '1'}, {'mailjetTemplate': '2'}]
+        document['profile']['email'] = 'pascal@bayes.org'
+
+        parsed_user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(document, parsed_user))
+        self.assertEqual(
+            user_pb2.Features(advisor=user_pb2.ACTIVE), parsed_user.features_enabled)
+        self.assertEqual(['1', '2'], [e.mailjet_template for e in parsed_user.emails_sent])
+        # Only the email of the profile is indexed: the rest is kept.
+        self.assertEqual('Pascal', parsed_user.profile.name)
+        self.assertEqual('pascal@bayes.org', parsed_user.profile.email)
+
+    def test_not_binary(self):
+        """Ignore a proto field that does not hold bytes."""
+        user = user_pb2.User()
+        self.assertTrue(proto.parse_from_mongo(
+            {'_proto': mock.MagicMock(), 'googleId': '1234'}, user))
+        self.assertEqual(user_pb2.User(google_id='1234'), user)
+
+    @mock.patch(proto.__name__ + '._IS_TEST_ENV', new=False)
+    @mock.patch(proto.__name__ + '.logging.warning')
+    def test_corrupted_binary(self, mock_warning):
+        """Corrupted binary documents are not parsed."""
+        self.assertFalse(proto.parse_from_mongo({'_proto': b'\xff\xff'}, user_pb2.User()))
+        mock_warning.assert_called_once()
+
+
+class GetMongoUpdateTestCase(unittest.TestCase):
+    """Unit tests for the get_mongo_update function."""
+
+    def test_same_documents(self):
+        """No update when nothing changed."""
+        self.assertEqual({}, proto.get_mongo_update(
+            {'_id': 'a', 'name': 'A', 'list': [1, 2]}, {'name': 'A', 'list': [1, 2]}))
+
+    def test_nested_changes(self):
+        """Only set the fields that changed."""
+        update = proto.get_mongo_update(
+            {
+                '_id': 'a',
+                'profile': {'name': 'Pascal', 'city': 'Lyon'},
+                'projects': [{'title': 'A', 'feedback': {'score': 1}}, {'title': 'B'}],
+                'revision': 3,
+            },
+            {
+                'profile': {'name': 'Pascal', 'email': 'pascal@example.com'},
+                'projects': [{'title': 'A', 'feedback': {'score': 5}}, {'title': 'B'}],
+                'revision': 4,
+            })
+        self.assertEqual({
+            '$set': {
+                'profile.email': 'pascal@example.com',
+                'projects.0.feedback.score': 5,
+                'revision': 4,
+            },
+            '$unset': {'profile.city': ''},
+        }, update)
+
+    def test_list_size_changed(self):
+        """Set the whole list when its size changed."""
+        self.assertEqual(
+            {'$set': {'projects': [{'title': 'A'}, {'title': 'B'}]}},
+            proto.get_mongo_update(
+                {'projects': [{'title': 'A'}]},
+                {'projects': [{'title': 'A'}, {'title': 'B'}]}))
+
+    def test_unsafe_keys(self):
+        """Set the whole dict when its keys cannot be used in a path."""
+        self.assertEqual(
+            {'$set': {'likes': {'a.b': 1, 'c': 2}}},
+            proto.get_mongo_update({'likes': {'a.b': 1}}, {'likes': {'a.b': 1, 'c': 2}}))
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
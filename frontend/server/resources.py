@@ -0,0 +1,159 @@
+"""Endpoints for the resources of a project: associations, job boards, etc."""
+import itertools
+import logging
+import random
+
+import flask
+
+from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import application_pb2
+from bob_emploi.frontend.api import association_pb2
+from bob_emploi.frontend.api import commute_pb2
+from bob_emploi.frontend.api import event_pb2
+from bob_emploi.frontend.api import jobboard_pb2
+from bob_emploi.frontend.api import project_resources_pb2
+
+
+def _list_associations(scoring_project):
+    associations = scoring_project.list_associations()
+    sorted_associations = sorted(associations, key=lambda j: (-len(j.filters), random.random()))
+    return association_pb2.Associations(associations=sorted_associations)
+
+
+def _list_events(scoring_project):
+    events = scoring_project.list_events()
+    sorted_events = sorted(events, key=lambda j: (j.start_date, -len(j.filters), random.random()))
+    return event_pb2.Events(events=sorted_events)
+
+
+def _list_interview_tips(scoring_project):
+    interview_tips = scoring_project.list_application_tips()
+    sorted_tips = sorted(interview_tips, key=lambda t: (-len(t.filters), random.random()))
+    tips_proto = application_pb2.InterviewTips(
+        qualities=[t for t in sorted_tips if t.type == application_pb2.QUALITY],
+        preparations=[
+            t for t in sorted_tips
+            if t.type == application_pb2.INTERVIEW_PREPARATION])
+    for tip in itertools.chain(tips_proto.qualities, tips_proto.preparations):
+        tip.ClearField('type')
+    return tips_proto
+
+
+def _list_jobboards(scoring_project):
+    jobboards = scoring_project.list_jobboards()
+    sorted_jobboards = sorted(jobboards, key=lambda j: (-len(j.filters), random.random()))
+    return jobboard_pb2.JobBoards(job_boards=sorted_jobboards)
+
+
+def _list_resume_tips(scoring_project):
+    resume_tips = scoring_project.list_application_tips()
+    sorted_tips = sorted(resume_tips, key=lambda t: (-len(t.filters), random.random()))
+    tips_proto = application_pb2.ResumeTips(
+        qualities=[t for t in sorted_tips if t.type == application_pb2.QUALITY],
+        improvements=[t for t in sorted_tips if t.type == application_pb2.CV_IMPROVEMENT])
+    for tip in itertools.chain(tips_proto.qualities, tips_proto.improvements):
+        tip.ClearField('type')
+    return tips_proto
+
+
+def _list_commuting_cities(scoring_project):
+    return commute_pb2.CommutingCities(cities=scoring_project.list_nearby_cities())
+
+
+# Resources of a project, keyed by the name used in their endpoint. Values are
+# the field of the ProjectResources proto to populate, and the function to
+# compute them from a ScoringProject.
+_PROJECT_RESOURCES = {
+    'associations': ('associations', _list_associations),
+    'commute': ('commute', _list_commuting_cities),
+    'events': ('events', _list_events),
+    'interview-tips': ('interview_tips', _list_interview_tips),
+    'jobboards': ('job_boards', _list_jobboards),
+    'resume-tips': ('resume_tips', _list_resume_tips),
+    'volunteer': ('volunteer', lambda scoring_project: scoring_project.volunteering_missions()),
+}
+
+
+def create_blueprint(get_scoring_project):
+    """Create the blueprint of the project resources endpoints.
+
+    Args:
+        get_scoring_project: a function to get the ScoringProject for a user
+            ID and a project ID.
+    Returns:
+        a flask Blueprint to register with the "/api/project" prefix.
+    """
+    app = flask.Blueprint('resources', __name__)  # pylint: disable=invalid-name
+
+    def _get_project_resource(user_id, project_id, resource):
+        return _PROJECT_RESOURCES[resource][1](get_scoring_project(user_id, project_id))
+
+    @app.route('/<user_id>/<project_id>/associations', methods=['GET'])
+    @proto.flask_api(out_type=association_pb2.Associations)
+    def project_associations(user_id, project_id):
+        """Retrieve a list of associations for a project."""
+        return _get_project_resource(user_id, project_id, 'associations')
+
+    @app.route('/<user_id>/<project_id>/events', methods=['GET'])
+    @proto.flask_api(out_type=event_pb2.Events)
+    def project_events(user_id, project_id):
+        """Retrieve a list of associations for a project."""
+        return _get_project_resource(user_id, project_id, 'events')
+
+    @app.route('/<user_id>/<project_id>/interview-tips', methods=['GET'])
+    @proto.flask_api(out_type=application_pb2.InterviewTips)
+    def project_interview_tips(user_id, project_id):
+        """Retrieve a list of interview tips for a project."""
+        return _get_project_resource(user_id, project_id, 'interview-tips')
+
+    @app.route('/<user_id>/<project_id>/jobboards', methods=['GET'])
+    @proto.flask_api(out_type=jobboard_pb2.JobBoards)
+    def project_jobboards(user_id, project_id):
+        """Retrieve a list of job boards for a project."""
+        return _get_project_resource(user_id, project_id, 'jobboards')
+
+    @app.route('/<user_id>/<project_id>/resume-tips', methods=['GET'])
+    @proto.flask_api(out_type=application_pb2.ResumeTips)
+    def project_resume_tips(user_id, project_id):
+        """Retrieve a list of resume tips for a project."""
+        return _get_project_resource(user_id, project_id, 'resume-tips')
+
+    @app.route('/<user_id>/<project_id>/volunteer', methods=['GET'])
+    @proto.flask_api(out_type=association_pb2.VolunteeringMissions)
+    def project_volunteer(user_id, project_id):
+        """Retrieve a list of job boards for a project."""
+        return _get_project_resource(user_id, project_id, 'volunteer')
+
+    @app.route('/<user_id>/<project_id>/commute', methods=['GET'])
+    @proto.flask_api(out_type=commute_pb2.CommutingCities)
+    def project_commute(user_id, project_id):
+        """Retrieve a list of commuting cities for a project."""
+        return _get_project_resource(user_id, project_id, 'commute')
+
+    @app.route('/<user_id>/<project_id>/resources', methods=['POST'])
+    @proto.flask_api(
+        in_type=project_resources_pb2.ProjectResourcesRequest,
+        out_type=project_resources_pb2.ProjectResources)
+    def project_resources(request, user_id, project_id):
+        """Retrieve several resources of a project at once.
+
+        They are all computed with the same ScoringProject, so the market data
+        is only fetched once. A resource that fails is reported in the errors
+        field without failing the others.
+        """
+        scoring_project = get_scoring_project(user_id, project_id)
+        response = project_resources_pb2.ProjectResources()
+        for resource in request.resources:
+            try:
+                field, compute = _PROJECT_RESOURCES[resource]
+            except KeyError:
+                response.errors.add(resource=resource, message='Ressource inconnue.')
+                continue
+            try:
+                getattr(response, field).CopyFrom(compute(scoring_project))
+            except Exception as error:  # pylint: disable=broad-except
+                logging.exception('Error while computing the %s of a project', resource)
+                response.errors.add(resource=resource, message=str(error))
+        return response
+
+    return app
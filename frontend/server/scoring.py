@@ -4,12 +4,23 @@
 See design doc at http://go/pe:scoring-chantiers.
 """
 import collections
+from concurrent import futures
 import datetime
 import itertools
 import logging
 import math
+import os
 import random
 import re
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    # The NumPy engine to find commuting cities is optional: without NumPy we
+    # fall back to the grid index.
+    numpy = None
 
 from bob_emploi.frontend import companies
 from bob_emploi.frontend import proto
@@ -23,6 +34,7 @@ from bob_emploi.frontend.api import geo_pb2
 from bob_emploi.frontend.api import job_pb2
 from bob_emploi.frontend.api import jobboard_pb2
 from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import stats_pb2
 from bob_emploi.frontend.api import training_pb2
 from bob_emploi.frontend.api import user_pb2
 
@@ -61,6 +73,25 @@ _EVENTS = proto.MongoCachedCollection(event_pb2.Event, 'events')
 _SPECIFIC_TO_JOB_ADVICE = proto.MongoCachedCollection(
     advisor_pb2.DynamicAdvice, 'specific_to_job_advice')
 
+# Cache of local diagnosis keyed by "<departement_id>:<rome_id>".
+_LOCAL_DIAGNOSIS = proto.MongoCachedDocuments(
+    job_pb2.LocalJobStats, 'local_diagnosis', max_size=5000)
+
+# Cache of job group info keyed by ROME ID.
+_JOB_GROUP_INFO = proto.MongoCachedDocuments(job_pb2.JobGroup, 'job_group_info', max_size=1000)
+
+# Number of threads used to prefetch concurrently the market data of a
+# project. Set it to 0 to disable the prefetching and only fetch data lazily.
+_PREFETCH_THREADS = int(os.getenv('SCORING_PREFETCH_THREADS', '6'))
+
+_PREFETCH_EXECUTOR = \
+    futures.ThreadPoolExecutor(max_workers=_PREFETCH_THREADS) if _PREFETCH_THREADS else None
+
+# Engine used to find the cities close to a project's city: "grid" for a
+# spatial index, or "numpy" for a vectorized scan of all the hiring cities.
+# NumPy is only installed in the test image, to benchmark both engines.
+_COMMUTE_ENGINE = os.getenv('COMMUTE_ENGINE', 'grid')
+
 # Distance below which the city is so close that it is obvious.
 _MIN_CITY_DISTANCE = 8
 
@@ -175,6 +206,45 @@ _ALL_DEPARTEMENTS = {
 }
 
 
+_DepartementsRanking = collections.namedtuple(
+    'DepartementsRanking', ['sorted_offers', 'offers'])
+
+
+def _rank_departements(local_diagnosis, rome_id):
+    """Rank all the départements by their number of job offers for a job group.
+
+    Args:
+        local_diagnosis: the MongoDB collection of local diagnosis.
+        rome_id: the ID of the job group.
+    Returns:
+        a _DepartementsRanking with a list of (departement_id, offers) tuples
+        sorted by decreasing number of offers, and a dict of the number of
+        offers keyed by departement_id.
+    """
+    local_stats_ids = {
+        ('%s:%s' % (departement_id, rome_id)): departement_id
+        for departement_id in _ALL_DEPARTEMENTS}
+
+    local_stats = local_diagnosis.find(
+        {'_id': {'$in': list(local_stats_ids)}},
+        {'imt.yearlyAvgOffersPer10Candidates': 1})
+
+    departement_to_offers = {}
+    for departement_local_stats in local_stats:
+        departement_id = local_stats_ids[departement_local_stats['_id']]
+        departement_to_offers[departement_id] = \
+            departement_local_stats.get('imt', {}).get('yearlyAvgOffersPer10Candidates', 0) or 0
+
+    return _DepartementsRanking(
+        sorted_offers=sorted(departement_to_offers.items(), key=lambda x: x[1], reverse=True),
+        offers=departement_to_offers)
+
+
+# Cache of the départements ranking keyed by ROME ID.
+_DEPARTEMENTS_RANKING = proto.MongoCachedDocuments(
+    None, 'local_diagnosis', max_size=1000, load_func=_rank_departements)
+
+
 def compute_square_distance(city_a, city_b):
     """Compute the approximative distance between two cities.
 
@@ -191,6 +261,136 @@ def compute_square_distance(city_a, city_b):
     return delta_x * delta_x + delta_y * delta_y
 
 
+class _HiringCitiesIndex(object):
+    """A spatial index of the cities hiring for a job group.
+
+    The cities are bucketed in a grid of square cells of _MAX_CITY_DISTANCE km
+    on the same projection as compute_square_distance: all the cities that are
+    closer than _MAX_CITY_DISTANCE to a point are in the 3x3 cells around it.
+    """
+
+    def __init__(self, hiring_cities):
+        self.hiring_cities = hiring_cities
+        self._cells = collections.defaultdict(list)
+        self._offers_per_inhabitant = {}
+        for index, hiring_city in enumerate(hiring_cities):
+            self._cells[self._get_cell(hiring_city.city)].append(index)
+            if hiring_city.city.population:
+                self._offers_per_inhabitant.setdefault(
+                    hiring_city.city.city_id, hiring_city.offers / hiring_city.city.population)
+
+    @staticmethod
+    def _get_cell(city):
+        return (
+            math.floor(city.longitude * 73 / _MAX_CITY_DISTANCE),
+            math.floor(city.latitude * 111 / _MAX_CITY_DISTANCE))
+
+    def offers_per_inhabitant(self, city_id):
+        """Get the number of offers per inhabitant in a city, or 0 if it is not hiring."""
+        return self._offers_per_inhabitant.get(city_id, 0)
+
+    def list_close_cities(self, target_city):
+        """List the hiring cities closer than _MAX_CITY_DISTANCE to a city.
+
+        Yields:
+            a tuple with a HiringCity proto and its distance in km to the
+            target city, in the same order as in the hiring_cities list.
+        """
+        cell_x, cell_y = self._get_cell(target_city)
+        indices = sorted(itertools.chain.from_iterable(
+            self._cells.get((cell_x + delta_x, cell_y + delta_y), [])
+            for delta_x in (-1, 0, 1) for delta_y in (-1, 0, 1)))
+        for index in indices:
+            hiring_city = self.hiring_cities[index]
+            distance = math.sqrt(compute_square_distance(hiring_city.city, target_city))
+            if distance < _MAX_CITY_DISTANCE:
+                yield hiring_city, distance
+
+    def list_commuting_cities(self, target_city):
+        """List the hiring cities closer than _MAX_CITY_DISTANCE to a city.
+
+        Yields:
+            a CommutingCity proto for each close city, in the same order as in
+            the hiring_cities list.
+        """
+        # Get the reference offers per inhabitant.
+        ref = self.offers_per_inhabitant(target_city.city_id)
+
+        for hiring_city, distance in self.list_close_cities(target_city):
+            try:
+                relative_offers = (hiring_city.offers / hiring_city.city.population) / ref
+            except ZeroDivisionError:
+                relative_offers = 0
+
+            yield commute_pb2.CommutingCity(
+                name=hiring_city.city.name,
+                relative_offers_per_inhabitant=relative_offers,
+                distance_km=distance)
+
+
+class _HiringCitiesArrays(object):
+    """Columnar NumPy arrays of the cities hiring for a job group.
+
+    This is an alternative to _HiringCitiesIndex that computes the distances
+    and relative offers of all the hiring cities in one vectorized pass.
+    """
+
+    def __init__(self, hiring_cities):
+        self.hiring_cities = hiring_cities
+        self._latitudes = numpy.array([h.city.latitude for h in hiring_cities], dtype=float)
+        self._longitudes = numpy.array([h.city.longitude for h in hiring_cities], dtype=float)
+        offers = numpy.array([h.offers for h in hiring_cities], dtype=float)
+        populations = numpy.array([h.city.population for h in hiring_cities], dtype=float)
+        self._offers_per_inhabitant = numpy.divide(
+            offers, populations, out=numpy.zeros_like(offers), where=populations > 0)
+        self._offers_per_inhabitant_by_city = {}
+        for hiring_city, offers_per_inhabitant in zip(hiring_cities, self._offers_per_inhabitant):
+            if hiring_city.city.population:
+                self._offers_per_inhabitant_by_city.setdefault(
+                    hiring_city.city.city_id, float(offers_per_inhabitant))
+
+    def offers_per_inhabitant(self, city_id):
+        """Get the number of offers per inhabitant in a city, or 0 if it is not hiring."""
+        return self._offers_per_inhabitant_by_city.get(city_id, 0)
+
+    def list_commuting_cities(self, target_city):
+        """List the hiring cities closer than _MAX_CITY_DISTANCE to a city.
+
+        Yields:
+            a CommutingCity proto for each close city, in the same order as in
+            the hiring_cities list.
+        """
+        delta_y = (self._latitudes - target_city.latitude) * 111
+        delta_x = (self._longitudes - target_city.longitude) * 73
+        distances = numpy.sqrt(delta_x * delta_x + delta_y * delta_y)
+        close_indices = numpy.flatnonzero(distances < _MAX_CITY_DISTANCE)
+
+        ref = self.offers_per_inhabitant(target_city.city_id)
+        if ref:
+            relative_offers = self._offers_per_inhabitant[close_indices] / ref
+        else:
+            relative_offers = numpy.zeros(len(close_indices))
+
+        for index, relative_offer in zip(close_indices, relative_offers):
+            yield commute_pb2.CommutingCity(
+                name=self.hiring_cities[index].city.name,
+                relative_offers_per_inhabitant=relative_offer,
+                distance_km=distances[index])
+
+
+def _index_hiring_cities(hiring_cities_collection, rome_id):
+    all_cities = commute_pb2.HiringCities()
+    proto.parse_from_mongo(hiring_cities_collection.find_one({'_id': rome_id}), all_cities)
+    if _COMMUTE_ENGINE == 'numpy' and numpy:
+        return _HiringCitiesArrays(all_cities.hiring_cities)
+    return _HiringCitiesIndex(all_cities.hiring_cities)
+
+
+# Cache of the hiring cities spatial indices keyed by ROME ID.
+_HIRING_CITIES = proto.MongoCachedDocuments(
+    None, 'hiring_cities', max_size=1000, load_func=_index_hiring_cities)
+
+
 def is_city_quite_close(city_a, city_b):
     """Return true if the city is not too far for commute, but not too close to be obvious."""
     square_distance = compute_square_distance(city_a, city_b)
@@ -212,6 +412,18 @@ class ScoringProject(object):
     responsible to make them accessible to the scoring function.
     """
 
+    # Methods that read market data from MongoDB. They only depend on the
+    # project's job group, département and city, so they can be called
+    # concurrently to prefetch all the data before scoring.
+    _MARKET_DATA_ACCESSORS = (
+        'local_diagnosis',
+        'job_group_info',
+        '_get_hiring_cities',
+        '_get_target_city',
+        'volunteering_missions',
+        'find_best_departements',
+    )
+
     def __init__(self, project, user_profile, features_enabled, database, now=None):
         self.details = project
         self.user_profile = user_profile
@@ -225,6 +437,8 @@ class ScoringProject(object):
         self._jobboards = None
         self._associations = None
         self._nearby_cities = None
+        self._hiring_cities = None
+        self._target_city = None
         self._application_tips = None
         self._trainings = None
         self._volunteering_missions = None
@@ -235,19 +449,39 @@ class ScoringProject(object):
     # project requirements from job offers, IMT, median unemployment duration
     # from FHS, etc.
 
+    def prefetch(self, accessors=None):
+        """Fetch concurrently the market data that the scoring models need.
+
+        Each accessor populates its own cache, so once this method returns,
+        the scoring models can access the data without any round-trip to
+        MongoDB. If a fetch fails, the error is logged and the data will be
+        fetched again lazily when needed.
+
+        Args:
+            accessors: names of the methods to call to populate the cache. By
+                default all the ones reading market data from MongoDB.
+        """
+        if not _PREFETCH_EXECUTOR:
+            return
+        if accessors is None:
+            accessors = self._MARKET_DATA_ACCESSORS
+        pending = [
+            _PREFETCH_EXECUTOR.submit(getattr(self, accessor)) for accessor in accessors]
+        for future in futures.as_completed(pending):
+            error = future.exception()
+            if error:
+                logging.warning('Error while prefetching market data: %s', error)
+
     def local_diagnosis(self):
         """Get local stats for the project's job group and département."""
         if self._local_diagnosis is not None:
             return self._local_diagnosis
 
-        self._local_diagnosis = job_pb2.LocalJobStats()
         local_id = '%s:%s' % (
             self.details.mobility.city.departement_id,
             self.details.target_job.job_group.rome_id)
-        # TODO(pascal): Handle when return is False (no data).
-        proto.parse_from_mongo(
-            self._db.local_diagnosis.find_one({'_id': local_id}), self._local_diagnosis)
-
+        # TODO(pascal): Handle when there is no data.
+        self._local_diagnosis = _LOCAL_DIAGNOSIS.get_document(self._db, local_id)
         return self._local_diagnosis
 
     def imt_proto(self):
@@ -273,10 +507,7 @@ class ScoringProject(object):
         if self._job_group_info is not None:
             return self._job_group_info
 
-        self._job_group_info = job_pb2.JobGroup()
-        proto.parse_from_mongo(
-            self._db.job_group_info.find_one({'_id': self._rome_id()}),
-            self._job_group_info)
+        self._job_group_info = _JOB_GROUP_INFO.get_document(self._db, self._rome_id())
         return self._job_group_info
 
     def requirements(self):
@@ -300,7 +531,7 @@ class ScoringProject(object):
             return self._jobboards
 
         all_job_boards = _JOB_BOARDS.get_collection(self._db)
-        self._jobboards = list(filter_using_score(all_job_boards, lambda j: j.filters, self))
+        self._jobboards = list(_filter_cached_collection(all_job_boards, self))
         return self._jobboards
 
     def list_associations(self):
@@ -309,7 +540,7 @@ class ScoringProject(object):
             return self._associations
 
         all_associations = _ASSOCIATIONS.get_collection(self._db)
-        self._associations = list(filter_using_score(all_associations, lambda j: j.filters, self))
+        self._associations = list(_filter_cached_collection(all_associations, self))
         return self._associations
 
     def find_best_departements(self):
@@ -317,73 +548,35 @@ class ScoringProject(object):
         if self._best_departements is not None:
             return self._best_departements
 
-        # TODO(pascal): Should we use the cache system described here :
-        # https://docs.python.org/3/library/functools.html ?
-
-        job_group = self.details.target_job.job_group.rome_id
-
-        local_stats_ids = {('%s:%s' % (departement_id, job_group)): departement_id
-                           for departement_id in _ALL_DEPARTEMENTS}
-
-        local_stats = self._db.local_diagnosis.find({'_id': {'$in': list(local_stats_ids)}})
-
-        departement_to_offers = {}
-        for departement_local_stats in local_stats:
-            departement_id = local_stats_ids[departement_local_stats['_id']]
-            departement_to_offers[departement_id] = \
-                departement_local_stats.get('imt', {}).get('yearlyAvgOffersPer10Candidates', 0) or 0
+        ranking = _DEPARTEMENTS_RANKING.get_document(self._db, self._rome_id())
 
         # If we do not have data about our own departement, we chose not to say anything.
         own_departement = self.details.mobility.city.departement_id
 
         # We only advice departements that are better than own departement.
-        min_offers = departement_to_offers.get(own_departement, 0)
+        min_offers = ranking.offers.get(own_departement, 0)
 
         if not min_offers:
             self._best_departements = []
             return self._best_departements
 
-        # Compute the score for each departement.
-        sorted_departements = sorted(
-            departement_to_offers.items(), key=lambda x: x[1], reverse=True)
-
-        # Get only departements that are strictly better than own departement.
-        top_departements = [
-            project_pb2.DepartementScore(name=_ALL_DEPARTEMENTS[dep[0]],
-                                         offer_ratio=dep[1] / min_offers)
-            for dep in sorted_departements if dep[1] > min_offers]
-
-        # Return at most 10 departements
-        self._best_departements = top_departements[0:10]
+        # Get only departements that are strictly better than own departement,
+        # and at most 10 of them.
+        better_departements = itertools.takewhile(
+            lambda dep: dep[1] > min_offers, ranking.sorted_offers)
+        self._best_departements = [
+            project_pb2.DepartementScore(
+                name=_ALL_DEPARTEMENTS[departement_id], offer_ratio=offers / min_offers)
+            for departement_id, offers in itertools.islice(better_departements, 10)]
         return self._best_departements
 
-    def _get_commuting_cities(self, interesting_cities_for_rome, target_city):
-        # Get the reference offers per inhabitant.
-
-        ref = next((h.offers / h.city.population
-                    for h in interesting_cities_for_rome
-                    if h.city.city_id == target_city.city_id and h.city.population), 0)
-
-        for hiring_city in interesting_cities_for_rome:
-            distance = math.sqrt(compute_square_distance(hiring_city.city, target_city))
-
-            if distance < _MAX_CITY_DISTANCE:
-                try:
-                    relative_offers = (hiring_city.offers / hiring_city.city.population) / ref
-                except ZeroDivisionError:
-                    relative_offers = 0
-
-                yield commute_pb2.CommutingCity(
-                    name=hiring_city.city.name,
-                    relative_offers_per_inhabitant=relative_offers,
-                    distance_km=distance)
-
     def get_trainings(self):
         """Get the training opportunities from our partner's API."""
         if self._trainings is not None:
             return self._trainings
         self._trainings = carif.get_trainings(
-            self.details.target_job.job_group.rome_id, self.details.mobility.city.departement_id)
+            self.details.target_job.job_group.rome_id, self.details.mobility.city.departement_id,
+            self._db)
         return self._trainings
 
     def get_seasonal_departements(self):
@@ -401,23 +594,16 @@ class ScoringProject(object):
             return self._nearby_cities
         self._nearby_cities = []
 
-        job_group = self.details.target_job.job_group.rome_id
-
-        all_cities = commute_pb2.HiringCities()
-        proto.parse_from_mongo(self._db.hiring_cities.find_one({'_id': job_group}), all_cities)
-        interesting_cities_for_rome = all_cities.hiring_cities
+        hiring_cities_index = self._get_hiring_cities()
 
-        if not interesting_cities_for_rome:
+        if not hiring_cities_index.hiring_cities:
             return []
 
-        target_city = geo_pb2.FrenchCity()
-        mongo_city = self._db.cities.find_one({'_id': self.details.mobility.city.city_id})
-        if not mongo_city:
+        target_city = self._get_target_city()
+        if not target_city:
             return []
-        proto.parse_from_mongo(mongo_city, target_city)
 
-        commuting_cities = list(
-            self._get_commuting_cities(interesting_cities_for_rome, target_city))
+        commuting_cities = list(hiring_cities_index.list_commuting_cities(target_city))
 
         obvious_cities = [
             city for city in commuting_cities
@@ -435,6 +621,27 @@ class ScoringProject(object):
         self._nearby_cities = interesting_cities
         return self._nearby_cities
 
+    def _get_hiring_cities(self):
+        """Get the spatial index of the cities hiring for the project's job group."""
+        if self._hiring_cities is not None:
+            return self._hiring_cities
+
+        self._hiring_cities = _HIRING_CITIES.get_document(self._db, self._rome_id())
+        return self._hiring_cities
+
+    def _get_target_city(self):
+        """Get the project's city from DB, or False if it is unknown."""
+        if self._target_city is not None:
+            return self._target_city
+
+        target_city = geo_pb2.FrenchCity()
+        if not proto.parse_from_mongo(
+                self._db.cities.find_one({'_id': self.details.mobility.city.city_id}),
+                target_city):
+            target_city = False
+        self._target_city = target_city
+        return self._target_city
+
     def volunteering_missions(self):
         """Return a list of volunteering mission close to the project."""
         if self._volunteering_missions is not None:
@@ -466,8 +673,7 @@ class ScoringProject(object):
             return self._application_tips
 
         all_application_tips = _APPLICATION_TIPS.get_collection(self._db)
-        self._application_tips = list(filter_using_score(
-            all_application_tips, lambda j: j.filters, self))
+        self._application_tips = list(_filter_cached_collection(all_application_tips, self))
         return self._application_tips
 
     def list_events(self):
@@ -478,14 +684,15 @@ class ScoringProject(object):
         if self._events:
             return self._events
         today = self.now.strftime('%Y-%m-%d')
-        all_events = [e for e in _EVENTS.get_collection(self._db) if e.start_date >= today]
-        self._events = list(filter_using_score(all_events, lambda e: e.filters, self))
+        self._events = [
+            e for e in _filter_cached_collection(_EVENTS.get_collection(self._db), self)
+            if e.start_date >= today]
         return self._events
 
     def specific_to_job_advice_config(self):
         """Find the first specific to job advice config that matches this project."""
         _configs = _SPECIFIC_TO_JOB_ADVICE.get_collection(self._db)
-        return next(filter_using_score(_configs, lambda c: c.filters, self), None)
+        return next(_filter_cached_collection(_configs, self), None)
 
 
 class _ScoringModelBase(object):
@@ -500,6 +707,11 @@ class _ScoringModelBase(object):
     # If we do standard computation across models, add it here and use this one
     # as a base class.
 
+    # Names of the ScoringProject methods that fetch the data this model needs
+    # from MongoDB or from external APIs, so that they can be prefetched
+    # concurrently before scoring.
+    accessors = ()
+
     def score(self, unused_project):
         """Compute a score for the given ScoringProject.
 
@@ -511,6 +723,8 @@ class _ScoringModelBase(object):
 class _AdviceEventScoringModel(_ScoringModelBase):
     """A scoring model for Advice that user needs to go to events."""
 
+    accessors = ('job_group_info',)
+
     def score(self, project):
         application_modes = project.job_group_info().application_modes.values()
         first_modes = set(fap_modes.modes[0].mode for fap_modes in application_modes)
@@ -531,6 +745,8 @@ class _AdviceEventScoringModel(_ScoringModelBase):
 class _ImproveYourNetworkScoringModel(_ScoringModelBase):
     """A scoring model for Advice that user needs to improve their network."""
 
+    accessors = ('job_group_info',)
+
     def __init__(self, network_level):
         self._network_level = network_level
 
@@ -562,6 +778,8 @@ class ConstantScoreModel(_ScoringModelBase):
 class _AdviceTrainingScoringModel(_ScoringModelBase):
     """A scoring model for the training advice."""
 
+    accessors = ('get_trainings',)
+
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
         return training_pb2.Trainings(trainings=project.get_trainings())
@@ -649,6 +867,8 @@ class _AdviceSpecificToJob(_ScoringModelBase):
 class _SpontaneousApplicationScoringModel(_ScoringModelBase):
     """A scoring model for the "Send spontaneous applications" advice module."""
 
+    accessors = ('job_group_info',)
+
     def score(self, project):
         """Compute a score for the given ScoringProject."""
         application_modes = project.job_group_info().application_modes.values()
@@ -813,6 +1033,7 @@ class _NegateFilter(_ScoringModelBase):
         self.negated_filter = get_scoring_model(negated_filter_name)
         if self.negated_filter is None:
             return None
+        self.accessors = self.negated_filter.accessors
         return self
 
     def score(self, project):
@@ -823,6 +1044,8 @@ class _NegateFilter(_ScoringModelBase):
 class _ApplicationComplexityFilter(_ScoringModelBase):
     """A scoring model to filter on job group application complexity."""
 
+    accessors = ('job_group_info',)
+
     def __init__(self, application_complexity):
         super(_ApplicationComplexityFilter, self).__init__()
         self._application_complexity = application_complexity
@@ -837,6 +1060,8 @@ class _ApplicationComplexityFilter(_ScoringModelBase):
 class _AdviceOtherWorkEnv(_ScoringModelBase):
     """A scoring model to trigger the "Other Work Environment" Advice."""
 
+    accessors = ('job_group_info',)
+
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
         return project_pb2.OtherWorkEnvAdviceData(
@@ -920,6 +1145,8 @@ class _AdviceLessApplications(_ScoringModelBase):
 class _AdviceVolunteer(_ScoringModelBase):
     """A scoring model to trigger the "Try volunteering" Advice."""
 
+    accessors = ('volunteering_missions',)
+
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
         association_names = [m.association_name for m in project.volunteering_missions().missions]
@@ -943,6 +1170,8 @@ class _AdviceVolunteer(_ScoringModelBase):
 class _AdviceImproveInterview(_ScoringModelBase):
     """A scoring model to trigger the "Improve your interview skills" advice."""
 
+    accessors = ('job_group_info',)
+
     _NUM_INTERVIEWS = {
         project_pb2.LESS_THAN_2: 0,
         project_pb2.SOME: 1,
@@ -982,6 +1211,8 @@ class _AdviceImproveInterview(_ScoringModelBase):
 class _AdviceBetterJobInGroup(_ScoringModelBase):
     """A scoring model to trigger the "Change to better job in your job group" advice."""
 
+    accessors = ('job_group_info',)
+
     def score(self, project):
         """Compute a score for the given ScoringProject."""
         specific_jobs = project.requirements().specific_jobs
@@ -1038,6 +1269,8 @@ class _AdviceBetterJobInGroup(_ScoringModelBase):
 class _AdviceImproveResume(_ScoringModelBase):
     """A scoring model to trigger the "Improve your resume to get more interviews" advice."""
 
+    accessors = ('job_group_info', 'local_diagnosis')
+
     _APPLICATION_PER_WEEK = {
         project_pb2.LESS_THAN_2: 0,
         project_pb2.SOME: 2,
@@ -1090,6 +1323,8 @@ class _AdviceImproveResume(_ScoringModelBase):
 class _AdviceFreshResume(_ProjectFilter):
     """A scoring model to trigger the "To start, prepare your resume" advice."""
 
+    accessors = ('job_group_info',)
+
     def __init__(self):
         super(_AdviceFreshResume, self).__init__(self._should_trigger)
 
@@ -1141,6 +1376,8 @@ class _AdviceJobBoards(_LowPriorityAdvice):
 class _AdviceRelocateScoringModel(_ScoringModelBase):
     """A scoring model to trigger the "Relocate" advice."""
 
+    accessors = ('find_best_departements',)
+
     def compute_extra_data(self, project):
         """Compute extra data for this module."""
         return project_pb2.RelocateData(departement_scores=project.find_best_departements())
@@ -1159,6 +1396,8 @@ class _AdviceRelocateScoringModel(_ScoringModelBase):
 class _AdviceCommuteScoringModel(_ScoringModelBase):
     """A scoring model to trigger the "Commute" advice."""
 
+    accessors = ('_get_hiring_cities', '_get_target_city')
+
     def compute_extra_data(self, project):
         """Compute extra data for this module to render a card in the client."""
         return project_pb2.CommuteData(cities=[c.name for c in project.list_nearby_cities()])
@@ -1199,6 +1438,122 @@ class _AdviceAssociationHelp(_ScoringModelBase):
         return project_pb2.AssociationsData(association_name=sorted_associations[0].name)
 
 
+# Whether to record the time spent in each scoring model. When disabled,
+# get_scoring_model returns the scoring models themselves so that recording the
+# stats has no overhead at all.
+_STATS_ENABLED = bool(os.getenv('SCORING_STATS_ENABLED'))
+
+# The methods of the scoring models that are timed when recording stats.
+_TIMED_METHODS = frozenset(('compute_extra_data', 'get_advice_override', 'score'))
+
+
+class _ScoringStats(object):
+    """Call counters and timings of the scoring models, per model name."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Calls count, total and max durations, keyed by model and method names.
+        self._methods = {}
+        self._cache_hits = collections.Counter()
+        self._timed_models = {}
+
+    def get_timed_model(self, scoring_model_name, scoring_model, is_cache_hit):
+        """Get a proxy to a scoring model that records its stats."""
+        with self._lock:
+            if is_cache_hit:
+                self._cache_hits[scoring_model_name] += 1
+            timed_model = self._timed_models.get(scoring_model_name)
+            # The proxies are kept so that a given model is always represented
+            # by the same object, e.g. in the filter plans.
+            # pylint: disable=protected-access
+            if timed_model is None or timed_model._scoring_model is not scoring_model:
+                timed_model = _TimedScoringModel(scoring_model_name, scoring_model)
+                self._timed_models[scoring_model_name] = timed_model
+            return timed_model
+
+    def record(self, scoring_model_name, method_name, duration):
+        """Record a call to a method of a scoring model."""
+        key = (scoring_model_name, method_name)
+        with self._lock:
+            call_count, total_duration, max_duration = self._methods.get(key, (0, 0, 0))
+            self._methods[key] = (
+                call_count + 1, total_duration + duration, max(max_duration, duration))
+
+    def reset(self):
+        """Forget all the recorded stats."""
+        with self._lock:
+            self._methods.clear()
+            self._cache_hits.clear()
+
+    def to_proto(self):
+        """Export the stats as a ScoringStats proto."""
+        stats = stats_pb2.ScoringStats(enabled=_STATS_ENABLED)
+        models = {}
+        with self._lock:
+            for scoring_model_name, cache_hit_count in self._cache_hits.items():
+                models[scoring_model_name] = stats_pb2.ScoringModelStats(
+                    scoring_model_name=scoring_model_name, cache_hit_count=cache_hit_count)
+            for (scoring_model_name, method_name), values in sorted(self._methods.items()):
+                model = models.get(scoring_model_name)
+                if not model:
+                    model = stats_pb2.ScoringModelStats(scoring_model_name=scoring_model_name)
+                    models[scoring_model_name] = model
+                call_count, total_duration, max_duration = values
+                model.methods.add(
+                    method_name=method_name, call_count=call_count,
+                    total_duration_seconds=total_duration, max_duration_seconds=max_duration)
+                model.total_duration_seconds += total_duration
+        stats.scoring_models.extend(sorted(
+            models.values(),
+            key=lambda model: (-model.total_duration_seconds, model.scoring_model_name)))
+        return stats
+
+
+class _TimedScoringModel(object):
+    """A proxy to a scoring model that records the time spent in its methods."""
+
+    def __init__(self, scoring_model_name, scoring_model):
+        self._scoring_model_name = scoring_model_name
+        self._scoring_model = scoring_model
+
+    def __getattr__(self, name):
+        value = getattr(self._scoring_model, name)
+        if name not in _TIMED_METHODS:
+            return value
+
+        def _timed_method(*args, **kwargs):
+            start = time.time()
+            try:
+                return value(*args, **kwargs)
+            finally:
+                _STATS.record(self._scoring_model_name, name, time.time() - start)
+        return _timed_method
+
+
+_STATS = _ScoringStats()
+
+
+def get_stats():
+    """Get the stats recorded for the scoring models, see SCORING_STATS_ENABLED."""
+    return _STATS.to_proto()
+
+
+def reset_stats():
+    """Reset the stats recorded for the scoring models."""
+    _STATS.reset()
+
+
+def enable_stats(enabled=True):
+    """Enable or disable the recording of the stats of the scoring models.
+
+    The compiled filter plans keep the scoring models they were compiled with,
+    so the caches are cleared to compile them again.
+    """
+    global _STATS_ENABLED  # pylint: disable=global-statement
+    _STATS_ENABLED = enabled
+    clear_cache()
+
+
 _ScoringModelRegexp = collections.namedtuple('ScoringModelRegexp', ['regexp', 'constructor'])
 
 
@@ -1225,7 +1580,10 @@ _SCORING_MODEL_REGEXPS = (
 def get_scoring_model(scoring_model_name):
     """Get a scoring model by its name, may generate it if needed and possible."""
     if scoring_model_name in SCORING_MODELS:
-        return SCORING_MODELS[scoring_model_name]
+        scoring_model = SCORING_MODELS[scoring_model_name]
+        if _STATS_ENABLED:
+            return _STATS.get_timed_model(scoring_model_name, scoring_model, is_cache_hit=True)
+        return scoring_model
 
     for regexp, constructor in _SCORING_MODEL_REGEXPS:
         job_group_match = regexp.match(scoring_model_name)
@@ -1233,6 +1591,9 @@ def get_scoring_model(scoring_model_name):
             scoring_model = constructor(job_group_match.group(1))
             if scoring_model:
                 SCORING_MODELS[scoring_model_name] = scoring_model
+                if _STATS_ENABLED:
+                    return _STATS.get_timed_model(
+                        scoring_model_name, scoring_model, is_cache_hit=False)
             return scoring_model
 
     return None
@@ -1299,48 +1660,98 @@ SCORING_MODELS = {
 }
 
 
-class _Scorer(object):
-    """Helper to compute the scores of multiple models for a given project."""
+class _FilterPlan(object):
+    """A compiled plan to evaluate the filters of a list of items.
 
-    def __init__(self, project):
-        self._project = project
-        # A cache of scores keyed by scoring model names.
-        self._scores = {}
+    Each distinct scoring model is resolved once and associated with a bitset
+    of the items that use it as a filter. Filtering the items for a project
+    then costs one score per distinct model instead of one per item and
+    filter: models are evaluated from the cheapest to the most expensive, and
+    skipped once all the items they filter are already excluded.
+    """
 
-    def _get_score(self, scoring_model_name):
-        if scoring_model_name in self._scores:
-            return self._scores[scoring_model_name]
+    def __init__(self, filters_per_item):
+        """Compiles a plan.
 
-        scoring_model = get_scoring_model(scoring_model_name)
-        if scoring_model is None:
-            logging.warning(
-                'Scoring model "%s" unknown, falling back to default.', scoring_model_name)
-            score = self._get_score('')
-            self._scores[scoring_model_name] = score
-            return score
+        Args:
+            filters_per_item: a list with the list of filters of each item.
+        """
+        self.num_items = len(filters_per_item)
+        self._all_items = (1 << self.num_items) - 1
+        items_per_model = collections.OrderedDict()
+        for index, filters in enumerate(filters_per_item):
+            for filter_name in filters:
+                scoring_model = _get_filter_model(filter_name)
+                items_per_model[scoring_model] = \
+                    items_per_model.get(scoring_model, 0) | (1 << index)
+        self._models = sorted(
+            items_per_model.items(),
+            key=lambda model_items: (
+                len(getattr(model_items[0], 'accessors', ())), -bin(model_items[1]).count('1')))
+
+    def apply(self, project):
+        """Apply the filters to the project.
 
-        score = scoring_model.score(self._project)
-        if scoring_model_name:
-            self._scores[scoring_model_name] = score
-        return score
+        Returns:
+            a bitset of the items that pass all their filters.
+        """
+        passing = self._all_items
+        for scoring_model, items in self._models:
+            if not passing & items:
+                continue
+            if scoring_model.score(project) <= 0:
+                passing &= ~items
+        return passing
 
+    def iterate_passing(self, items, project):
+        """Iterate over the items that pass all their filters."""
+        passing = self.apply(project)
+        for index, item in enumerate(items):
+            if passing & (1 << index):
+                yield item
 
-class _FilterHelper(_Scorer):
-    """A helper object to cache scoring in the filter function."""
 
-    def apply(self, filters):
-        """Apply all filters to the project.
+def _get_filter_model(filter_name):
+    scoring_model = get_scoring_model(filter_name)
+    if scoring_model is None:
+        logging.warning('Scoring model "%s" unknown, falling back to default.', filter_name)
+        return get_scoring_model('')
+    return scoring_model
+
+
+def _compile_filters(items):
+    items = list(items)
+    return items, _FilterPlan([item.filters for item in items])
 
-        Returns:
-            False if any of the filters returned a negative value for the
-            project. True if there are no filters.
-        """
-        return all(self._get_score(f) > 0 for f in filters)
+
+def _filter_cached_collection(cached_collection, project):
+    """Filter a cached collection of protos with a "filters" field.
+
+    The evaluation plan is compiled only once per refresh of the cache.
+    """
+    items, plan = cached_collection.get_derived('filter_plan', _compile_filters)
+    return plan.iterate_passing(items, project)
+
+
+def clear_cache():
+    """Clear all caches for this module."""
+    _JOB_BOARDS.reset_cache()
+    _ASSOCIATIONS.reset_cache()
+    _APPLICATION_TIPS.reset_cache()
+    _EVENTS.reset_cache()
+    _SPECIFIC_TO_JOB_ADVICE.reset_cache()
+    _LOCAL_DIAGNOSIS.reset_cache()
+    _JOB_GROUP_INFO.reset_cache()
+    _DEPARTEMENTS_RANKING.reset_cache()
+    _HIRING_CITIES.reset_cache()
 
 
 def filter_using_score(iterable, get_scoring_func, project):
     """Filter the elements of an iterable using scores.
 
+    To filter a cached collection of protos many times, prefer
+    _filter_cached_collection that compiles its filters only once.
+
     Args:
         iterable: an iterable of objects on which this function will iterate at
             most once.
@@ -1351,7 +1762,6 @@ def filter_using_score(iterable, get_scoring_func, project):
     Yield:
         an item from iterable if it passes the filters.
     """
-    helper = _FilterHelper(project)
-    for item in iterable:
-        if helper.apply(get_scoring_func(item)):
-            yield item
+    items = list(iterable)
+    plan = _FilterPlan([get_scoring_func(item) for item in items])
+    return plan.iterate_passing(items, project)
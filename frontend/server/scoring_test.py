@@ -12,6 +12,7 @@ import mongomock
 
 from bob_emploi.frontend import scoring
 from bob_emploi.frontend import proto
+from bob_emploi.frontend.api import commute_pb2
 from bob_emploi.frontend.api import geo_pb2
 from bob_emploi.frontend.api import job_pb2
 from bob_emploi.frontend.api import project_pb2
@@ -249,7 +250,7 @@ class TrainingAdviceScoringModelTestCase(ScoringModelTestBase('advice-training')
         if self.persona.project.kind == project_pb2.REORIENTATION:
             self.persona.project.kind = project_pb2.FIND_JOB
         self.assertGreater(2, self._score_persona(self.persona))
-        mock_carif_get_trainings.assert_called_once_with('A1234', '35')
+        mock_carif_get_trainings.assert_called_once_with('A1234', '35', self.database)
 
     @mock.patch(scoring.carif.__name__ + '.get_trainings')
     def test_three_stars(self, mock_carif_get_trainings):
@@ -514,6 +515,180 @@ class CommuteScoringModelTestCase(ScoringModelTestBase('advice-commute')):
         self.assertGreater(len(result.cities), 1, msg='Failed for "%s"' % self.persona.name)
 
 
+class RelocateScoringModelTestCase(ScoringModelTestBase('advice-relocate')):
+    """Unit tests for the "Relocate" scoring model."""
+
+    def setUp(self):
+        super(RelocateScoringModelTestCase, self).setUp()
+        self.persona = self._random_persona().clone()
+        self.persona.project.target_job.job_group.rome_id = 'M1604'
+        self.persona.project.mobility.city.departement_id = '69'
+        self.persona.project.mobility.area_type = geo_pb2.COUNTRY
+        self.database.local_diagnosis.insert_many([
+            {'_id': '69:M1604', 'imt': {'yearlyAvgOffersPer10Candidates': 2}},
+            {'_id': '31:M1604', 'imt': {'yearlyAvgOffersPer10Candidates': 3}},
+            {'_id': '75:M1604', 'imt': {'yearlyAvgOffersPer10Candidates': 8}},
+            {'_id': '13:M1604', 'imt': {'yearlyAvgOffersPer10Candidates': 1}},
+            {'_id': '38:M1604'},
+            {'_id': '75:A1234', 'imt': {'yearlyAvgOffersPer10Candidates': 20}},
+        ])
+
+    def test_better_departements(self):
+        """Recommend the départements with more offers."""
+        score = self._score_persona(self.persona)
+        self.assertEqual(2, score, msg='Failed for "%s"' % self.persona.name)
+
+        project = self.persona.scoring_project(self.database)
+        result = self.model.compute_extra_data(project)
+        self.assertEqual(
+            [('Paris', 4), ('Haute-Garonne', 1.5)],
+            [(d.name, d.offer_ratio) for d in result.departement_scores])
+
+    def test_best_departement(self):
+        """Nothing to recommend when already in the best département."""
+        self.persona.project.mobility.city.departement_id = '75'
+        score = self._score_persona(self.persona)
+        self.assertEqual(0, score, msg='Failed for "%s"' % self.persona.name)
+
+    def test_no_local_data(self):
+        """Nothing to recommend without data about the own département."""
+        self.persona.project.mobility.city.departement_id = '38'
+        score = self._score_persona(self.persona)
+        self.assertEqual(0, score, msg='Failed for "%s"' % self.persona.name)
+
+    def test_at_most_ten(self):
+        """Recommend at most 10 départements."""
+        self.database.local_diagnosis.insert_many([
+            {'_id': '%d:M1604' % index, 'imt': {'yearlyAvgOffersPer10Candidates': 10 + index}}
+            for index in range(40, 60)])
+        project = self.persona.scoring_project(self.database)
+        result = self.model.compute_extra_data(project)
+        self.assertEqual(
+            ['Nord', 'Nièvre', 'Moselle', 'Morbihan', 'Meuse', 'Meurthe-et-Moselle', 'Mayenne',
+             'Haute-Marne', 'Marne', 'Manche'],
+            [d.name for d in result.departement_scores])
+        self.assertEqual(34.5, result.departement_scores[0].offer_ratio)
+
+    def test_not_mobile(self):
+        """Do not recommend to relocate to people who do not want to move."""
+        self.persona.project.mobility.area_type = geo_pb2.CITY
+        score = self._score_persona(self.persona)
+        self.assertEqual(0, score, msg='Failed for "%s"' % self.persona.name)
+
+
+class HiringCitiesIndexTestCase(unittest.TestCase):
+    """Unit tests for the spatial index of hiring cities."""
+
+    def test_same_as_full_scan(self):
+        """The index finds the same cities as a full scan."""
+        randomizer = random.Random(42)
+        hiring_cities = [
+            commute_pb2.HiringCity(offers=randomizer.randint(0, 100), city=geo_pb2.FrenchCity(
+                city_id='%05d' % index,
+                latitude=randomizer.uniform(44, 46),
+                longitude=randomizer.uniform(3, 6),
+                population=randomizer.randint(0, 10000)))
+            for index in range(2000)]
+        index = scoring._HiringCitiesIndex(hiring_cities)  # pylint: disable=protected-access
+
+        for target in hiring_cities[:20]:
+            expected = [
+                (hiring_city.city.city_id, scoring.compute_square_distance(
+                    hiring_city.city, target.city))
+                for hiring_city in hiring_cities
+                if scoring.compute_square_distance(hiring_city.city, target.city) < 35 * 35]
+            close_cities = [
+                (hiring_city.city.city_id, distance * distance)
+                for hiring_city, distance in index.list_close_cities(target.city)]
+            self.assertEqual([c[0] for c in expected], [c[0] for c in close_cities])
+            for (unused_id, expected_distance), (unused_id, distance) in zip(
+                    expected, close_cities):
+                self.assertAlmostEqual(expected_distance, distance)
+
+    def test_offers_per_inhabitant(self):
+        """Get the offers per inhabitant of a hiring city."""
+        index = scoring._HiringCitiesIndex([  # pylint: disable=protected-access
+            commute_pb2.HiringCity(offers=10, city=geo_pb2.FrenchCity(city_id='69123')),
+            commute_pb2.HiringCity(
+                offers=10, city=geo_pb2.FrenchCity(city_id='69123', population=1000)),
+            commute_pb2.HiringCity(
+                offers=20, city=geo_pb2.FrenchCity(city_id='69123', population=1000)),
+        ])
+
+        self.assertEqual(.01, index.offers_per_inhabitant('69123'))
+        self.assertEqual(0, index.offers_per_inhabitant('31555'))
+
+
+@unittest.skipUnless(scoring.numpy, 'NumPy is not installed')
+class HiringCitiesArraysTestCase(unittest.TestCase):
+    """Unit tests for the NumPy engine to find commuting cities."""
+
+    def test_same_as_index(self):
+        """The arrays find the same commuting cities as the spatial index."""
+        randomizer = random.Random(42)
+        hiring_cities = [
+            commute_pb2.HiringCity(offers=randomizer.randint(0, 100), city=geo_pb2.FrenchCity(
+                city_id='%05d' % index,
+                name='City %d' % index,
+                latitude=randomizer.uniform(44, 46),
+                longitude=randomizer.uniform(3, 6),
+                population=randomizer.randint(0, 10000)))
+            for index in range(2000)]
+        # pylint: disable=protected-access
+        index = scoring._HiringCitiesIndex(hiring_cities)
+        arrays = scoring._HiringCitiesArrays(hiring_cities)
+
+        for target in hiring_cities[:20]:
+            expected = list(index.list_commuting_cities(target.city))
+            commuting_cities = list(arrays.list_commuting_cities(target.city))
+            self.assertEqual([c.name for c in expected], [c.name for c in commuting_cities])
+            for expected_city, city in zip(expected, commuting_cities):
+                self.assertAlmostEqual(expected_city.distance_km, city.distance_km, places=3)
+                self.assertAlmostEqual(
+                    expected_city.relative_offers_per_inhabitant,
+                    city.relative_offers_per_inhabitant, places=3)
+
+    def test_offers_per_inhabitant(self):
+        """Get the offers per inhabitant of a hiring city."""
+        arrays = scoring._HiringCitiesArrays([  # pylint: disable=protected-access
+            commute_pb2.HiringCity(offers=10, city=geo_pb2.FrenchCity(city_id='69123')),
+            commute_pb2.HiringCity(
+                offers=10, city=geo_pb2.FrenchCity(city_id='69123', population=1000)),
+            commute_pb2.HiringCity(
+                offers=20, city=geo_pb2.FrenchCity(city_id='69123', population=1000)),
+        ])
+
+        self.assertEqual(.01, arrays.offers_per_inhabitant('69123'))
+        self.assertEqual(0, arrays.offers_per_inhabitant('31555'))
+
+    def test_not_hiring_in_target_city(self):
+        """Relative offers are 0 when the target city is not hiring."""
+        arrays = scoring._HiringCitiesArrays([  # pylint: disable=protected-access
+            commute_pb2.HiringCity(offers=10, city=geo_pb2.FrenchCity(
+                city_id='69266', name='Villeurbanne', latitude=45.77, longitude=4.88,
+                population=1000)),
+        ])
+
+        commuting_cities = list(arrays.list_commuting_cities(
+            geo_pb2.FrenchCity(city_id='69123', latitude=45.75, longitude=4.85)))
+
+        self.assertEqual(['Villeurbanne'], [c.name for c in commuting_cities])
+        self.assertEqual(0, commuting_cities[0].relative_offers_per_inhabitant)
+
+    @mock.patch(scoring.__name__ + '._COMMUTE_ENGINE', 'numpy')
+    def test_engine_selection(self):
+        """The NumPy engine is used when selected."""
+        database = mongomock.MongoClient().test
+        database.hiring_cities.insert_one({'_id': 'M1604', 'hiringCities': [
+            {'offers': 3, 'city': {'cityId': '69123', 'latitude': 45.75, 'longitude': 4.85}},
+        ]})
+
+        # pylint: disable=protected-access
+        engine = scoring._index_hiring_cities(database.hiring_cities, 'M1604')
+
+        self.assertIsInstance(engine, scoring._HiringCitiesArrays)
+
+
 class PersonasTestCase(unittest.TestCase):
     """Tests all scoring models and all personas."""
 
@@ -567,6 +742,229 @@ class PersonasTestCase(unittest.TestCase):
                 msg='Model "%s" has the same score for all personas.' % model_name)
 
 
+class FilterCachedCollectionTestCase(unittest.TestCase):
+    """Unit tests for the filtering of cached collections."""
+
+    def setUp(self):
+        super(FilterCachedCollectionTestCase, self).setUp()
+        scoring.clear_cache()
+        self.database = mongomock.MongoClient().test
+        self.database.jobboards.insert_many([
+            {'title': 'Indeed', 'filters': []},
+            {'title': 'Pôle emploi', 'filters': ['for-departement(69)']},
+            {'title': 'APEC', 'filters': ['for-departement(75)', 'for-job-group(M16)']},
+        ])
+
+    def test_compile_once(self):
+        """Compile the filters of a collection only once."""
+        persona = _PERSONAS['mover'].clone()
+        persona.project.mobility.city.departement_id = '69'
+        other_persona = _PERSONAS['mover'].clone()
+        other_persona.project.mobility.city.departement_id = '75'
+        other_persona.project.target_job.job_group.rome_id = 'M1604'
+
+        with mock.patch(
+                scoring.__name__ + '._compile_filters',
+                wraps=scoring._compile_filters) as mock_compile:  # pylint: disable=protected-access
+            jobboards = persona.scoring_project(self.database).list_jobboards()
+            other_jobboards = other_persona.scoring_project(self.database).list_jobboards()
+
+        self.assertEqual(['Indeed', 'Pôle emploi'], [j.title for j in jobboards])
+        self.assertEqual(['Indeed', 'APEC'], [j.title for j in other_jobboards])
+        mock_compile.assert_called_once()
+
+
+@mock.patch(scoring.__name__ + '._STATS_ENABLED', new=True)
+class ScoringStatsTestCase(unittest.TestCase):
+    """Unit tests for the stats of the scoring models."""
+
+    def setUp(self):
+        super(ScoringStatsTestCase, self).setUp()
+        scoring.reset_stats()
+        self.database = mongomock.MongoClient().test
+
+    def test_record_calls(self):
+        """Record the calls to each scoring model."""
+        project = _PERSONAS['malek'].scoring_project(self.database)
+        for unused_index in range(3):
+            scoring.get_scoring_model('constant(2)').score(project)
+        scoring.get_scoring_model('not-for-women').score(project)
+
+        stats = scoring.get_stats()
+
+        self.assertTrue(stats.enabled)
+        models = {model.scoring_model_name: model for model in stats.scoring_models}
+        self.assertEqual({'constant(2)', 'not-for-women', 'for-women'}, set(models))
+        self.assertEqual(['score'], [m.method_name for m in models['constant(2)'].methods])
+        self.assertEqual(3, models['constant(2)'].methods[0].call_count)
+        self.assertLessEqual(
+            models['constant(2)'].methods[0].max_duration_seconds,
+            models['constant(2)'].methods[0].total_duration_seconds)
+        # The negated filter is timed as well.
+        self.assertEqual(1, models['for-women'].methods[0].call_count)
+        self.assertGreaterEqual(
+            models['not-for-women'].total_duration_seconds,
+            models['for-women'].total_duration_seconds)
+        self.assertEqual(
+            [model.scoring_model_name for model in stats.scoring_models],
+            sorted(
+                models, key=lambda name: (-models[name].total_duration_seconds, name)))
+
+    def test_cache_hits(self):
+        """Count the scoring models found in the registry."""
+        scoring.get_scoring_model('advice-commute')
+        scoring.get_scoring_model('advice-commute')
+
+        stats = scoring.get_stats()
+
+        self.assertEqual(
+            [('advice-commute', 2)],
+            [(m.scoring_model_name, m.cache_hit_count) for m in stats.scoring_models])
+
+    def test_same_proxy(self):
+        """Always use the same proxy for a given scoring model."""
+        self.assertIs(
+            scoring.get_scoring_model('advice-commute'),
+            scoring.get_scoring_model('advice-commute'))
+
+    def test_missing_method(self):
+        """Do not add methods to the scoring models."""
+        scoring_model = scoring.get_scoring_model('advice-senior')
+        with self.assertRaises(AttributeError):
+            scoring_model.compute_extra_data  # pylint: disable=pointless-statement
+
+    def test_reset(self):
+        """Reset the stats."""
+        scoring.get_scoring_model('advice-commute')
+        scoring.reset_stats()
+        self.assertFalse(scoring.get_stats().scoring_models)
+
+    def test_disabled(self):
+        """Do not wrap the scoring models when the stats are disabled."""
+        with mock.patch(scoring.__name__ + '._STATS_ENABLED', new=False):
+            self.assertIs(
+                scoring.SCORING_MODELS['advice-commute'],
+                scoring.get_scoring_model('advice-commute'))
+        self.assertFalse(scoring.get_stats().scoring_models)
+
+
+class ScoringProjectPrefetchTestCase(unittest.TestCase):
+    """Unit tests for the prefetch method of ScoringProject."""
+
+    def setUp(self):
+        super(ScoringProjectPrefetchTestCase, self).setUp()
+        self.database = mongomock.MongoClient().test
+        _load_json_to_mongo(self.database, 'job_group_info')
+        _load_json_to_mongo(self.database, 'local_diagnosis')
+        _load_json_to_mongo(self.database, 'volunteering_missions')
+        _load_json_to_mongo(self.database, 'hiring_cities')
+        _load_json_to_mongo(self.database, 'cities')
+        self.persona = _PERSONAS['mover'].clone()
+        self.persona.project.target_job.job_group.rome_id = 'M1604'
+        self.persona.project.mobility.city.departement_id = '69'
+        self.persona.project.mobility.city.city_id = '69123'
+
+    def test_no_more_db_access(self):
+        """Once prefetched, the market data is available without the DB."""
+        project = self.persona.scoring_project(self.database)
+        project.prefetch()
+        expected = self.persona.scoring_project(self.database)
+
+        # pylint: disable=protected-access
+        project._db = mock.MagicMock()
+        self.assertEqual(expected.local_diagnosis(), project.local_diagnosis())
+        self.assertEqual(expected.job_group_info(), project.job_group_info())
+        self.assertEqual(expected.list_nearby_cities(), project.list_nearby_cities())
+        self.assertEqual(expected.volunteering_missions(), project.volunteering_missions())
+        self.assertEqual(expected.find_best_departements(), project.find_best_departements())
+        self.assertFalse(project._db.mock_calls)
+
+    def test_some_accessors(self):
+        """Only prefetch some of the market data."""
+        project = self.persona.scoring_project(self.database)
+        project.prefetch(['job_group_info'])
+
+        # pylint: disable=protected-access
+        project._db = mock.MagicMock()
+        project.job_group_info()
+        self.assertFalse(project._db.mock_calls)
+        project.local_diagnosis()
+        self.assertTrue(project._db.mock_calls)
+
+    @mock.patch(scoring.logging.__name__ + '.warning')
+    def test_prefetch_error(self, mock_warning):
+        """An error while prefetching is only logged."""
+        project = self.persona.scoring_project(mock.MagicMock())
+        # pylint: disable=protected-access
+        project._db.cities.find_one.side_effect = IOError('Mongo is down')
+
+        project.prefetch(['_get_target_city'])
+
+        mock_warning.assert_called_once()
+        self.assertEqual('Mongo is down', str(mock_warning.call_args[0][1]))
+        with self.assertRaises(IOError):
+            project._get_target_city()
+
+    def test_models_accessors(self):
+        """Scoring models only declare existing accessors."""
+        for model_name, model in scoring.SCORING_MODELS.items():
+            for accessor in model.accessors:
+                self.assertTrue(
+                    callable(getattr(scoring.ScoringProject, accessor, None)),
+                    msg='"%s" needs an unknown accessor "%s"' % (model_name, accessor))
+
+    @mock.patch(scoring.carif.__name__ + '.get_trainings')
+    def test_models_declare_their_accessors(self, mock_get_trainings):
+        """Scoring models declare all the accessors they use."""
+        mock_get_trainings.return_value = [training_pb2.Training()]
+        # pylint: disable=protected-access
+        tracked_accessors = scoring.ScoringProject._MARKET_DATA_ACCESSORS + ('get_trainings',)
+        now = datetime.datetime(2016, 9, 27)
+        for model_name in scoring.SCORING_MODELS:
+            model = scoring.get_scoring_model(model_name)
+            for persona_name, persona in _PERSONAS.items():
+                project = persona.scoring_project(self.database, now=now)
+                accessor_mocks = {}
+                for accessor in tracked_accessors:
+                    accessor_mocks[accessor] = mock.MagicMock(wraps=getattr(project, accessor))
+                    setattr(project, accessor, accessor_mocks[accessor])
+
+                model.score(project)
+                if hasattr(model, 'compute_extra_data'):
+                    model.compute_extra_data(project)
+
+                used_accessors = {
+                    accessor for accessor, accessor_mock in accessor_mocks.items()
+                    if accessor_mock.called}
+                self.assertLessEqual(
+                    used_accessors, set(model.accessors),
+                    msg='Model "%s" uses undeclared accessors for persona "%s"' % (
+                        model_name, persona_name))
+
+    @mock.patch(scoring.carif.__name__ + '.get_trainings')
+    def test_prefetch_models_accessors(self, mock_get_trainings):
+        """Once their data is prefetched, the scoring models do not block on I/O."""
+        mock_get_trainings.return_value = [training_pb2.Training()]
+        project = self.persona.scoring_project(self.database)
+        project.prefetch(['get_trainings', 'job_group_info'])
+        mock_get_trainings.reset_mock()
+        project._db = None  # pylint: disable=protected-access
+
+        scoring.get_scoring_model('advice-training').score(project)
+        scoring.get_scoring_model('advice-other-work-env').score(project)
+        scoring.get_scoring_model('not-for-complex-application').score(project)
+
+        mock_get_trainings.assert_not_called()
+
+    @mock.patch(scoring.__name__ + '._PREFETCH_EXECUTOR', new=None)
+    def test_disabled(self):
+        """Prefetching can be disabled."""
+        database = mock.MagicMock()
+        project = self.persona.scoring_project(database)
+        project.prefetch()
+        self.assertFalse(database.mock_calls)
+
+
 class LifeBalanceTestCase(ScoringModelTestBase('advice-life-balance')):
     """Unit tests for the "Work/Life balance" advice."""
 
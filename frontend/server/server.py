@@ -12,7 +12,6 @@ import hashlib
 import itertools
 import logging
 import os
-import random
 import re
 import time
 from urllib import parse
@@ -30,21 +29,22 @@ from werkzeug.contrib import fixers
 from bob_emploi.frontend import action
 from bob_emploi.frontend import advisor
 from bob_emploi.frontend import auth
+from bob_emploi.frontend import carif
+from bob_emploi.frontend import companies
 from bob_emploi.frontend import evaluation
+from bob_emploi.frontend import monitoring
 from bob_emploi.frontend import now
 from bob_emploi.frontend import opengraph
 from bob_emploi.frontend import proto
+from bob_emploi.frontend import resources
 from bob_emploi.frontend import scoring
+from bob_emploi.frontend import user_cache
 from bob_emploi.frontend.api import action_pb2
-from bob_emploi.frontend.api import application_pb2
 from bob_emploi.frontend.api import association_pb2
 from bob_emploi.frontend.api import config_pb2
 from bob_emploi.frontend.api import chantier_pb2
-from bob_emploi.frontend.api import event_pb2
 from bob_emploi.frontend.api import feedback_pb2
 from bob_emploi.frontend.api import job_pb2
-from bob_emploi.frontend.api import commute_pb2
-from bob_emploi.frontend.api import jobboard_pb2
 from bob_emploi.frontend.api import project_pb2
 from bob_emploi.frontend.api import stats_pb2
 from bob_emploi.frontend.api import user_pb2
@@ -60,6 +60,11 @@ _DB = pymongo.MongoClient(os.getenv('MONGO_URL', 'mongodb://localhost/test'))\
 
 _SERVER_TAG = {'_server': os.getenv('SERVER_VERSION', 'dev')}
 
+# Store users as binary protos (with only their indexed fields as JSON) instead
+# of JSON documents. Existing JSON documents can still be read, and can be
+# migrated with asynchronous/migrate_user_storage.py.
+_STORE_USERS_AS_PROTOS = bool(os.getenv('STORE_USERS_AS_PROTOS'))
+
 _SLACK_FEEDBACK_URL = os.getenv('SLACK_FEEDBACK_URL')
 _ADMIN_AUTH_TOKEN = os.getenv('ADMIN_AUTH_TOKEN')
 
@@ -81,8 +86,8 @@ ADVISOR_DISABLED_FOR_TESTING = False
 
 _Tick = collections.namedtuple('Tick', ['name', 'time'])
 
-# Log timing of requests that take too long to be treated.
-_LONG_REQUEST_DURATION_SECONDS = 1.5
+# Number of times to try saving a user that is modified concurrently.
+_MAX_SAVE_USER_ATTEMPTS = 3
 
 
 def requires_admin_auth(func):
@@ -126,6 +131,7 @@ def delete_user(user_data):
     if filter_user:
         _DB.user_auth.delete_one(filter_user)
         _DB.user.delete_one(filter_user)
+        user_cache.forget_user(str(filter_user['_id']))
     return user_pb2.UserId(user_id=user_data.user_id)
 
 
@@ -168,12 +174,19 @@ def user_likes(user_data):
     for key in user_data.likes.keys():
         if '.' in key or '$' in key:
             flask.abort(422, 'Liked feature IDs cannot contain . or $, got "%s"' % key)
+    if _STORE_USERS_AS_PROTOS:
+        # The likes of binary users cannot be updated one by one: they are
+        # merged and stored as a JSON field that overrides the binary one.
+        likes = dict(_get_user_data(user_data.user_id).likes)
+        likes.update(user_data.likes)
+        update = {'likes': likes}
+    else:
+        update = {'likes.%s' % key: value for key, value in user_data.likes.items()}
     result = _DB.user.update_one(
-        {'_id': _safe_object_id(user_data.user_id)}, {'$set': {
-            'likes.%s' % key: value for key, value in user_data.likes.items()}},
-        upsert=False)
+        {'_id': _safe_object_id(user_data.user_id)}, {'$set': update}, upsert=False)
     if not result.matched_count:
         flask.abort(404, 'Utilisateur "%s" inconnu.' % user_data.user_id)
+    user_cache.forget_user(user_data.user_id)
     return ''
 
 
@@ -239,17 +252,62 @@ def _get_feedback_context(feedback):
 
 
 def _save_user(user_data, is_new_user):
-    _tick('Save user start')
+    _tick('Save user prepare')
 
     if is_new_user:
-        previous_user_data = user_data
-    else:
+        post_save_actions = _process_user(user_data, user_data, is_new_user=True)
+        _tick('Save user')
+        user_dict = _user_to_mongo(user_data)
+        user_dict['_id'] = _get_unguessable_object_id()
+        result = _DB.user.insert_one(user_dict)
+        user_data.user_id = str(result.inserted_id)
+        _run_post_save_actions(post_save_actions)
+        _tick('Return user proto')
+        return user_data
+
+    for unused_attempt in range(_MAX_SAVE_USER_ATTEMPTS):
         _tick('Load old user data')
-        previous_user_data = _get_user_data(user_data.user_id)
+        previous_user_data, previous_user_dict = _load_user(user_data.user_id)
         if user_data.revision and previous_user_data.revision > user_data.revision:
             # Do not overwrite newer data that was saved already: just return it.
             return previous_user_data
 
+        # Work on a copy so that a retry merges the data sent by the client
+        # again with the latest stored data.
+        new_user_data = user_pb2.User()
+        new_user_data.CopyFrom(user_data)
+        post_save_actions = _process_user(
+            new_user_data, previous_user_data, is_new_user=False)
+
+        # Modifications on new_user_data after this point will not be saved.
+        _tick('Save user')
+        if _update_user(new_user_data.user_id, previous_user_dict, _user_to_mongo(new_user_data)):
+            user_cache.forget_user(new_user_data.user_id)
+            # Only notify once the data is saved, not for each attempt.
+            _run_post_save_actions(post_save_actions)
+            _tick('Return user proto')
+            return new_user_data
+        _tick('Concurrent user update')
+
+    flask.abort(409, 'Les données utilisateur ont été modifiées en même temps, réessayez.')
+
+
+def _run_post_save_actions(post_save_actions):
+    _tick('Post save actions')
+    for post_save_action in post_save_actions:
+        post_save_action()
+
+
+def _process_user(user_data, previous_user_data, is_new_user):
+    """Merge the data of a user to save with their previous data.
+
+    This does not have any side effect outside of user_data, so that it can be
+    run again if the save fails.
+
+    Returns:
+        a list of functions to call once the user is saved, e.g. to send emails.
+    """
+    post_save_actions = []
     if not previous_user_data.registered_at.seconds:
         user_data.registered_at.FromDatetime(now.get())
         # No need to pollute our DB with super precise timestamps.
@@ -294,8 +352,10 @@ def _save_user(user_data, is_new_user):
                 {rome_id: project.local_stats}, project.mobility.city)
 
         _tick('Advisor')
-        advisor.maybe_advise(
-            user_data, project, _DB, parse.urljoin(flask.request.base_url, '/')[:-1])
+        if advisor.recommend_advice(user_data, project, _DB):
+            post_save_actions.append(functools.partial(
+                advisor.send_activation_email, user_data, project, _DB,
+                parse.urljoin(flask.request.base_url, '/')[:-1]))
 
         _tick('New feedback')
         if not is_new_user and (project.feedback.text or project.feedback.score):
@@ -308,13 +368,14 @@ def _save_user(user_data, is_new_user):
             else:
                 score_text = ''
             if project.feedback.text and not previous_project.feedback.text:
-                _give_feedback(feedback_pb2.Feedback(
-                    user_id=str(user_data.user_id),
-                    project_id=str(project.project_id),
-                    feedback=project.feedback.text,
-                    source=feedback_pb2.PROJECT_FEEDBACK), extra_text=score_text)
+                post_save_actions.append(functools.partial(
+                    _give_feedback, feedback_pb2.Feedback(
+                        user_id=str(user_data.user_id),
+                        project_id=str(project.project_id),
+                        feedback=project.feedback.text,
+                        source=feedback_pb2.PROJECT_FEEDBACK), extra_text=score_text))
             else:
-                _tell_slack(score_text)
+                post_save_actions.append(functools.partial(_tell_slack, score_text))
 
         _tick('Process project end')
 
@@ -324,19 +385,34 @@ def _save_user(user_data, is_new_user):
         _populate_feature_flags(user_data)
 
     user_data.revision += 1
+    return post_save_actions
 
-    # Modifications on user_data after this point will not be saved.
-    _tick('Save user')
-    user_dict = json_format.MessageToDict(user_data)
-    user_dict.update(_SERVER_TAG)
-    if is_new_user:
-        user_dict['_id'] = _get_unguessable_object_id()
-        result = _DB.user.insert_one(user_dict)
-        user_data.user_id = str(result.inserted_id)
+
+def _user_to_mongo(user_data):
+    if _STORE_USERS_AS_PROTOS:
+        user_dict = proto.to_binary_document(user_data, auth.USER_INDEXED_FIELDS)
     else:
-        _DB.user.replace_one({'_id': _safe_object_id(user_data.user_id)}, user_dict)
-    _tick('Return user proto')
-    return user_data
+        user_dict = json_format.MessageToDict(user_data)
+    user_dict.update(_SERVER_TAG)
+    return user_dict
+
+
+def _update_user(user_id, previous_user_dict, user_dict):
+    """Update a user document by only sending the fields that changed.
+
+    Returns:
+        False if the document was modified since it was read, in which case it
+        is not updated.
+    """
+    update = proto.get_mongo_update(previous_user_dict, user_dict)
+    if not update:
+        return True
+    # Compare-and-swap: only update the fields if the document has not been
+    # saved since it was read.
+    result = _DB.user.update_one(
+        {'_id': _safe_object_id(user_id), 'revision': previous_user_dict.get('revision')},
+        update)
+    return bool(result.matched_count)
 
 
 def _create_new_project_id(user_data):
@@ -447,6 +523,12 @@ def _safe_object_id(_id):
         flask.abort(400, 'L\'identifiant "%s" n\'est pas un identifiant MongoDB valide.' % _id)
 
 
+def _get_cached_scoring_project(user_id, project_id):
+    """Get a user's project and its scoring environment, see user_cache."""
+    return user_cache.get_scoring_project(
+        user_id, project_id, _DB, _get_user_data, _get_project_data)
+
+
 # Mapping of old diploma estimates to new training estimates.
 TRAINING_ESTIMATION = {
     project_pb2.FULFILLED: project_pb2.ENOUGH_DIPLOMAS,
@@ -458,7 +540,18 @@ TRAINING_ESTIMATION = {
 
 def _get_user_data(user_id):
     """Load user data from DB."""
+    return _load_user(user_id)[0]
+
+
+def _load_user(user_id):
+    """Load user data from DB.
+
+    Returns:
+        a tuple with the user proto, and the document as it is stored in the DB.
+    """
     user_dict = _DB.user.find_one({'_id': _safe_object_id(user_id)})
+    # Keep the stored document as parse_from_mongo drops its private fields.
+    stored_user_dict = dict(user_dict) if user_dict else None
     user_proto = user_pb2.User()
     if not proto.parse_from_mongo(user_dict, user_proto):
         # Switch to raising an error if you move this function in a lib.
@@ -501,7 +594,7 @@ def _get_user_data(user_id):
     user_proto.profile.ClearField('latest_job')
     user_proto.profile.ClearField('situation')
 
-    return user_proto
+    return user_proto, stored_user_dict
 
 
 def _get_project_data(user_proto, project_id):
@@ -558,7 +651,7 @@ def reset_password(auth_request):
 
 
 # Cache (from MongoDB) of job group info.
-_JOB_GROUPS_INFO = proto.MongoCachedCollection(job_pb2.JobGroup, 'job_group_info')
+_JOB_GROUPS_INFO = proto.MongoCachedCollection(job_pb2.JobGroup, 'job_group_info', lazy=True)
 
 
 def _job_groups_info():
@@ -589,115 +682,15 @@ def _get_project_requirements(project):
     return job_group_info.requirements
 
 
-@app.route('/api/project/<user_id>/<project_id>/associations', methods=['GET'])
-@proto.flask_api(out_type=association_pb2.Associations)
-def project_associations(user_id, project_id):
-    """Retrieve a list of associations for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    associations = scoring_project.list_associations()
-    sorted_associations = sorted(associations, key=lambda j: (-len(j.filters), random.random()))
-    return association_pb2.Associations(associations=sorted_associations)
-
-
-@app.route('/api/project/<user_id>/<project_id>/events', methods=['GET'])
-@proto.flask_api(out_type=event_pb2.Events)
-def project_events(user_id, project_id):
-    """Retrieve a list of associations for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB, now=now.get())
-    events = scoring_project.list_events()
-    sorted_events = sorted(events, key=lambda j: (j.start_date, -len(j.filters), random.random()))
-    return event_pb2.Events(events=sorted_events)
-
-
-@app.route('/api/project/<user_id>/<project_id>/interview-tips', methods=['GET'])
-@proto.flask_api(out_type=application_pb2.InterviewTips)
-def project_interview_tips(user_id, project_id):
-    """Retrieve a list of interview tips for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    interview_tips = scoring_project.list_application_tips()
-    sorted_tips = sorted(interview_tips, key=lambda t: (-len(t.filters), random.random()))
-    tips_proto = application_pb2.InterviewTips(
-        qualities=[t for t in sorted_tips if t.type == application_pb2.QUALITY],
-        preparations=[
-            t for t in sorted_tips
-            if t.type == application_pb2.INTERVIEW_PREPARATION])
-    for tip in itertools.chain(tips_proto.qualities, tips_proto.preparations):
-        tip.ClearField('type')
-    return tips_proto
-
-
-@app.route('/api/project/<user_id>/<project_id>/jobboards', methods=['GET'])
-@proto.flask_api(out_type=jobboard_pb2.JobBoards)
-def project_jobboards(user_id, project_id):
-    """Retrieve a list of job boards for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    jobboards = scoring_project.list_jobboards()
-    sorted_jobboards = sorted(jobboards, key=lambda j: (-len(j.filters), random.random()))
-    return jobboard_pb2.JobBoards(job_boards=sorted_jobboards)
-
-
-@app.route('/api/project/<user_id>/<project_id>/resume-tips', methods=['GET'])
-@proto.flask_api(out_type=application_pb2.ResumeTips)
-def project_resume_tips(user_id, project_id):
-    """Retrieve a list of resume tips for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    resume_tips = scoring_project.list_application_tips()
-    sorted_tips = sorted(resume_tips, key=lambda t: (-len(t.filters), random.random()))
-    tips_proto = application_pb2.ResumeTips(
-        qualities=[t for t in sorted_tips if t.type == application_pb2.QUALITY],
-        improvements=[t for t in sorted_tips if t.type == application_pb2.CV_IMPROVEMENT])
-    for tip in itertools.chain(tips_proto.qualities, tips_proto.improvements):
-        tip.ClearField('type')
-    return tips_proto
-
-
-@app.route('/api/project/<user_id>/<project_id>/volunteer', methods=['GET'])
-@proto.flask_api(out_type=association_pb2.VolunteeringMissions)
-def project_volunteer(user_id, project_id):
-    """Retrieve a list of job boards for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    return scoring_project.volunteering_missions()
-
-
-@app.route('/api/project/<user_id>/<project_id>/commute', methods=['GET'])
-@proto.flask_api(out_type=commute_pb2.CommutingCities)
-def project_commute(user_id, project_id):
-    """Retrieve a list of commuting cities for a project."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
-
-    scoring_project = scoring.ScoringProject(
-        project, user_proto.profile, user_proto.features_enabled, _DB)
-    return commute_pb2.CommutingCities(cities=scoring_project.list_nearby_cities())
-
-
 @app.route('/api/project/<user_id>/<project_id>/advice/<advice_id>/tips', methods=['GET'])
 @proto.flask_api(out_type=action_pb2.AdviceTips)
 def advice_tips(user_id, project_id, advice_id):
     """Get all available tips for a piece of advice."""
-    user_proto = _get_user_data(user_id)
-    project = _get_project_data(user_proto, project_id)
+    user_proto, project, scoring_project = _get_cached_scoring_project(user_id, project_id)
     piece_of_advice = _get_advice_data(project, advice_id)
 
-    all_tips = advisor.list_all_tips(user_proto, project, piece_of_advice, _DB)
+    all_tips = advisor.list_all_tips(
+        user_proto, project, piece_of_advice, _DB, cache={'scoring_project': scoring_project})
 
     response = action_pb2.AdviceTips()
     for tip_template in all_tips:
@@ -734,7 +727,11 @@ def clear_cache():
     _JOB_GROUPS_INFO.reset_cache()
     _CHANTIERS.reset_cache()
     _SHOW_UNVERIFIED_DATA_USERS.clear()
+    user_cache.clear()
     advisor.clear_cache()
+    carif.clear_cache()
+    companies.clear_cache()
+    scoring.clear_cache()
     return 'Server cache cleared.'
 
 
@@ -888,6 +885,7 @@ def set_nps_survey_response(nps_survey_response):
         )}},
         upsert=False
     )
+    user_cache.forget_user(str(user_id))
     return ''
 
 
@@ -910,6 +908,7 @@ def get_usage_stats():
             },
         },
         {
+            proto.BINARY_FIELD: 1,
             'profile.email': 1,
             'projects': 1,
             'registeredAt': 1,
@@ -951,6 +950,15 @@ app.register_blueprint(evaluation.app, url_prefix='/api/eval')
 app.register_blueprint(opengraph.app, url_prefix='/og')
 
 
+app.register_blueprint(monitoring.create_blueprint(requires_admin_auth), url_prefix='/api')
+
+
+app.register_blueprint(
+    resources.create_blueprint(
+        lambda user_id, project_id: _get_cached_scoring_project(user_id, project_id)[2]),
+    url_prefix='/api/project')
+
+
 @app.before_request
 def _before_request():
     flask.g.start = time.time()
@@ -973,16 +981,9 @@ def _is_test_user(user_proto):
 
 @app.teardown_request
 def _teardown_request(unused_exception=None):
-    total_duration = time.time() - flask.g.start
-    if total_duration <= _LONG_REQUEST_DURATION_SECONDS:
-        return
-    logging.warning('Long request: %d seconds', total_duration)
-    last_tick_time = flask.g.start
-    for tick in sorted(flask.g.ticks, key=lambda t: t.time):
-        logging.warning(
-            '%.4f: Tick %s (%.4f since last tick)',
-            tick.time - flask.g.start, tick.name, tick.time - last_tick_time)
-        last_tick_time = tick.time
+    monitoring.record_request(
+        flask.request.endpoint or 'unknown', flask.g.start,
+        sorted(flask.g.ticks, key=lambda t: t.time), time.time())
 
 
 app.config['DATABASE'] = _DB
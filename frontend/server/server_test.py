@@ -13,8 +13,12 @@ import mongomock
 import requests
 
 from bob_emploi.frontend import base_test
+from bob_emploi.frontend import monitoring
 from bob_emploi.frontend import now
+from bob_emploi.frontend import resources
+from bob_emploi.frontend import scoring
 from bob_emploi.frontend import server
+from bob_emploi.frontend import user_cache
 
 # TODO(pascal): Split this smaller test modules.
 # pylint: disable=too-many-lines
@@ -451,6 +455,140 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         self.assertGreater(
             job_search_started_at, datetime.datetime.now() - datetime.timedelta(days=200))
 
+    def test_save_user_partial_update(self):
+        """Saving a user only sends the fields that changed."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal', 'gender': 'MASCULINE'}})
+        user_info = self.get_user_info(user_id)
+        user_info['profile']['name'] = 'Cyrille'
+
+        with mock.patch.object(
+                self._db.user, 'update_one', wraps=self._db.user.update_one) as mock_update:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+
+        mock_update.assert_called_once()
+        user_filter, update = mock_update.call_args[0]
+        self.assertEqual(user_info['revision'], user_filter['revision'])
+        self.assertEqual('Cyrille', update['$set']['profile.name'])
+        self.assertNotIn('profile', update['$set'])
+        self.assertNotIn('profile.gender', update['$set'])
+        self.assertEqual('Cyrille', self.get_user_info(user_id)['profile']['name'])
+
+    def _save_user_concurrently(self, user_id, num_concurrent_saves):
+        load_user = server._load_user  # pylint: disable=protected-access
+        loads = []
+
+        def _load_then_save(load_user_id):
+            loaded = load_user(load_user_id)
+            loads.append(load_user_id)
+            if len(loads) <= num_concurrent_saves:
+                self._db.user.update_one(
+                    {'_id': mongomock.ObjectId(user_id)},
+                    {'$set': {'profile.lastName': 'Corpet'}, '$inc': {'revision': 1}})
+            return loaded
+
+        return loads, mock.patch(server.__name__ + '._load_user', new=_load_then_save)
+
+    def test_save_user_concurrent_update(self):
+        """Retry saving the user if it was saved since it was read."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}})
+        user_info = self.get_user_info(user_id)
+        user_info['profile']['name'] = 'Cyrille'
+        del user_info['revision']
+
+        loads, patch = self._save_user_concurrently(user_id, 1)
+        with patch:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(2, len(loads))
+        self.assertEqual('Cyrille', self.get_user_info(user_id)['profile']['name'])
+
+    def test_save_user_concurrent_newer_revision(self):
+        """Return the stored user if a newer revision was saved concurrently."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}})
+        user_info = self.get_user_info(user_id)
+        user_info['profile']['name'] = 'Cyrille'
+
+        unused_loads, patch = self._save_user_concurrently(user_id, 1)
+        with patch:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+
+        saved_user_info = self.json_from_response(response)
+        self.assertEqual('Pascal', saved_user_info['profile']['name'])
+        self.assertEqual('Corpet', saved_user_info['profile']['lastName'])
+
+    @mock.patch(server.__name__ + '._tell_slack')
+    @mock.patch(server.__name__ + '.advisor.send_activation_email')
+    def test_save_user_concurrent_update_notify_once(self, mock_send_email, mock_tell_slack):
+        """Send emails and Slack messages only once when retrying to save a user."""
+        self._db.advice_modules.insert_one({
+            'adviceId': 'network',
+            'triggerScoringModel': 'constant(2)',
+            'isReadyForProd': True,
+        })
+        server.clear_cache()
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}}, advisor=True)
+        user_info = self.get_user_info(user_id)
+        _add_project(user_info)
+        user_info['projects'][0]['feedback'] = {'score': 5}
+        del user_info['revision']
+
+        loads, patch = self._save_user_concurrently(user_id, 1)
+        with patch:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+
+        self.assertEqual(2, len(loads))
+        mock_send_email.assert_called_once()
+        self.assertEqual(
+            ['network'], [a.advice_id for a in mock_send_email.call_args[0][1].advices])
+        mock_tell_slack.assert_called_once()
+        self.assertIn(':star:' * 5, mock_tell_slack.call_args[0][0])
+
+    @mock.patch(server.__name__ + '._tell_slack')
+    @mock.patch(server.__name__ + '.advisor.send_activation_email')
+    def test_save_user_too_many_concurrent_updates_no_notification(
+            self, mock_send_email, mock_tell_slack):
+        """Do not notify anything for a user that could not be saved."""
+        self._db.advice_modules.insert_one({
+            'adviceId': 'network',
+            'triggerScoringModel': 'constant(2)',
+            'isReadyForProd': True,
+        })
+        server.clear_cache()
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}}, advisor=True)
+        user_info = self.get_user_info(user_id)
+        _add_project(user_info)
+        user_info['projects'][0]['feedback'] = {'score': 5}
+        del user_info['revision']
+
+        unused_loads, patch = self._save_user_concurrently(user_id, 10)
+        with patch:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(409, response.status_code)
+
+        mock_send_email.assert_not_called()
+        mock_tell_slack.assert_not_called()
+
+    def test_save_user_too_many_concurrent_updates(self):
+        """Give up saving a user that keeps being saved concurrently."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}})
+        user_info = self.get_user_info(user_id)
+        user_info['profile']['name'] = 'Cyrille'
+        del user_info['revision']
+
+        unused_loads, patch = self._save_user_concurrently(user_id, 10)
+        with patch:
+            response = self.app.post(
+                '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(409, response.status_code)
+
     def test_user(self):
         """Basic usage."""
         time_before = datetime.datetime.now() - datetime.timedelta(seconds=1)
@@ -512,9 +650,9 @@ class UserEndpointTestCase(base_test.ServerTestCase):
         # Check the app is available for user.
         self.assertFalse(user_info.get('appNotAvailable'))
 
-    @mock.patch(server.__name__ + '.advisor.maybe_advise')
+    @mock.patch(server.__name__ + '.advisor.recommend_advice')
     @mock.patch(server.__name__ + '.time.time')
-    @mock.patch(server.__name__ + '.logging.warning')
+    @mock.patch(monitoring.__name__ + '.logging.warning')
     def test_log_long_requests(self, mock_warning, mock_time, mock_advise):
         """Log timing for long requests."""
         # Variable as a list to be used in closures below.
@@ -1135,6 +1273,141 @@ class ProjectJobBoardsTestCase(base_test.ServerTestCase):
             [j.get('title') for j in jobboards.get('jobBoards', [])])
 
 
+class CachedUserTestCase(base_test.ServerTestCase):
+    """Unit tests for the short-lived cache of users for the project endpoints."""
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        super(CachedUserTestCase, self).setUp()
+        self.user_id = self.create_user(modifiers=[_add_project], advisor=True)
+        user_info = self.get_user_info(self.user_id)
+        self.project_id = user_info['projects'][0]['projectId']
+        self._db.jobboards.insert_one({'title': 'Indeed'})
+        self._db.associations.insert_one({'name': 'SNC'})
+
+    def _get_project_data(self, endpoint):
+        response = self.app.get(
+            '/api/project/%s/%s/%s' % (self.user_id, self.project_id, endpoint))
+        return self.json_from_response(response)
+
+    def test_load_user_once(self):
+        """Several project endpoints only load the user and its project once."""
+        with mock.patch(
+                server.__name__ + '._get_user_data',
+                wraps=server._get_user_data) as mock_get_user_data, \
+                mock.patch(server.scoring.__name__ + '.ScoringProject',
+                           wraps=server.scoring.ScoringProject) as mock_scoring_project:
+            self._get_project_data('jobboards')
+            self._get_project_data('associations')
+            self._get_project_data('commute')
+
+        mock_get_user_data.assert_called_once_with(self.user_id)
+        mock_scoring_project.assert_called_once()
+
+    def test_save_user(self):
+        """Saving a user drops it from the cache."""
+        self._get_project_data('jobboards')
+
+        user_info = self.get_user_info(self.user_id)
+        user_info['projects'][0]['mobility']['city']['departementId'] = '69'
+        response = self.app.post(
+            '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+
+        with mock.patch(
+                server.__name__ + '._get_user_data',
+                wraps=server._get_user_data) as mock_get_user_data:
+            self._get_project_data('jobboards')
+        mock_get_user_data.assert_called_once_with(self.user_id)
+
+    def test_saved_by_another_process(self):
+        """A user saved by another server process is loaded again."""
+        self._get_project_data('jobboards')
+
+        # Save the user without going through this process' cache.
+        self._db.user.update_one(
+            {}, {'$inc': {'revision': 1}, '$set': {'projects.0.mobility.city.departementId': '69'}})
+
+        with mock.patch(
+                server.__name__ + '._get_user_data',
+                wraps=server._get_user_data) as mock_get_user_data:
+            self._get_project_data('jobboards')
+            self._get_project_data('associations')
+        mock_get_user_data.assert_called_once_with(self.user_id)
+
+    @mock.patch(user_cache.__name__ + '._CACHED_USER_DURATION', new=datetime.timedelta(0))
+    def test_expired(self):
+        """Users are only kept for a short time."""
+        with mock.patch(
+                server.__name__ + '._get_user_data',
+                wraps=server._get_user_data) as mock_get_user_data:
+            self._get_project_data('jobboards')
+            self._get_project_data('jobboards')
+        self.assertEqual(2, mock_get_user_data.call_count)
+
+    def test_unknown_user(self):
+        """Errors are not cached."""
+        user_in_db = self._db.user.find_one_and_delete({})
+        response = self.app.get('/api/project/%s/%s/jobboards' % (self.user_id, self.project_id))
+        self.assertEqual(404, response.status_code)
+
+        self._db.user.insert_one(user_in_db)
+        self.assertEqual({'jobBoards': [{'title': 'Indeed'}]}, self._get_project_data('jobboards'))
+
+
+class ProjectResourcesTestCase(base_test.ServerTestCase):
+    """Unit tests for the project/.../resources endpoint."""
+
+    def setUp(self):
+        super(ProjectResourcesTestCase, self).setUp()
+        self.user_id = self.create_user(modifiers=[_add_project], advisor=True)
+        user_info = self.get_user_info(self.user_id)
+        self.project_id = user_info['projects'][0]['projectId']
+        self._db.jobboards.insert_one({'title': 'Indeed'})
+        self._db.associations.insert_one({'name': 'SNC'})
+
+    def _get_resources(self, names):
+        response = self.app.post(
+            '/api/project/%s/%s/resources' % (self.user_id, self.project_id),
+            data=json.dumps({'resources': names}),
+            content_type='application/json')
+        return self.json_from_response(response)
+
+    def test_several_resources(self):
+        """Compute several resources at once."""
+        results = self._get_resources(['jobboards', 'associations'])
+        self.assertEqual({
+            'associations': {'associations': [{'name': 'SNC'}]},
+            'jobBoards': {'jobBoards': [{'title': 'Indeed'}]},
+        }, results)
+
+    def test_unknown_resource(self):
+        """Report unknown resources as errors."""
+        results = self._get_resources(['jobboards', 'unknown'])
+        self.assertEqual({'jobBoards': [{'title': 'Indeed'}]}, results['jobBoards'])
+        self.assertEqual(
+            [{'resource': 'unknown', 'message': 'Ressource inconnue.'}], results['errors'])
+
+    @mock.patch(resources.__name__ + '.logging.exception')
+    @mock.patch(server.scoring.__name__ + '.ScoringProject.list_associations')
+    def test_failing_resource(self, mock_list_associations, mock_logging):
+        """A failing resource does not prevent computing the others."""
+        mock_list_associations.side_effect = ValueError('Oops')
+        results = self._get_resources(['associations', 'jobboards'])
+        self.assertEqual({'jobBoards': [{'title': 'Indeed'}]}, results['jobBoards'])
+        self.assertNotIn('associations', results)
+        self.assertEqual([{'resource': 'associations', 'message': 'Oops'}], results['errors'])
+        mock_logging.assert_called_once()
+
+    def test_unknown_project(self):
+        """Fail on an unknown project."""
+        response = self.app.post(
+            '/api/project/%s/foo/resources' % self.user_id,
+            data='{"resources": ["jobboards"]}', content_type='application/json')
+        self.assertEqual(404, response.status_code)
+
+
 class ProjectInterviewTipsTestCase(base_test.ServerTestCase):
     """Unit tests for the project/.../interview-tips endpoint."""
 
@@ -1290,11 +1563,6 @@ class ProjectCommuteTestCase(base_test.ServerTestCase):
 
     def test_lyon(self):
         """Cities available close to Lyon."""
-        user_id = self.create_user(
-            data={'projects': [{
-                'mobility': {'city': {'cityId': '69123'}},
-                'targetJob': {'jobGroup': {'romeId': 'A6789'}},
-            }]})
         self._db.cities.insert_one({
             '_id': '69123',
             'name': 'Lyon',
@@ -1327,6 +1595,11 @@ class ProjectCommuteTestCase(base_test.ServerTestCase):
                 },
             ],
         })
+        user_id = self.create_user(
+            data={'projects': [{
+                'mobility': {'city': {'cityId': '69123'}},
+                'targetJob': {'jobGroup': {'romeId': 'A6789'}},
+            }]})
         user_info = self.get_user_info(user_id)
         project_id = user_info['projects'][0]['projectId']
         response = self.app.get('/api/project/%s/%s/commute' % (user_id, project_id))
@@ -1514,6 +1787,103 @@ class CacheClearEndpointTestCase(base_test.ServerTestCase):
         self.assertEqual(['6789'], self._get_requirements('A1234'))
 
 
+class MetricsEndpointTestCase(base_test.ServerTestCase):
+    """Unit tests for the metrics endpoint."""
+
+    def setUp(self):  # pylint: disable=missing-docstring
+        super(MetricsEndpointTestCase, self).setUp()
+        server._ADMIN_AUTH_TOKEN = ''
+        monitoring._REQUEST_DURATION.reset()
+        monitoring._REQUEST_STAGE_DURATION.reset()
+
+    def test_stages(self):
+        """Export the duration of each stage of the requests."""
+        self.create_user(email='foo@bar.fr')
+
+        response = self.app.get('/api/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response.content_type)
+        metrics_text = response.get_data(as_text=True)
+
+        self.assertIn('# TYPE bob_request_stage_duration_seconds histogram', metrics_text)
+        self.assertIn('bob_request_duration_seconds_count{endpoint="user"} ', metrics_text)
+        self.assertIn(
+            'bob_request_stage_duration_seconds_count{endpoint="user",'
+            'stage="Unverified data zone check"} ', metrics_text)
+        self.assertIn(
+            'bob_request_stage_duration_seconds_count{endpoint="user",stage="Save user"} ',
+            metrics_text)
+        # Ticks marking the end of a stage do not start a stage of their own.
+        self.assertNotIn('Unverified data zone check end', metrics_text)
+        self.assertEqual(
+            1, monitoring._REQUEST_STAGE_DURATION.get_count('user', 'Unverified data zone check'))
+        # Each stage is observed once per request.
+        self.assertEqual(1, monitoring._REQUEST_STAGE_DURATION.get_count('user', 'Save user'))
+        self.assertEqual(
+            1, monitoring._REQUEST_STAGE_DURATION.get_count('user', 'Save user prepare'))
+
+    def test_missing_auth(self):
+        """Endpoint protected and no auth token sent."""
+        server._ADMIN_AUTH_TOKEN = 'cryptic-admin-auth-token-123'
+        response = self.app.get('/api/metrics')
+        self.assertEqual(401, response.status_code)
+
+    def test_wrong_auth(self):
+        """Endpoint protected and wrong auth token sent."""
+        server._ADMIN_AUTH_TOKEN = 'cryptic-admin-auth-token-123'
+        response = self.app.get('/api/metrics', headers={'Authorization': 'wrong-token'})
+        self.assertEqual(403, response.status_code)
+
+
+class ScoringStatsEndpointTestCase(base_test.ServerTestCase):
+    """Unit tests for the scoring/stats endpoint."""
+
+    def setUp(self):  # pylint: disable=missing-docstring
+        super(ScoringStatsEndpointTestCase, self).setUp()
+        server._ADMIN_AUTH_TOKEN = ''
+        scoring.reset_stats()
+        self._db.advice_modules.insert_one({
+            'adviceId': 'commute',
+            'triggerScoringModel': 'constant(2)',
+            'isReadyForProd': True,
+        })
+        server.clear_cache()
+
+    @mock.patch(scoring.__name__ + '._STATS_ENABLED', new=True)
+    def test_get_stats(self):
+        """Get the stats of the scoring models used to advise."""
+        self.create_user(modifiers=[_add_project], advisor=True)
+
+        stats = self.json_from_response(self.app.get('/api/scoring/stats'))
+
+        self.assertTrue(stats.get('enabled'))
+        models = {m['scoringModelName']: m for m in stats.get('scoringModels', [])}
+        self.assertIn('constant(2)', models, msg=stats)
+        self.assertEqual(
+            [{'methodName': 'score', 'callCount': 1}],
+            [{k: v for k, v in method.items() if not k.endswith('DurationSeconds')}
+             for method in models['constant(2)']['methods']])
+
+        response = self.app.delete('/api/scoring/stats')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+            {'enabled': True}, self.json_from_response(self.app.get('/api/scoring/stats')))
+
+    def test_disabled(self):
+        """Do not record any stats when disabled."""
+        self.create_user(modifiers=[_add_project], advisor=True)
+
+        stats = self.json_from_response(self.app.get('/api/scoring/stats'))
+
+        self.assertEqual({}, stats)
+
+    def test_missing_auth(self):
+        """Endpoint protected and no auth token sent."""
+        server._ADMIN_AUTH_TOKEN = 'cryptic-admin-auth-token-123'
+        self.assertEqual(401, self.app.get('/api/scoring/stats').status_code)
+        self.assertEqual(401, self.app.delete('/api/scoring/stats').status_code)
+
+
 class CreateDashboardExportTestCase(base_test.ServerTestCase):
     """Unit test for create_dashboard_export endpoint."""
 
@@ -1775,5 +2145,62 @@ class JobsEndpointTestCase(base_test.ServerTestCase):
         }, job_group)
 
 
+@mock.patch(server.__name__ + '._STORE_USERS_AS_PROTOS', new=True)
+class BinaryUserStorageTestCase(base_test.ServerTestCase):
+    """Unit tests for the storage of users as binary protos."""
+
+    def test_save_user(self):
+        """Users are stored as binary protos with their indexed fields."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal', 'gender': 'MASCULINE'}})
+
+        user_in_db = self._db.user.find_one({'_id': mongomock.ObjectId(user_id)})
+        self.assertIn('_proto', user_in_db)
+        self.assertEqual({'email'}, set(user_in_db['profile']))
+        self.assertIn('registeredAt', user_in_db)
+        self.assertEqual('ACTIVE', user_in_db['featuresEnabled']['advisor'])
+
+        user_info = self.get_user_info(user_id)
+        self.assertEqual('Pascal', user_info['profile']['name'])
+        self.assertEqual('MASCULINE', user_info['profile']['gender'])
+
+    def test_read_json_user(self):
+        """Users stored as JSON documents are still read and then converted."""
+        with mock.patch(server.__name__ + '._STORE_USERS_AS_PROTOS', new=False):
+            user_id = self.create_user(data={'profile': {'name': 'Pascal'}})
+        self.assertNotIn(
+            '_proto', self._db.user.find_one({'_id': mongomock.ObjectId(user_id)}))
+
+        user_info = self.get_user_info(user_id)
+        self.assertEqual('Pascal', user_info['profile']['name'])
+
+        user_info['profile']['lastName'] = 'Corpet'
+        response = self.app.post(
+            '/api/user', data=json.dumps(user_info), content_type='application/json')
+        self.assertEqual(200, response.status_code)
+        user_in_db = self._db.user.find_one({'_id': mongomock.ObjectId(user_id)})
+        self.assertIn('_proto', user_in_db)
+        self.assertEqual('Corpet', self.get_user_info(user_id)['profile']['lastName'])
+
+    def test_save_likes(self):
+        """Likes are merged with the ones stored in the binary proto."""
+        user_id = self.create_user()
+        for likes in ('{"landing": 1}', '{"dashboard": -1}'):
+            response = self.app.post(
+                '/api/user/likes',
+                data='{"userId": "%s", "likes": %s}' % (user_id, likes),
+                content_type='application/json')
+            self.assertEqual(200, response.status_code)
+
+        user_info = self.get_user_info(user_id)
+        self.assertEqual({'landing': 1, 'dashboard': -1}, user_info.get('likes'))
+
+    def test_authenticate(self):
+        """Users stored as binary protos can still log in."""
+        user_id = self.create_user(data={'profile': {'name': 'Pascal'}}, email='foo@bar.fr')
+        user_info = self.user_login('foo@bar.fr')
+        self.assertEqual(user_id, user_info['userId'])
+        self.assertEqual('Pascal', user_info['profile']['name'])
+
+
 if __name__ == '__main__':
     unittest.main()  # pragma: no cover
@@ -0,0 +1,107 @@
+"""Short-lived in-memory cache of users and of their scoring projects.
+
+The frontend calls several project endpoints at once, e.g. to load the
+dashboard: the user is only loaded once from DB for all of them, and their
+scoring projects are shared so that the market data is only fetched once.
+
+Only the revision of a cached user is read from DB to check that the cache is
+still up to date, e.g. if the user was saved by another server process.
+"""
+import collections
+from concurrent import futures
+import datetime
+import threading
+
+from bson import objectid
+
+from bob_emploi.frontend import now
+from bob_emploi.frontend import scoring
+
+_CACHED_USER_DURATION = datetime.timedelta(seconds=5)
+_CACHED_USERS_MAX_SIZE = 1000
+_CACHED_USERS_LOCK = threading.Lock()
+# Cached users keyed by user ID, the least recently used first.
+_CACHED_USERS = collections.OrderedDict()
+
+_CachedUser = collections.namedtuple(
+    'CachedUser', ['future_user', 'database', 'expires_at', 'scoring_projects'])
+
+
+def _get_cached_user(user_id, database, load_user):
+    instant = datetime.datetime.now()
+    with _CACHED_USERS_LOCK:
+        cached = _CACHED_USERS.get(user_id)
+        is_loading = not cached or cached.database is not database or cached.expires_at <= instant
+        if is_loading:
+            cached = _CachedUser(futures.Future(), database, instant + _CACHED_USER_DURATION, {})
+            _CACHED_USERS[user_id] = cached
+            while len(_CACHED_USERS) > _CACHED_USERS_MAX_SIZE:
+                _CACHED_USERS.popitem(last=False)
+        _CACHED_USERS.move_to_end(user_id)
+
+    if is_loading:
+        try:
+            cached.future_user.set_result(load_user(user_id))
+        except Exception as error:  # pylint: disable=broad-except
+            # Do not cache errors, e.g. unknown users.
+            forget_user(user_id)
+            cached.future_user.set_exception(error)
+    elif _is_cached_user_outdated(user_id, cached):
+        # The user was saved since it was cached, e.g. by another server process.
+        with _CACHED_USERS_LOCK:
+            if _CACHED_USERS.get(user_id) is cached:
+                del _CACHED_USERS[user_id]
+        return _get_cached_user(user_id, database, load_user)
+
+    return cached
+
+
+def _is_cached_user_outdated(user_id, cached):
+    if cached.future_user.exception():
+        # The error is raised to the caller anyway.
+        return False
+    # The user ID is valid as the user could be loaded.
+    stored_user = cached.database.user.find_one(
+        {'_id': objectid.ObjectId(user_id)}, {'revision': 1})
+    stored_revision = (stored_user or {}).get('revision', 0)
+    return stored_revision != cached.future_user.result().revision
+
+
+def get_scoring_project(user_id, project_id, database, load_user, get_project):
+    """Get a user's project and its scoring environment, possibly from cache.
+
+    None of the returned objects must be modified as they are shared between
+    requests.
+
+    Args:
+        user_id: the ID of the user.
+        project_id: the ID of the project.
+        database: the database of the users and of the market data.
+        load_user: a function to load a user proto from DB from its ID.
+        get_project: a function to get a project from a user proto and a
+            project ID.
+    Returns:
+        a tuple with the user proto, the project proto and the scoring project.
+    """
+    cached = _get_cached_user(user_id, database, load_user)
+    user_proto = cached.future_user.result()
+    project = get_project(user_proto, project_id)
+    with _CACHED_USERS_LOCK:
+        scoring_project = cached.scoring_projects.get(project_id)
+        if not scoring_project:
+            scoring_project = scoring.ScoringProject(
+                project, user_proto.profile, user_proto.features_enabled, database, now=now.get())
+            cached.scoring_projects[project_id] = scoring_project
+    return user_proto, project, scoring_project
+
+
+def forget_user(user_id):
+    """Drop a user from the cache, e.g. after modifying it."""
+    with _CACHED_USERS_LOCK:
+        _CACHED_USERS.pop(user_id, None)
+
+
+def clear():
+    """Drop all the cached users."""
+    with _CACHED_USERS_LOCK:
+        _CACHED_USERS.clear()
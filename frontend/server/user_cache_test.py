@@ -0,0 +1,75 @@
+"""Unit tests for the bob_emploi.frontend.user_cache module."""
+import unittest
+
+from bson import objectid
+import mock
+import mongomock
+
+from bob_emploi.frontend import user_cache
+from bob_emploi.frontend.api import project_pb2
+from bob_emploi.frontend.api import user_pb2
+
+
+class GetScoringProjectTestCase(unittest.TestCase):
+    """Unit tests for the get_scoring_project function."""
+
+    def setUp(self):
+        super(GetScoringProjectTestCase, self).setUp()
+        user_cache.clear()
+        self.addCleanup(user_cache.clear)
+        self.database = mongomock.MongoClient().test
+        self.user_id = str(self.database.user.insert_one({'revision': 1}).inserted_id)
+        self.load_user = mock.MagicMock(side_effect=self._load_user)
+
+    def _load_user(self, user_id):
+        stored_user = self.database.user.find_one({'_id': objectid.ObjectId(user_id)})
+        if not stored_user:
+            raise KeyError(user_id)
+        user_proto = user_pb2.User(user_id=user_id, revision=stored_user['revision'])
+        user_proto.projects.add(project_id='0')
+        return user_proto
+
+    def _get_scoring_project(self, user_id=None):
+        return user_cache.get_scoring_project(
+            user_id or self.user_id, '0', self.database, self.load_user,
+            lambda user_proto, project_id: user_proto.projects[0])
+
+    def test_cached(self):
+        """Load the user only once for several calls."""
+        user_proto, project, scoring_project = self._get_scoring_project()
+        self.assertEqual(self.user_id, user_proto.user_id)
+        self.assertIsInstance(project, project_pb2.Project)
+        self.assertEqual('0', project.project_id)
+
+        self.assertIs(scoring_project, self._get_scoring_project()[2])
+        self.load_user.assert_called_once_with(self.user_id)
+
+    def test_outdated(self):
+        """Reload the user if it was saved since it was cached."""
+        self._get_scoring_project()
+        self.database.user.update_one(
+            {'_id': objectid.ObjectId(self.user_id)}, {'$set': {'revision': 2}})
+
+        user_proto = self._get_scoring_project()[0]
+        self.assertEqual(2, user_proto.revision)
+        self.assertEqual(2, self.load_user.call_count)
+
+    def test_forget_user(self):
+        """Reload a user that was dropped from the cache."""
+        self._get_scoring_project()
+        user_cache.forget_user(self.user_id)
+        self._get_scoring_project()
+        self.assertEqual(2, self.load_user.call_count)
+
+    def test_errors_not_cached(self):
+        """Do not cache the failures to load a user."""
+        unknown_user_id = str(objectid.ObjectId())
+        with self.assertRaises(KeyError):
+            self._get_scoring_project(unknown_user_id)
+        with self.assertRaises(KeyError):
+            self._get_scoring_project(unknown_user_id)
+        self.assertEqual(2, self.load_user.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover